@@ -12,6 +12,8 @@ from bpy.props import (
     BoolProperty,
     CollectionProperty,
     EnumProperty,
+    FloatProperty,
+    IntProperty,
     PointerProperty,
     StringProperty
 )
@@ -66,12 +68,27 @@ PROFILE_ITEMS = (
 IMAGE_STORAGE_ITEMS = (
     ('EMBED', 'Embed', 'Embed image data into the glTF file'),
     ('REFERENCE', 'Reference', 'Use the same filepath that Blender uses for images'),
-    ('COPY', 'Copy', 'Copy images to output directory and use a relative reference')
+    ('COPY', 'Copy', 'Copy images to output directory and use a relative reference'),
+    ('KTX2', 'KTX2', 'Copy images and write KTX2 files with precomputed mipmaps next to them'),
+)
+MIP_FILTER_ITEMS = (
+    ('BOX', 'Box', 'Average texels with a box filter'),
+    ('KAISER', 'Kaiser', 'Use a Kaiser windowed sinc filter for sharper mipmaps'),
 )
 ANIM_EXPORT_ITEMS = (
     ('ACTIVE', 'Active Only', 'Export the active action per object'),
     ('ELIGIBLE', 'All Eligible', 'Export all actions that can be used by an object'),
 )
+SPLIT_MARKER_ITEMS = (
+    ('NONE', 'None', 'Export each action as a single animation'),
+    ('POSE', 'Pose Markers', 'Split actions into clips at their pose markers'),
+    ('TIMELINE', 'Timeline Markers', 'Split actions into clips at the scene timeline markers'),
+)
+WEIGHT_TYPE_ITEMS = (
+    ('FLOAT', 'Float', 'Store skin weights as floats'),
+    ('UNSIGNED_BYTE', 'Unsigned Byte', 'Store skin weights as normalized unsigned bytes'),
+    ('UNSIGNED_SHORT', 'Unsigned Short', 'Store skin weights as normalized unsigned shorts'),
+)
 _DEFAULT_VALUES_BY_PARAM_TYPE = {
     5124 : 1, # GL_INT
     5126 : 1.0, # GL_FLOAT
@@ -155,6 +172,24 @@ class ExportGLTF(bpy.types.Operator, ExportHelper, GLTFOrientationHelper):
         description='Only export nodes that are currently selected',
         default=False
     )
+    nodes_gpu_instancing = BoolProperty(
+        name='GPU Instancing',
+        description='Draw static meshes shared by several objects or dupli-groups as '
+                    'instances with EXT_mesh_gpu_instancing',
+        default=False
+    )
+    nodes_flatten_hierarchy = BoolProperty(
+        name='Flatten Hierarchy',
+        description='Remove static empties without children or extras and fold static empties '
+                    'with a single child into that child',
+        default=False
+    )
+    nodes_bounding_volumes = BoolProperty(
+        name='Bounding Volumes',
+        description='Store world space bounds of static nodes and primitives and a bounding '
+                    'volume hierarchy over them in scene extras',
+        default=False
+    )
     materials_disable = BoolProperty(
         name='Disable Material Export',
         description='Export minimum default materials. Useful when using material extensions',
@@ -173,6 +208,45 @@ class ExportGLTF(bpy.types.Operator, ExportHelper, GLTFOrientationHelper):
         ),
         default=False
     )
+    meshes_weight_threshold = FloatProperty(
+        name='Weight Threshold',
+        description='Drop skin influences below this fraction of the total weight of their vertex',
+        min=0.0,
+        max=1.0,
+        default=0.001,
+        precision=4
+    )
+    meshes_weight_type = EnumProperty(
+        items=WEIGHT_TYPE_ITEMS,
+        name='Weight Type',
+        default='FLOAT'
+    )
+    meshes_merge_static = BoolProperty(
+        name='Merge Static Meshes',
+        description='Merge static, unanimated mesh objects into one mesh per batch with a '
+                    'primitive per material',
+        default=False
+    )
+    meshes_merge_max_vertices = IntProperty(
+        name='Max Merged Vertices',
+        description='Largest number of vertices in a merged mesh, so merged meshes can still '
+                    'be culled',
+        min=3,
+        default=65535
+    )
+    meshes_match_transformed = BoolProperty(
+        name='Match Transformed Meshes',
+        description='Export meshes that are rotated and moved copies of another mesh as that '
+                    'mesh, with the difference moved onto the object transform',
+        default=False
+    )
+    meshes_max_joints = IntProperty(
+        name='Max Joints',
+        description='Split skinned meshes into partitions that each use at most this many '
+                    'joints (at least 12), 0 to disable',
+        min=0,
+        default=0
+    )
     animations_object_export = EnumProperty(
         items=ANIM_EXPORT_ITEMS,
         name='Objects',
@@ -183,16 +257,133 @@ class ExportGLTF(bpy.types.Operator, ExportHelper, GLTFOrientationHelper):
         name='Armatures',
         default='ELIGIBLE'
     )
+    animations_split_markers = EnumProperty(
+        items=SPLIT_MARKER_ITEMS,
+        name='Split Clips',
+        default='NONE'
+    )
+    animations_native_keyframes = BoolProperty(
+        name='Export Keyframes',
+        description=(
+            'Export F-curve keyframes as STEP, LINEAR or CUBICSPLINE samplers where glTF can '
+            'represent them, and bake the remaining channels (glTF 2.0 only)'
+        ),
+        default=False
+    )
+    animations_reduce_keyframes = BoolProperty(
+        name='Reduce Keyframes',
+        description=(
+            'Remove keyframes that linear interpolation can reproduce within the tolerances '
+            'and store channels that never change on the nodes instead'
+        ),
+        default=False
+    )
+    animations_quantize_rotations = BoolProperty(
+        name='Quantize Rotations',
+        description=(
+            'Store rotation keyframes as normalized 8 or 16 bit integers when they stay within '
+            'the quantization error (glTF 2.0 only)'
+        ),
+        default=False
+    )
+    animations_quantization_error = FloatProperty(
+        name='Quantization Error',
+        description='Maximum angle a quantized rotation may deviate',
+        min=0.0,
+        default=0.0005,
+        precision=4,
+        subtype='ANGLE'
+    )
+    animations_translation_tolerance = FloatProperty(
+        name='Translation Tolerance',
+        description='Maximum distance a reduced translation channel may deviate',
+        min=0.0,
+        default=0.0001,
+        precision=5
+    )
+    animations_rotation_tolerance = FloatProperty(
+        name='Rotation Tolerance',
+        description='Maximum angle a reduced rotation channel may deviate',
+        min=0.0,
+        default=0.001,
+        precision=4,
+        subtype='ANGLE'
+    )
+    animations_scale_tolerance = FloatProperty(
+        name='Scale Tolerance',
+        description='Maximum difference a reduced scale channel may have on any axis',
+        min=0.0,
+        default=0.0001,
+        precision=5
+    )
+    animations_bake_memory_limit = IntProperty(
+        name='Bake Memory Limit',
+        description='Megabytes of intermediate samples held while baking, long actions are '
+                    'baked in chunks of frames to stay under this',
+        min=1,
+        default=256
+    )
     images_data_storage = EnumProperty(
         items=IMAGE_STORAGE_ITEMS,
         name='Storage',
         default='COPY'
     )
+    images_ktx2_mip_filter = EnumProperty(
+        items=MIP_FILTER_ITEMS,
+        name='Mipmap Filter',
+        default='BOX'
+    )
+    images_cache_dir = StringProperty(
+        name='Cache Directory',
+        description='Directory to keep encoded images in between exports (disabled when empty)',
+        default='',
+        subtype='DIR_PATH'
+    )
+    images_cache_max_size = IntProperty(
+        name='Cache Size (MB)',
+        description='Least recently used images are removed from the cache beyond this size',
+        default=512,
+        min=1
+    )
+    images_link_copies = BoolProperty(
+        name='Link Copied Images',
+        description=(
+            'Hard link images into the output directory instead of copying them when possible. '
+            'Edits to either file will show up in both'
+        ),
+        default=False
+    )
     images_allow_srgb = BoolProperty(
         name='sRGB Texture Support',
         description='Use sRGB texture formats for sRGB textures',
         default=False
     )
+    images_atlas_textures = BoolProperty(
+        name='Texture Atlas',
+        description='Pack small non-repeating textures into shared atlas images',
+        default=False
+    )
+    images_atlas_page_size = IntProperty(
+        name='Atlas Size',
+        description='Maximum width and height of an atlas image',
+        default=2048,
+        min=64,
+        max=16384
+    )
+    images_atlas_max_image_size = IntProperty(
+        name='Max Image Size',
+        description='Images larger than this in either dimension are not packed into an atlas',
+        default=256,
+        min=1,
+        max=16384
+    )
+    images_atlas_padding = IntProperty(
+        name='Padding',
+        description='Gutter in pixels added around each image in an atlas',
+        default=4,
+        min=0,
+        max=64
+    )
     buffers_embed_data = BoolProperty(
         name='Embed Buffer Data',
         description='Embed buffer data into the glTF file',
@@ -203,6 +394,11 @@ class ExportGLTF(bpy.types.Operator, ExportHelper, GLTFOrientationHelper):
         description='Combine all buffers into a single buffer',
         default=True
     )
+    buffers_deduplicate_accessors = BoolProperty(
+        name='Deduplicate Accessors',
+        description='Merge accessors that hold identical data into a single accessor',
+        default=True
+    )
     asset_version = EnumProperty(
         items=VERSION_ITEMS,
         name='Version',
@@ -324,11 +520,23 @@ class ExportGLTF(bpy.types.Operator, ExportHelper, GLTFOrientationHelper):
         col.label('Nodes:', icon='OBJECT_DATA')
         col.prop(self, 'nodes_export_hidden')
         col.prop(self, 'nodes_selected_only')
+        col.prop(self, 'nodes_flatten_hierarchy')
+        col.prop(self, 'nodes_bounding_volumes')
+        if Version(self.asset_version) >= Version('2.0'):
+            col.prop(self, 'nodes_gpu_instancing')
 
         col = layout.box().column()
         col.label('Meshes:', icon='MESH_DATA')
         col.prop(self, 'meshes_apply_modifiers')
         col.prop(self, 'meshes_interleave_vertex_data')
+        col.prop(self, 'meshes_weight_threshold')
+        if Version(self.asset_version) >= Version('2.0'):
+            col.prop(self, 'meshes_weight_type')
+        col.prop(self, 'meshes_max_joints')
+        col.prop(self, 'meshes_merge_static')
+        if self.meshes_merge_static:
+            col.prop(self, 'meshes_merge_max_vertices')
+        col.prop(self, 'meshes_match_transformed')
 
         col = layout.box().column()
         col.label('Materials:', icon='MATERIAL_DATA')
@@ -341,16 +549,42 @@ class ExportGLTF(bpy.types.Operator, ExportHelper, GLTFOrientationHelper):
         col.label('Animations:', icon='ACTION')
         col.prop(self, 'animations_armature_export')
         col.prop(self, 'animations_object_export')
+        col.prop(self, 'animations_split_markers')
+        if Version(self.asset_version) >= Version('2.0'):
+            col.prop(self, 'animations_native_keyframes')
+        col.prop(self, 'animations_reduce_keyframes')
+        if self.animations_reduce_keyframes or self.animations_native_keyframes:
+            col.prop(self, 'animations_translation_tolerance')
+            col.prop(self, 'animations_rotation_tolerance')
+            col.prop(self, 'animations_scale_tolerance')
+        if Version(self.asset_version) >= Version('2.0'):
+            col.prop(self, 'animations_quantize_rotations')
+            if self.animations_quantize_rotations:
+                col.prop(self, 'animations_quantization_error')
+        col.prop(self, 'animations_bake_memory_limit')
 
         col = layout.box().column()
         col.label('Images:', icon='IMAGE_DATA')
         col.prop(self, 'images_data_storage')
+        if self.images_data_storage == 'KTX2':
+            col.prop(self, 'images_ktx2_mip_filter')
+        if self.images_data_storage in ('COPY', 'KTX2'):
+            col.prop(self, 'images_link_copies')
         if Version(self.asset_version) < Version('2.0'):
             col.prop(self, 'images_allow_srgb')
+        col.prop(self, 'images_cache_dir')
+        if self.images_cache_dir:
+            col.prop(self, 'images_cache_max_size')
+        col.prop(self, 'images_atlas_textures')
+        if self.images_atlas_textures:
+            col.prop(self, 'images_atlas_page_size')
+            col.prop(self, 'images_atlas_max_image_size')
+            col.prop(self, 'images_atlas_padding')
 
         col = layout.box().column()
         col.label('Buffers:', icon='SORTALPHA')
         col.prop(self, 'buffers_embed_data')
+        col.prop(self, 'buffers_deduplicate_accessors')
 
         col = col.column()
         col.enabled = not self.gltf_export_binary or not self.buffers_embed_data
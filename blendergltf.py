@@ -1,17 +1,27 @@
 import base64
 import collections
 from distutils.version import StrictVersion as Version
+import filecmp
 import functools
+import hashlib
 import itertools
 import json
 import math
 import os
+import re
+import shutil
 import struct
 import zlib
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import bpy
 import idprop
 import mathutils
+import numpy as np
 
 
 __all__ = ['export_gltf']
@@ -23,19 +33,46 @@ DEFAULT_SETTINGS = {
     'gltf_export_binary': False,
     'buffers_embed_data': True,
     'buffers_combine_data': False,
+    'buffers_deduplicate_accessors': True,
     'nodes_export_hidden': False,
     'nodes_global_matrix': mathutils.Matrix.Identity(4),
     'nodes_selected_only': False,
+    'nodes_gpu_instancing': False,
+    'nodes_flatten_hierarchy': False,
+    'nodes_bounding_volumes': False,
     'blocks_prune_unused': True,
     'meshes_apply_modifiers': True,
     'meshes_interleave_vertex_data': True,
+    'meshes_weight_threshold': 0.001,
+    'meshes_weight_type': 'FLOAT',
+    'meshes_max_joints': 0,
+    'meshes_merge_static': False,
+    'meshes_merge_max_vertices': 65535,
+    'meshes_match_transformed': False,
     'images_data_storage': 'COPY',
     'asset_version': '2.0',
     'asset_profile': 'WEB',
     'images_allow_srgb': False,
+    'images_ktx2_mip_filter': 'BOX',
+    'images_cache_dir': '',
+    'images_cache_max_size': 512,
+    'images_link_copies': False,
+    'images_atlas_textures': False,
+    'images_atlas_page_size': 2048,
+    'images_atlas_max_image_size': 256,
+    'images_atlas_padding': 4,
     'extension_exporters': [],
     'animations_object_export': 'ACTIVE',
     'animations_armature_export': 'ELIGIBLE',
+    'animations_native_keyframes': False,
+    'animations_split_markers': 'NONE',
+    'animations_reduce_keyframes': False,
+    'animations_quantize_rotations': False,
+    'animations_quantization_error': 0.0005,
+    'animations_translation_tolerance': 0.0001,
+    'animations_rotation_tolerance': 0.001,
+    'animations_scale_tolerance': 0.0001,
+    'animations_bake_memory_limit': 256,
 }
 
 
@@ -109,23 +146,15 @@ class Vertex:
         self.colors = tuple(layer.data[loop_idx].color[:] for layer in mesh.vertex_colors)
         self.loop_indices = [loop_idx]
 
-        # Take the four most influential groups
+        # Influences are pruned and limited once the mesh's joint palette is known
         groups = sorted(
             mesh.vertices[vert_idx].groups,
             key=lambda group: group.weight,
             reverse=True
         )
-        if len(groups) > 4:
-            groups = groups[:4]
-
         self.weights = [group.weight for group in groups]
         self.joint_indexes = [group.group for group in groups]
 
-        if len(self.weights) < 4:
-            for _ in range(len(self.weights), 4):
-                self.weights.append(0.0)
-                self.joint_indexes.append(0)
-
         self.index = 0
 
     def __hash__(self):
@@ -152,6 +181,123 @@ class SimpleID:
         self.data = data
 
 
+class SceneOverrides:
+    # Context manager that temporarily overrides properties of Blender data. Every override
+    # is applied before a single scene evaluation, and the original values are restored
+    # exactly once on exit, even if an exception is raised.
+    def __init__(self, scene):
+        self.scene = scene
+        self._saved = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        changed = bool(self._saved)
+        for owner, attr, value in reversed(list(self._saved.values())):
+            setattr(owner, attr, value)
+        if changed:
+            self.evaluate()
+        self._saved.clear()
+        return False
+
+    def set(self, owner, attr, value):
+        key = (owner.as_pointer(), attr)
+        if key not in self._saved:
+            self._saved[key] = (owner, attr, getattr(owner, attr))
+        setattr(owner, attr, value)
+
+    def original(self, owner, attr):
+        saved = self._saved.get((owner.as_pointer(), attr))
+        return saved[2] if saved else getattr(owner, attr)
+
+    def evaluate(self):
+        # Tag every object whose data was overridden, then update the scene once
+        changed = {owner.id_data.as_pointer() for owner, _, _ in self._saved.values()}
+        for obj in bpy.data.objects:
+            ids = [obj, obj.data, getattr(obj.data, 'shape_keys', None)]
+            if any(data is not None and data.as_pointer() in changed for data in ids):
+                obj.update_tag()
+        self.scene.frame_set(self.scene.frame_current)
+
+
+class AtlasPage:
+    __slots__ = (
+        "name",
+        "size",
+        "pixels",
+        "srgb",
+        "type",
+        )
+
+    def __init__(self, name, width, height, srgb):
+        self.name = name
+        self.size = (width, height)
+        self.pixels = np.zeros((height, width, 4), dtype=np.uint8)
+        self.pixels[..., 3] = 255
+        self.srgb = srgb
+        self.type = 'IMAGE'
+
+
+# Bump when image encoding changes so entries written by older exporters are not reused
+IMAGE_CACHE_VERSION = 1
+
+
+class ImageCache:
+    __slots__ = (
+        "directory",
+        "max_size",
+        "hits",
+        "misses",
+        )
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps([IMAGE_CACHE_VERSION] + key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + '.bin')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fin:
+                data = fin.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        # Touch the entry so eviction sees it as recently used
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        with open(path + '.tmp', 'wb') as fout:
+            fout.write(data)
+        os.replace(path + '.tmp', path)
+
+    def evict(self):
+        entries = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith('.bin')
+        ]
+        total_size = sum(entry[1] for entry in entries)
+
+        # Remove the least recently used entries first
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
+
+
 class Buffer:
     ARRAY_BUFFER = 34962
     ELEMENT_ARRAY_BUFFER = 34963
@@ -183,6 +329,7 @@ class Buffer:
             "min",
             "max",
             "data_type",
+            "normalized",
             "type_size",
             "_ctype",
             "_ctype_size",
@@ -197,7 +344,8 @@ class Buffer:
                      byte_stride,
                      component_type,
                      count,
-                     data_type):
+                     data_type,
+                     normalized=False):
             self.name = name
             self.buffer = buffer
             self.buffer_view = buffer_view
@@ -208,6 +356,7 @@ class Buffer:
             self.min = [math.inf for i in range(16)]
             self.max = [0 for i in range(16)]
             self.data_type = data_type
+            self.normalized = normalized
 
             if self.data_type == Buffer.MAT4:
                 self.type_size = 16
@@ -271,6 +420,35 @@ class Buffer:
 
             struct.pack_into(self._ctype, self._buffer_data, ptr, value)
 
+        def set_array(self, values):
+            values = np.asarray(values).reshape(self.count, self.type_size)
+            view = np.ndarray(
+                (self.count, self.type_size),
+                dtype=np.dtype(self._ctype),
+                buffer=self._buffer_data,
+                offset=self.byte_offset,
+                strides=(self.byte_stride, self._ctype_size)
+            )
+            view[...] = values
+
+            if self.count:
+                convert = float if self.component_type == Buffer.FLOAT else int
+                mins = values.min(axis=0)
+                maxs = values.max(axis=0)
+                for i in range(self.type_size):
+                    self.min[i] = min(self.min[i], convert(mins[i]))
+                    self.max[i] = max(self.max[i], convert(maxs[i]))
+
+        def to_bytes(self):
+            view = np.ndarray(
+                (self.count, self.type_size),
+                dtype=np.dtype(self._ctype),
+                buffer=self._buffer_data,
+                offset=self.byte_offset,
+                strides=(self.byte_stride, self._ctype_size)
+            )
+            return view.tobytes()
+
     __slots__ = (
         "name",
         "bytelength",
@@ -359,7 +537,8 @@ class Buffer:
                      byte_stride,
                      component_type,
                      count,
-                     data_type):
+                     data_type,
+                     normalized=False):
         accessor_name = 'accessor_{}_{}'.format(self.name, len(self.accessors))
         self.accessors[accessor_name] = self.Accessor(
             accessor_name,
@@ -369,7 +548,8 @@ class Buffer:
             byte_stride,
             component_type,
             count,
-            data_type
+            data_type,
+            normalized
         )
         return self.accessors[accessor_name]
 
@@ -394,6 +574,9 @@ class Buffer:
             if state['version'] < Version('2.0'):
                 gltf['byteStride'] = value.byte_stride
 
+            if value.normalized:
+                gltf['normalized'] = True
+
             gltf['bufferView'] = Reference('bufferViews', value.buffer_view, gltf, 'bufferView')
             state['references'].append(gltf['bufferView'])
 
@@ -432,6 +615,113 @@ def decompose(matrix):
     return loc, rot, scale
 
 
+def _quat_multiply(quat_a, quat_b):
+    # Hamilton product of quaternion arrays in (x, y, z, w) order
+    ax, ay, az, aw = np.moveaxis(quat_a, -1, 0)
+    bx, by, bz, bw = np.moveaxis(quat_b, -1, 0)
+    return np.stack((
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+        aw * bw - ax * bx - ay * by - az * bz,
+    ), axis=-1)
+
+
+def _euler_to_quat(angles, order):
+    quat = np.zeros(angles.shape[:-1] + (4,))
+    quat[..., 3] = 1.0
+    for axis in order:
+        idx = 'XYZ'.index(axis)
+        axis_quat = np.zeros_like(quat)
+        axis_quat[..., idx] = np.sin(angles[..., idx] * 0.5)
+        axis_quat[..., 3] = np.cos(angles[..., idx] * 0.5)
+        quat = _quat_multiply(axis_quat, quat)
+    return quat
+
+
+def _axis_angle_to_quat(values):
+    # Blender stores axis angle rotations as (angle, x, y, z)
+    angle = values[..., 0]
+    axis = values[..., 1:]
+    length = np.linalg.norm(axis, axis=-1)
+    valid = length > 1e-10
+    axis = axis / np.where(valid, length, 1.0)[..., None]
+
+    quat = np.zeros(values.shape[:-1] + (4,))
+    quat[..., :3] = axis * np.sin(angle * 0.5)[..., None]
+    quat[..., 3] = np.cos(angle * 0.5)
+    quat[~valid] = (0.0, 0.0, 0.0, 1.0)
+    return quat
+
+
+def _normalize_quats(quats):
+    length = np.linalg.norm(quats, axis=-1, keepdims=True)
+    return np.where(length > 1e-10, quats / np.where(length > 1e-10, length, 1.0), (0, 0, 0, 1))
+
+
+def _quat_to_matrix(quats):
+    x, y, z, w = np.moveaxis(_normalize_quats(quats), -1, 0)
+    return np.stack((
+        np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)), axis=-1),
+        np.stack((2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)), axis=-1),
+        np.stack((2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)), axis=-1),
+    ), axis=-2)
+
+
+def _matrix_to_quat(rotations):
+    # Vectorized Shepperd method, picking the numerically safest branch per matrix
+    m00, m11, m22 = rotations[..., 0, 0], rotations[..., 1, 1], rotations[..., 2, 2]
+    candidates = np.stack((
+        np.stack((
+            rotations[..., 2, 1] - rotations[..., 1, 2],
+            rotations[..., 0, 2] - rotations[..., 2, 0],
+            rotations[..., 1, 0] - rotations[..., 0, 1],
+            1 + m00 + m11 + m22,
+        ), axis=-1),
+        np.stack((
+            1 + m00 - m11 - m22,
+            rotations[..., 0, 1] + rotations[..., 1, 0],
+            rotations[..., 0, 2] + rotations[..., 2, 0],
+            rotations[..., 2, 1] - rotations[..., 1, 2],
+        ), axis=-1),
+        np.stack((
+            rotations[..., 0, 1] + rotations[..., 1, 0],
+            1 - m00 + m11 - m22,
+            rotations[..., 1, 2] + rotations[..., 2, 1],
+            rotations[..., 0, 2] - rotations[..., 2, 0],
+        ), axis=-1),
+        np.stack((
+            rotations[..., 0, 2] + rotations[..., 2, 0],
+            rotations[..., 1, 2] + rotations[..., 2, 1],
+            1 - m00 - m11 + m22,
+            rotations[..., 1, 0] - rotations[..., 0, 1],
+        ), axis=-1),
+    ), axis=-2)
+    choice = np.argmax(np.stack((m00 + m11 + m22, m00, m11, m22), axis=-1), axis=-1)
+    quats = np.take_along_axis(candidates, choice[..., None, None], axis=-2)[..., 0, :]
+    quats = _normalize_quats(quats)
+
+    # Match mathutils by keeping w positive
+    return np.where(quats[..., 3:] < 0.0, -quats, quats)
+
+
+def compose_matrices(loc, rot, scale):
+    matrices = np.zeros(np.shape(loc)[:-1] + (4, 4))
+    matrices[..., :3, :3] = _quat_to_matrix(rot) * np.asarray(scale)[..., None, :]
+    matrices[..., :3, 3] = loc
+    matrices[..., 3, 3] = 1.0
+    return matrices
+
+
+def decompose_matrices(matrices):
+    loc = matrices[..., :3, 3]
+    basis = matrices[..., :3, :3]
+    scale = np.linalg.norm(basis, axis=-2)
+    scale = np.where(np.linalg.det(basis)[..., None] < 0.0, -scale, scale)
+    rot = _matrix_to_quat(basis / np.where(scale == 0.0, 1.0, scale)[..., None, :])
+    return loc, rot, scale
+
+
 _IGNORED_CUSTOM_PROPS = [
     '_RNA_UI',
     'cycles',
@@ -480,6 +770,56 @@ def export_camera(_, camera):
     return camera_gltf
 
 
+def _apply_atlas_transform(state, material, texture_name, texture_info):
+    transform = state['atlas']['texture_transforms'].get((material.name, texture_name))
+    if transform is None:
+        return
+
+    offset, scale = transform
+    texture_info['extensions'] = {
+        'KHR_texture_transform': {
+            'offset': list(offset),
+            'scale': list(scale),
+        },
+    }
+    # Atlased textures sample the wrong region without the transform
+    if 'KHR_texture_transform' not in state['extensions_used']:
+        state['extensions_used'].append('KHR_texture_transform')
+    if 'KHR_texture_transform' not in state['extensions_required']:
+        state['extensions_required'].append('KHR_texture_transform')
+
+
+def get_alpha_images(state):
+    # Images used as base color textures by materials whose alpha mode depends on them
+    if state['version'] < Version('2.0'):
+        return set()
+
+    images = set()
+    for material in state['input']['materials']:
+        pbr_settings = getattr(material, 'pbr_export_settings', None)
+        if pbr_settings is None or pbr_settings.base_color_factor[3] < 1.0:
+            continue
+        texture = bpy.data.textures.get(pbr_settings.base_color_texture)
+        image = getattr(texture, 'image', None)
+        if image is not None:
+            images.add(image.name)
+    return images
+
+
+def _get_material_alpha_mode(state, pbr_settings, has_base_color_texture):
+    if pbr_settings.base_color_factor[3] < 1.0:
+        return 'BLEND'
+
+    if not has_base_color_texture:
+        return 'OPAQUE'
+
+    texture = bpy.data.textures.get(pbr_settings.base_color_texture)
+    image = getattr(texture, 'image', None)
+    if image is None:
+        return 'OPAQUE'
+    return state['image_alpha'].get(image.name, 'OPAQUE')
+
+
 def export_material(state, material):
     gltf = {
         'name': material.name,
@@ -497,6 +837,7 @@ def export_material(state, material):
         }
 
         input_textures = [texture.name for texture in state['input']['textures']]
+        input_textures += [name for key, name in state['aliases'] if key == 'textures']
         base_color_text = pbr_settings.base_color_texture
         if base_color_text and base_color_text in input_textures:
             pbr['baseColorTexture'] = {
@@ -509,6 +850,7 @@ def export_material(state, material):
                 'index'
             )
             state['references'].append(pbr['baseColorTexture']['index'])
+            _apply_atlas_transform(state, material, base_color_text, pbr['baseColorTexture'])
 
         metal_rough_text = pbr_settings.metal_roughness_texture
         if metal_rough_text and metal_rough_text in input_textures:
@@ -522,9 +864,18 @@ def export_material(state, material):
                 'index'
             )
             state['references'].append(pbr['metallicRoughnessTexture']['index'])
+            _apply_atlas_transform(
+                state, material, metal_rough_text, pbr['metallicRoughnessTexture']
+            )
 
         gltf['pbrMetallicRoughness'] = pbr
 
+        alpha_mode = _get_material_alpha_mode(state, pbr_settings, 'baseColorTexture' in pbr)
+        if alpha_mode != 'OPAQUE':
+            gltf['alphaMode'] = alpha_mode
+        if alpha_mode == 'MASK':
+            gltf['alphaCutoff'] = 0.5
+
         gltf['emissiveFactor'] = pbr_settings.emissive_factor[:]
 
         emissive_text = pbr_settings.emissive_texture
@@ -539,6 +890,7 @@ def export_material(state, material):
                 'index'
             )
             state['references'].append(gltf['emissiveTexture']['index'])
+            _apply_atlas_transform(state, material, emissive_text, gltf['emissiveTexture'])
 
         normal_text = pbr_settings.normal_texture
         if normal_text and normal_text in input_textures:
@@ -552,6 +904,7 @@ def export_material(state, material):
                 'index'
             )
             state['references'].append(gltf['normalTexture']['index'])
+            _apply_atlas_transform(state, material, normal_text, gltf['normalTexture'])
 
         occlusion_text = pbr_settings.occlusion_texture
         if occlusion_text and occlusion_text in input_textures:
@@ -565,18 +918,256 @@ def export_material(state, material):
                 'index'
             )
             state['references'].append(gltf['occlusionTexture']['index'])
+            _apply_atlas_transform(state, material, occlusion_text, gltf['occlusionTexture'])
 
     return gltf
 
 
-def export_attributes(state, mesh, vert_list, base_vert_list):
-    is_skinned = mesh.name in state['skinned_meshes']
+# Morph target offsets computed from shape key data, stored per loop
+ShapeKeyDeltas = collections.namedtuple('ShapeKeyDeltas', ['name', 'positions', 'normals'])
+
+
+def compute_loop_normals(positions, loop_vertices, loop_start, loop_total, use_smooth):
+    # Returns a normal for each loop, using angle weighted vertex normals for smooth polygons
+    # and face normals for flat ones. Auto smooth and custom split normals are not considered.
+    polygons = np.repeat(np.arange(len(loop_start)), loop_total)
+    loop_end = np.cumsum(loop_total)
+    loops = np.arange(len(polygons)) + np.repeat(loop_start - (loop_end - loop_total), loop_total)
+    next_loops = loops + 1
+    next_loops[loop_end - 1] = loop_start
+    prev_loops = loops - 1
+    prev_loops[loop_end - loop_total] = loop_start + loop_total - 1
+
+    corners = positions[loop_vertices[loops]]
+    next_corners = positions[loop_vertices[next_loops]]
+    prev_corners = positions[loop_vertices[prev_loops]]
+
+    # Newell's method handles non-planar polygons
+    face_normals = np.zeros((len(loop_start), 3))
+    np.add.at(face_normals, polygons, np.cross(corners, next_corners))
+    face_normals /= np.maximum(np.linalg.norm(face_normals, axis=1, keepdims=True), 1e-12)
+
+    edges_in = prev_corners - corners
+    edges_out = next_corners - corners
+    edges_in /= np.maximum(np.linalg.norm(edges_in, axis=1, keepdims=True), 1e-12)
+    edges_out /= np.maximum(np.linalg.norm(edges_out, axis=1, keepdims=True), 1e-12)
+    angles = np.arccos(np.clip(np.sum(edges_in * edges_out, axis=1), -1.0, 1.0))
+
+    vertex_normals = np.zeros((len(positions), 3))
+    np.add.at(vertex_normals, loop_vertices[loops], face_normals[polygons] * angles[:, None])
+    vertex_normals /= np.maximum(np.linalg.norm(vertex_normals, axis=1, keepdims=True), 1e-12)
+
+    normals = np.zeros((len(loop_vertices), 3))
+    normals[loops] = np.where(
+        use_smooth[polygons, None],
+        vertex_normals[loop_vertices[loops]],
+        face_normals[polygons]
+    )
+    return normals
+
+
+def _get_array(collection, attr, dtype, width=1):
+    values = np.zeros(len(collection) * width, dtype=dtype)
+    collection.foreach_get(attr, values)
+    return values.reshape(-1, width) if width > 1 else values
+
+
+def get_shape_key_deltas(mesh, keys):
+    # Returns ShapeKeyDeltas for each key at its slider maximum without evaluating the mesh
+    loop_vertices = _get_array(mesh.loops, 'vertex_index', np.int64)
+    loop_start = _get_array(mesh.polygons, 'loop_start', np.int64)
+    loop_total = _get_array(mesh.polygons, 'loop_total', np.int64)
+    use_smooth = _get_array(mesh.polygons, 'use_smooth', np.bool_)
+
+    key_positions = {}
+
+    def get_positions(key):
+        if key.name not in key_positions:
+            key_positions[key.name] = _get_array(key.data, 'co', np.float64, 3)
+        return key_positions[key.name]
+
+    basis = get_positions(mesh.shape_keys.reference_key)
+    base_normals = compute_loop_normals(basis, loop_vertices, loop_start, loop_total, use_smooth)
+
+    deltas = []
+    for key in keys:
+        offsets = (get_positions(key) - get_positions(key.relative_key)) * key.slider_max
+        normals = compute_loop_normals(
+            basis + offsets, loop_vertices, loop_start, loop_total, use_smooth
+        )
+        deltas.append(ShapeKeyDeltas(
+            '{}_{}'.format(mesh.name, key.name),
+            offsets[loop_vertices],
+            normals - base_normals
+        ))
+
+    return deltas
+
+
+# Component type and VEC4 size of each weight storage option
+WEIGHT_TYPES = {
+    'FLOAT': (Buffer.FLOAT, 16),
+    'UNSIGNED_BYTE': (Buffer.UNSIGNED_BYTE, 4),
+    'UNSIGNED_SHORT': (Buffer.UNSIGNED_SHORT, 8),
+}
+
+
+def compact_skin_influences(vert_list, group_joints, threshold, max_influences=4):
+    # Returns (palette, joints, weights) where palette lists the armature bone indices used by
+    # the vertices in order, and joints index into the palette. group_joints maps vertex group
+    # indices to bone indices. Influences below threshold of a vertex's total weight are
+    # dropped and the strongest max_influences are renormalized.
+    joints = np.zeros((len(vert_list), max_influences), dtype=np.int64)
+    weights = np.zeros((len(vert_list), max_influences))
+    for i, vtx in enumerate(vert_list):
+        influences = [
+            (weight, group_joints[group])
+            for weight, group in zip(vtx.weights, vtx.joint_indexes)
+            if group in group_joints and weight > 0.0
+        ]
+        total = sum(weight for weight, _ in influences)
+        influences = [
+            influence for influence in influences if influence[0] >= threshold * total
+        ][:max_influences]
+        for j, (weight, joint) in enumerate(influences):
+            weights[i, j] = weight
+            joints[i, j] = joint
+
+    totals = weights.sum(axis=1, keepdims=True)
+    np.divide(weights, totals, out=weights, where=totals > 0.0)
+
+    used = weights > 0.0
+    palette = np.unique(joints[used])
+    if not len(palette):
+        # A skin needs at least one joint even if nothing is weighted
+        palette = np.zeros(1, dtype=np.int64)
+    remap = np.zeros(palette[-1] + 1, dtype=np.int64)
+    remap[palette] = np.arange(len(palette))
+    joints = np.where(used, remap[np.minimum(joints, palette[-1])], 0)
+
+    return palette, joints, weights
+
+
+def quantize_weights(weights, component_type):
+    # Rounds normalized weights to integers while keeping every vertex's sum exact, any
+    # rounding error goes to the strongest influence
+    scale = 255 if component_type == Buffer.UNSIGNED_BYTE else 65535
+    quantized = np.round(weights * scale).astype(np.int64)
+    weighted = quantized.sum(axis=1) > 0
+    strongest = np.argmax(weights, axis=1)
+    rows = np.nonzero(weighted)[0]
+    quantized[rows, strongest[rows]] += scale - quantized[rows].sum(axis=1)
+    return quantized
+
+
+def get_skin_influences(state, mesh, vert_list):
+    # Returns (joint names, joints, weights) for a skinned mesh's vertices
+    obj = state['skinned_meshes'][mesh.name]
+    bones = obj.find_armature().data.bones
+    group_joints = {
+        i: bones.find(group.name)
+        for i, group in enumerate(obj.vertex_groups) if group.name in bones
+    }
+    palette, joints, weights = compact_skin_influences(
+        vert_list,
+        group_joints,
+        state['settings']['meshes_weight_threshold']
+    )
+    return [bones[i].name for i in palette], joints, weights
+
+
+# A triangle can reference up to 3 vertices with 4 influences each
+MIN_PARTITION_JOINTS = 12
+
+
+def partition_triangles(triangles, joints, weights, max_joints):
+    # Splits triangles into partitions that each reference at most max_joints joints.
+    # Returns a list of (sorted joints, triangle indices). Triangles go to the partition that
+    # gains the fewest new joints, favouring the most recent one so neighbouring triangles
+    # stay together and few vertices are duplicated across partitions.
+    partitions = []
+    for i, triangle in enumerate(triangles):
+        triangle_joints = set(joints[triangle][weights[triangle] > 0.0].tolist())
+        if len(triangle_joints) > max_joints:
+            raise ValueError('Triangle {} uses {} joints, more than the limit of {}'.format(
+                i, len(triangle_joints), max_joints
+            ))
+        best = None
+        for partition in reversed(partitions):
+            added = len(triangle_joints - partition[0])
+            if len(partition[0]) + added > max_joints:
+                continue
+            if best is None or added < best[0]:
+                best = (added, partition)
+                if not added:
+                    break
+        if best is None:
+            partitions.append((set(), []))
+            best = (0, partitions[-1])
+        best[1][0].update(triangle_joints)
+        best[1][1].append(i)
+
+    return [
+        (sorted(partition_joints), np.array(indices, dtype=np.int64))
+        for partition_joints, indices in partitions
+    ]
+
+
+def partition_skinned_mesh(name, prims, joint_names, joints, weights, max_joints):
+    # Returns parts in the form export_mesh expects, each with its vertices, prims and
+    # influences remapped to the part's own joint palette. The first part keeps the mesh name.
+    materials = list(prims)
+    triangles = np.array([
+        index for material in materials for index in prims[material]
+    ], dtype=np.int64).reshape(-1, 3)
+    triangle_materials = np.repeat(
+        np.arange(len(materials)),
+        [len(prims[material]) // 3 for material in materials]
+    )
+
+    parts = []
+    partitions = partition_triangles(triangles, joints, weights, max_joints)
+    for i, (part_joints, triangle_indices) in enumerate(partitions):
+        part_triangles = triangles[triangle_indices]
+        vertex_indices = np.unique(part_triangles)
+        vertex_remap = np.zeros(len(joints), dtype=np.int64)
+        vertex_remap[vertex_indices] = np.arange(len(vertex_indices))
+        joint_remap = np.zeros(len(joint_names), dtype=np.int64)
+        joint_remap[part_joints] = np.arange(len(part_joints))
+
+        part_weights = weights[vertex_indices]
+        part_joint_indices = np.where(
+            part_weights > 0.0,
+            joint_remap[joints[vertex_indices]],
+            0
+        )
+        part_materials = triangle_materials[triangle_indices]
+        part_prims = collections.OrderedDict(
+            (material, vertex_remap[part_triangles[part_materials == j]].ravel().tolist())
+            for j, material in enumerate(materials)
+        )
+        parts.append((
+            name if i == 0 else '{}_part{}'.format(name, i),
+            vertex_indices.tolist(),
+            part_prims,
+            (part_joint_indices, part_weights),
+            [joint_names[j] for j in part_joints]
+        ))
+
+    return parts
+
+
+def export_attributes(state, mesh, vert_list, deltas=None, skin=None, name=None):
+    # deltas holds the (position, normal) offsets of a morph target for each vertex, skin holds
+    # the (joints, weights) of each vertex, and name overrides the buffer names
+    if name is None:
+        name = mesh.name
 
     num_uv_layers = len(mesh.uv_layers)
     num_col_layers = len(mesh.vertex_colors)
     vertex_size = (3 + 3 + num_uv_layers * 2 + num_col_layers * 3) * 4
 
-    buf = Buffer(mesh.name)
+    buf = Buffer(name)
 
     num_verts = len(vert_list)
 
@@ -584,7 +1175,7 @@ def export_attributes(state, mesh, vert_list, base_vert_list):
         view = buf.add_view(vertex_size * num_verts, vertex_size, Buffer.ARRAY_BUFFER)
         vdata = buf.add_accessor(view, 0, vertex_size, Buffer.FLOAT, num_verts, Buffer.VEC3)
         ndata = buf.add_accessor(view, 12, vertex_size, Buffer.FLOAT, num_verts, Buffer.VEC3)
-        if not base_vert_list:
+        if deltas is None:
             tdata = [
                 buf.add_accessor(
                     view,
@@ -608,22 +1199,22 @@ def export_attributes(state, mesh, vert_list, base_vert_list):
                 for i in range(num_col_layers)
             ]
     else:
-        prop_buffer = Buffer(mesh.name + '_POSITION')
+        prop_buffer = Buffer(name + '_POSITION')
         state['buffers'].append(prop_buffer)
         state['input']['buffers'].append(SimpleID(prop_buffer.name))
         prop_view = prop_buffer.add_view(12 * num_verts, 12, Buffer.ARRAY_BUFFER)
         vdata = prop_buffer.add_accessor(prop_view, 0, 12, Buffer.FLOAT, num_verts, Buffer.VEC3)
 
-        prop_buffer = Buffer(mesh.name + '_NORMAL')
+        prop_buffer = Buffer(name + '_NORMAL')
         state['buffers'].append(prop_buffer)
         state['input']['buffers'].append(SimpleID(prop_buffer.name))
         prop_view = prop_buffer.add_view(12 * num_verts, 12, Buffer.ARRAY_BUFFER)
         ndata = prop_buffer.add_accessor(prop_view, 0, 12, Buffer.FLOAT, num_verts, Buffer.VEC3)
 
-        if not base_vert_list:
+        if deltas is None:
             tdata = []
             for uv_layer in range(num_uv_layers):
-                prop_buffer = Buffer('{}_TEXCOORD_{}'.format(mesh.name, uv_layer))
+                prop_buffer = Buffer('{}_TEXCOORD_{}'.format(name, uv_layer))
                 state['buffers'].append(prop_buffer)
                 state['input']['buffers'].append(SimpleID(prop_buffer.name))
                 prop_view = prop_buffer.add_view(8 * num_verts, 8, Buffer.ARRAY_BUFFER)
@@ -632,7 +1223,7 @@ def export_attributes(state, mesh, vert_list, base_vert_list):
                 )
             cdata = []
             for col_layer in range(num_col_layers):
-                prop_buffer = Buffer('{}_COLOR_{}'.format(mesh.name, col_layer))
+                prop_buffer = Buffer('{}_COLOR_{}'.format(name, col_layer))
                 state['buffers'].append(prop_buffer)
                 state['input']['buffers'].append(SimpleID(prop_buffer.name))
                 prop_view = prop_buffer.add_view(12 * num_verts, 12, Buffer.ARRAY_BUFFER)
@@ -641,16 +1232,14 @@ def export_attributes(state, mesh, vert_list, base_vert_list):
                 )
 
     # Copy vertex data
-    if base_vert_list:
-        vert_iter = [(i, v[0], v[1]) for i, v in enumerate(zip(vert_list, base_vert_list))]
-        for i, vtx, base_vtx in vert_iter:
-            co = [a - b for a, b in zip(vtx.co, base_vtx.co)]
-            normal = [a - b for a, b in zip(vtx.normal, base_vtx.normal)]
-            for j in range(3):
-                vdata[(i * 3) + j] = co[j]
-                ndata[(i * 3) + j] = normal[j]
+    if deltas is not None:
+        vdata.set_array(deltas[0])
+        ndata.set_array(deltas[1])
 
     else:
+        uv_transforms = [
+            state['atlas']['uv_transforms'].get((mesh.name, i)) for i in range(num_uv_layers)
+        ]
         for i, vtx in enumerate(vert_list):
             vtx.index = i
             co = vtx.co
@@ -661,11 +1250,21 @@ def export_attributes(state, mesh, vert_list, base_vert_list):
                 ndata[(i * 3) + j] = normal[j]
 
             for j, uv in enumerate(vtx.uvs):
-                tdata[j][i * 2] = uv[0]
+                u_coord = uv[0]
                 if state['settings']['asset_profile'] == 'WEB':
-                    tdata[j][i * 2 + 1] = 1.0 - uv[1]
+                    v_coord = 1.0 - uv[1]
                 else:
-                    tdata[j][i * 2 + 1] = uv[1]
+                    v_coord = uv[1]
+
+                # Remap into the atlas rectangle, clamping since atlased
+                # textures do not repeat
+                if uv_transforms[j]:
+                    offset, scale = uv_transforms[j]
+                    u_coord = offset[0] + scale[0] * min(max(u_coord, 0.0), 1.0)
+                    v_coord = offset[1] + scale[1] * min(max(v_coord, 0.0), 1.0)
+
+                tdata[j][i * 2] = u_coord
+                tdata[j][i * 2 + 1] = v_coord
 
             for j, col in enumerate(vtx.colors):
                 cdata[j][i * 3] = col[0]
@@ -680,7 +1279,7 @@ def export_attributes(state, mesh, vert_list, base_vert_list):
     gltf_attrs['NORMAL'] = Reference('accessors', ndata.name, gltf_attrs, 'NORMAL')
     state['references'].append(gltf_attrs['NORMAL'])
 
-    if not base_vert_list:
+    if deltas is None:
         for i, accessor in enumerate(tdata):
             attr_name = 'TEXCOORD_' + str(i)
             gltf_attrs[attr_name] = Reference('accessors', accessor.name, gltf_attrs, attr_name)
@@ -693,10 +1292,24 @@ def export_attributes(state, mesh, vert_list, base_vert_list):
     state['buffers'].append(buf)
     state['input']['buffers'].append(SimpleID(buf.name))
 
-    if is_skinned:
-        skin_buf = Buffer('{}_skin'.format(mesh.name))
+    if skin is not None:
+        joints, weights = skin
+
+        # Palettes with more than 256 joints no longer fit in bytes
+        joint_type, joint_size = Buffer.UNSIGNED_BYTE, 4
+        if len(joints) and joints.max() > 255:
+            joint_type, joint_size = Buffer.UNSIGNED_SHORT, 8
+
+        # Normalized integer weights are only supported by glTF 2.0
+        weight_type, weight_size = Buffer.FLOAT, 16
+        if state['version'] >= Version('2.0'):
+            weight_type, weight_size = WEIGHT_TYPES[state['settings']['meshes_weight_type']]
+        if weight_type != Buffer.FLOAT:
+            weights = quantize_weights(weights, weight_type)
+
+        skin_vertex_size = joint_size + weight_size
 
-        skin_vertex_size = (4 + 4) * 4
+        skin_buf = Buffer('{}_skin'.format(name))
         skin_view = skin_buf.add_view(
             skin_vertex_size * num_verts,
             skin_vertex_size,
@@ -706,26 +1319,21 @@ def export_attributes(state, mesh, vert_list, base_vert_list):
             skin_view,
             0,
             skin_vertex_size,
-            Buffer.UNSIGNED_BYTE,
+            joint_type,
             num_verts,
             Buffer.VEC4
         )
         wdata = skin_buf.add_accessor(
             skin_view,
-            16,
+            joint_size,
             skin_vertex_size,
-            Buffer.FLOAT,
+            weight_type,
             num_verts,
-            Buffer.VEC4
+            Buffer.VEC4,
+            normalized=weight_type != Buffer.FLOAT
         )
-
-        for i, vtx in enumerate(vert_list):
-            joints = vtx.joint_indexes
-            weights = vtx.weights
-
-            for j in range(4):
-                jdata[(i * 4) + j] = joints[j]
-                wdata[(i * 4) + j] = weights[j]
+        jdata.set_array(joints)
+        wdata.set_array(weights)
 
         if state['version'] < Version('2.0'):
             joint_key = 'JOINT'
@@ -761,40 +1369,20 @@ def check_mesh(mesh):
     return True
 
 
-def export_mesh(state, mesh):
-    # glTF data
-    gltf_mesh = {
-        'name': mesh.name,
-        'primitives': [],
-    }
-
-    extras = _get_custom_properties(mesh)
-    if extras:
-        gltf_mesh['extras'] = extras
-
+def get_mesh_geometry(state, mesh, deduplicate=True):
+    # Returns (vertices, prims) where prims maps material names to triangle vertex indices
     mesh.calc_normals_split()
     mesh.calc_tessface()
 
-    shape_keys = state['shape_keys'].get(mesh.name, [])
-
     # Remove duplicate verts with dictionary hashing (causes problems with shape keys)
-    if shape_keys:
+    if not deduplicate:
         vert_list = [Vertex(mesh, loop) for loop in mesh.loops]
     else:
         vert_list = {Vertex(mesh, loop): 0 for loop in mesh.loops}.keys()
 
-    # Process mesh data and gather attributes
-    buf, gltf_attrs = export_attributes(state, mesh, vert_list, None)
-
-    # Process shape keys
-    targets = []
-    for shape_key_mesh in [key[1] for key in shape_keys]:
-        shape_key_mesh.calc_normals_split()
-        shape_key_mesh.calc_tessface()
-        shape_verts = [Vertex(shape_key_mesh, loop) for loop in shape_key_mesh]
-        targets.append(export_attributes(state, shape_key_mesh, shape_verts, vert_list)[1])
-    if shape_keys:
-        gltf_mesh['weights'] = [key[0] for key in shape_keys]
+    vert_list = list(vert_list)
+    for i, vtx in enumerate(vert_list):
+        vtx.index = i
 
     # For each material, make an empty primitive set.
     # This dictionary maps material names to list of indices that form the
@@ -808,7 +1396,6 @@ def export_mesh(state, mesh):
     # Map loop indices to vertices
     vert_dict = {i: vertex for vertex in vert_list for i in vertex.loop_indices}
 
-    max_vert_index = 0
     for poly in mesh.polygons:
         # Find the primitive that this polygon ought to belong to (by
         # material).
@@ -825,9 +1412,6 @@ def export_mesh(state, mesh):
         # Find the (vertex) index associated with each loop in the polygon.
         indices = [vert_dict[i].index for i in poly.loop_indices]
 
-        # Used to determine whether a mesh must be split.
-        max_vert_index = max(max_vert_index, max(indices))
-
         if len(indices) == 3:
             # No triangulation necessary
             prim += indices
@@ -841,73 +1425,160 @@ def export_mesh(state, mesh):
                 "Invalid polygon with {} vertices.".format(len(indices))
             )
 
-    if max_vert_index > 65535:
-        # Use the integer index extension
-        if OES_ELEMENT_INDEX_UINT not in state['gl_extensions_used']:
-            state['gl_extensions_used'].append(OES_ELEMENT_INDEX_UINT)
+    return vert_list, prims
 
-    for mat, prim in prims.items():
-        # For each primitive set add an index buffer and accessor.
 
-        if not prim:
-            # This material has not verts, do not make a 0 length buffer
+def export_mesh(state, mesh):
+    # glTF data
+    gltf_mesh = {
+        'name': mesh.name,
+        'primitives': [],
+    }
+
+    extras = _get_custom_properties(mesh)
+    if extras:
+        gltf_mesh['extras'] = extras
+
+    shape_keys = state['shape_keys'].get(mesh.name, [])
+
+    vert_list, prims = get_mesh_geometry(state, mesh, deduplicate=not shape_keys)
+
+    # Shape key vertices line up with the base vertices since neither is deduplicated
+    shape_deltas = []
+    for _, source in shape_keys:
+        if isinstance(source, ShapeKeyDeltas):
+            shape_deltas.append((source.name, source.positions, source.normals))
             continue
+        source.calc_normals_split()
+        source.calc_tessface()
+        shape_verts = [Vertex(source, loop) for loop in source.loops]
+        shape_deltas.append((
+            source.name,
+            np.array([vtx.co for vtx in shape_verts]) - np.array([vtx.co for vtx in vert_list]),
+            np.array([vtx.normal for vtx in shape_verts]) -
+            np.array([vtx.normal for vtx in vert_list])
+        ))
+
+    joint_names = skin = None
+    if mesh.name in state['skinned_meshes']:
+        joint_names, joints, weights = get_skin_influences(state, mesh, vert_list)
+        skin = (joints, weights)
+
+    # Each part is (name, vertex indices or None for all, prims, skin, joint names)
+    parts = [(mesh.name, None, prims, skin, joint_names)]
+    max_joints = state['settings']['meshes_max_joints']
+    if skin is not None and 0 < max_joints < MIN_PARTITION_JOINTS:
+        print(
+            'Warning: meshes_max_joints must be 0 or at least {}, not partitioning {}'
+            .format(MIN_PARTITION_JOINTS, mesh.name)
+        )
+    elif skin is not None and max_joints and len(joint_names) > max_joints:
+        parts = partition_skinned_mesh(
+            mesh.name, prims, joint_names, joints, weights, max_joints
+        ) or parts
+        if len(parts) > 1:
+            print('Split skinned mesh {} into {} partitions of at most {} joints'.format(
+                mesh.name, len(parts), max_joints
+            ))
+
+    for part_index, (name, vertex_indices, part_prims, part_skin, part_joints) in enumerate(parts):
+        part_verts = vert_list
+        if vertex_indices is not None:
+            part_verts = [vert_list[i] for i in vertex_indices]
+
+        # Process mesh data and gather attributes
+        buf, gltf_attrs = export_attributes(state, mesh, part_verts, None, part_skin, name)
+
+        # Process shape keys
+        targets = []
+        for shape_name, positions, normals in shape_deltas:
+            if vertex_indices is not None:
+                positions = positions[vertex_indices]
+                normals = normals[vertex_indices]
+            if part_index:
+                shape_name = '{}_part{}'.format(shape_name, part_index)
+            targets.append(export_attributes(
+                state, mesh, part_verts, (positions, normals), name=shape_name
+            )[1])
+
+        if part_skin is not None:
+            state['skin_palettes'][name] = part_joints
+
+        part_mesh = gltf_mesh
+        if part_index:
+            part_mesh = {
+                'name': name,
+                'primitives': [],
+            }
+            state['partition_meshes'][name] = part_mesh
+            state['skin_partitions'].setdefault(mesh.name, []).append(name)
+        if shape_keys:
+            part_mesh['weights'] = [key[0] for key in shape_keys]
 
-        # If we got this far use integers if we have to, if this is not
-        # desirable we would have bailed out by now.
+        # Used to determine whether a mesh must be split.
+        max_vert_index = max([max(prim) for prim in part_prims.values() if prim] or [0])
         if max_vert_index > 65535:
-            itype = Buffer.UNSIGNED_INT
-            istride = 4
-        else:
-            itype = Buffer.UNSIGNED_SHORT
-            istride = 2
+            # Use the integer index extension
+            if OES_ELEMENT_INDEX_UINT not in state['gl_extensions_used']:
+                state['gl_extensions_used'].append(OES_ELEMENT_INDEX_UINT)
 
-        index_view = buf.add_view(istride * len(prim), 0, Buffer.ELEMENT_ARRAY_BUFFER)
-        idata = buf.add_accessor(index_view, 0, istride, itype, len(prim),
-                                 Buffer.SCALAR)
+        for mat, prim in part_prims.items():
+            # For each primitive set add an index buffer and accessor.
 
-        for i, index in enumerate(prim):
-            idata[i] = index
+            if not prim:
+                # This material has not verts, do not make a 0 length buffer
+                continue
 
-        gltf_prim = {
-            'attributes': gltf_attrs,
-            'mode': 4,
-        }
+            # If we got this far use integers if we have to, if this is not
+            # desirable we would have bailed out by now.
+            if max_vert_index > 65535:
+                itype = Buffer.UNSIGNED_INT
+                istride = 4
+            else:
+                itype = Buffer.UNSIGNED_SHORT
+                istride = 2
 
-        gltf_prim['indices'] = Reference('accessors', idata.name, gltf_prim, 'indices')
-        state['references'].append(gltf_prim['indices'])
+            index_view = buf.add_view(istride * len(prim), 0, Buffer.ELEMENT_ARRAY_BUFFER)
+            idata = buf.add_accessor(index_view, 0, istride, itype, len(prim),
+                                     Buffer.SCALAR)
 
-        if targets:
-            gltf_prim['targets'] = targets
+            for i, index in enumerate(prim):
+                idata[i] = index
 
-        # Add the material reference after checking that it is valid
-        if mat:
-            gltf_prim['material'] = Reference('materials', mat, gltf_prim, 'material')
-            state['references'].append(gltf_prim['material'])
+            gltf_prim = {
+                'attributes': gltf_attrs,
+                'mode': 4,
+            }
 
-        gltf_mesh['primitives'].append(gltf_prim)
+            gltf_prim['indices'] = Reference('accessors', idata.name, gltf_prim, 'indices')
+            state['references'].append(gltf_prim['indices'])
+
+            if targets:
+                gltf_prim['targets'] = targets
+
+            # Add the material reference after checking that it is valid
+            if mat:
+                gltf_prim['material'] = Reference('materials', mat, gltf_prim, 'material')
+                state['references'].append(gltf_prim['material'])
+
+            part_mesh['primitives'].append(gltf_prim)
 
     return gltf_mesh
 
 
 def export_skins(state):
-    def export_skin(obj):
+    def export_skin(name, arm, joint_names, bind_shape_mat):
         if state['version'] < Version('2.0'):
             joints_key = 'jointNames'
         else:
             joints_key = 'joints'
 
-        arm = obj.find_armature()
-
-        bind_shape_mat = obj.matrix_world * arm.matrix_world.inverted()
-        bone_groups = [group for group in obj.vertex_groups if group.name in arm.data.bones]
-
         gltf_skin = {
-            'name': obj.name,
+            'name': name,
         }
         gltf_skin[joints_key] = [
-            Reference('objects', _get_bone_name(arm.data.bones[group.name]), None, None)
-            for group in bone_groups
+            Reference('objects', _get_bone_name(arm.data.bones[name]), None, None)
+            for name in joint_names
         ]
         for i, ref in enumerate(gltf_skin[joints_key]):
             ref.source = gltf_skin[joints_key]
@@ -925,16 +1596,20 @@ def export_skins(state):
             state['references'].append(gltf_skin['skeleton'])
 
         element_size = 16 * 4
-        num_elements = len(bone_groups)
-        buf = Buffer('IBM_{}_skin'.format(obj.name))
+        num_elements = len(joint_names)
+        buf = Buffer('IBM_{}_skin'.format(name))
         buf_view = buf.add_view(element_size * num_elements, element_size, None)
         idata = buf.add_accessor(buf_view, 0, element_size, Buffer.FLOAT, num_elements, Buffer.MAT4)
 
-        for i, group in enumerate(bone_groups):
-            bone = arm.data.bones[group.name]
-            mat = togl(bone.matrix_local.inverted() * bind_shape_mat)
-            for j in range(16):
-                idata[(i * 16) + j] = mat[j]
+        bones = arm.data.bones
+        bind_matrices = get_matrices(bones, 'matrix_local')[
+            [bones.find(name) for name in joint_names]
+        ]
+        inverse_bind_matrices = np.matmul(
+            invert_matrices(bind_matrices),
+            np.array(bind_shape_mat, dtype=np.float64)
+        )
+        idata.set_array(inverse_bind_matrices.transpose(0, 2, 1).reshape(-1, 16))
 
         gltf_skin['inverseBindMatrices'] = Reference(
             'accessors',
@@ -946,11 +1621,76 @@ def export_skins(state):
         state['buffers'].append(buf)
         state['input']['buffers'].append(SimpleID(buf.name))
 
-        state['input']['skins'].append(SimpleID(obj.name))
+        state['input']['skins'].append(SimpleID(name))
 
         return gltf_skin
 
-    return [export_skin(obj) for obj in state['skinned_meshes'].values()]
+    # Meshes bound to the same armature with the same joints and bind shape share a skin
+    skins = []
+    shared = {}
+    for mesh_name, obj in state['skinned_meshes'].items():
+        arm = obj.find_armature()
+        bind_shape_mat = obj.matrix_world * arm.matrix_world.inverted()
+
+        # Skin partitions after the first get their own skins
+        mesh_names = [mesh_name] + state['skin_partitions'].get(mesh_name, [])
+        for i, part_name in enumerate(mesh_names):
+            skin_name = obj.name if i == 0 else '{}_part{}'.format(obj.name, i)
+            joint_names = state['skin_palettes'].get(part_name)
+            if joint_names is None:
+                joint_names = [
+                    group.name for group in obj.vertex_groups if group.name in arm.data.bones
+                ]
+
+            key = (
+                arm.name,
+                tuple(joint_names),
+                tuple(np.round(np.array(bind_shape_mat, dtype=np.float64), 6).flat)
+            )
+            if key in shared:
+                state['aliases'][('skins', skin_name)] = ('skins', shared[key])
+                continue
+            shared[key] = skin_name
+            skins.append(export_skin(skin_name, arm, joint_names, bind_shape_mat))
+
+    return skins
+
+
+def export_skin_partition_nodes(state):
+    # Skin partitions after the first are drawn by children of the skinned object's node.
+    # Like dupli-group nodes they have no Blender object, so they are added alongside those.
+    for mesh_name, obj in state['skinned_meshes'].items():
+        partitions = state['skin_partitions'].get(mesh_name, [])
+        if not partitions:
+            continue
+
+        node = state['output']['nodes'][state['input']['objects'].index(obj)]
+        children = node.setdefault('children', [])
+        for i, part_name in enumerate(partitions, 1):
+            name = '{}_part{}'.format(obj.name, i)
+            part_node = {
+                'name': name,
+            }
+            if state['version'] < Version('2.0'):
+                part_node['meshes'] = []
+                part_node['meshes'].append(Reference('meshes', part_name, part_node['meshes'], 0))
+                state['references'].append(part_node['meshes'][0])
+                part_node['skeletons'] = []
+                part_node['skeletons'].extend([
+                    Reference('objects', ref.blender_name, part_node['skeletons'], j)
+                    for j, ref in enumerate(node.get('skeletons', []))
+                ])
+                state['references'].extend(part_node['skeletons'])
+            else:
+                part_node['mesh'] = Reference('meshes', part_name, part_node, 'mesh')
+                state['references'].append(part_node['mesh'])
+            part_node['skin'] = Reference('skins', name, part_node, 'skin')
+            state['references'].append(part_node['skin'])
+
+            children.append(Reference('objects', name, children, len(children)))
+            state['references'].append(children[-1])
+            state['dupli_nodes'].append(part_node)
+            state['input']['dupli_ids'].append(SimpleID(name))
 
 
 def export_dupli_group(state, dupli_group):
@@ -989,101 +1729,712 @@ def export_dupli_group(state, dupli_group):
     return group_ref
 
 
-def export_node(state, obj):
-    node = {
-        'name': obj.name,
-    }
+def _get_node_parent(state, obj):
+    # Closest ancestor that still gets a node after flattening
+    parent = obj.parent
+    while parent is not None and parent.name in state['flattened_nodes']:
+        parent = parent.parent
+    return parent
 
-    obj_children = [child for child in obj.children if child in state['input']['objects']]
-    if obj_children:
-        node['children'] = []
-    for i, child in enumerate(obj_children):
-        node['children'].append(Reference('objects', child.name, node['children'], i))
-        state['references'].append(node['children'][-1])
 
-    node['translation'], node['rotation'], node['scale'] = decompose(obj.matrix_local)
+def _get_node_children(state, obj):
+    # Exported children, with the children of flattened empties pulled up to this node
+    children = []
+    for child in obj.children:
+        if child.name in state['flattened_nodes']:
+            children.extend(_get_node_children(state, child))
+        elif child in state['input']['objects']:
+            children.append(child)
+    return children
+
+
+def _get_node_matrix(state, obj):
+    # Transform relative to the parent node, folding in the transforms of flattened empties
+    matrix = obj.matrix_local
+    parent = obj.parent
+    while parent is not None and parent.name in state['flattened_nodes']:
+        matrix = parent.matrix_local * matrix
+        parent = parent.parent
+    return matrix
+
+
+def _is_animated(obj):
+    animation_data = obj.animation_data
+    return animation_data is not None and (
+        animation_data.action is not None or bool(animation_data.nla_tracks)
+    )
 
-    extras = _get_custom_properties(obj)
-    extras.update({
-        prop.name: prop.value for prop in obj.game.properties.values()
-    })
-    if extras:
-        node['extras'] = extras
 
-    if obj.type == 'MESH':
-        mesh = state['mod_meshes'].get(obj.name, obj.data)
-        if state['version'] < Version('2.0'):
-            node['meshes'] = []
-            node['meshes'].append(Reference('meshes', mesh.name, node['meshes'], 0))
-            state['references'].append(node['meshes'][0])
-        else:
-            node['mesh'] = Reference('meshes', mesh.name, node, 'mesh')
-            state['references'].append(node['mesh'])
-        armature = obj.find_armature()
-        if armature:
-            state['skinned_meshes'][mesh.name] = obj
-            node['skin'] = Reference('skins', obj.name, node, 'skin')
-            state['references'].append(node['skin'])
-            if state['version'] < Version('2.0'):
-                bone_names = [_get_bone_name(b) for b in armature.data.bones if b.parent is None]
-                node['skeletons'] = []
-                node['skeletons'].extend([
-                    Reference('objects', bone, node['skeletons'], i)
-                    for i, bone in enumerate(bone_names)
-                ])
-                for ref in node['skeletons']:
-                    state['references'].append(ref)
-    elif obj.type == 'CAMERA':
-        node['camera'] = Reference('cameras', obj.data.name, node, 'camera')
-        state['references'].append(node['camera'])
-    elif obj.type == 'EMPTY' and obj.dupli_group is not None:
-        node['children'] = node.get('children', [])
-        node['children'].append(export_dupli_group(state, obj.dupli_group))
-        node['children'][-1].source = node['children']
-        node['children'][-1].prop = len(node['children']) - 1
-    elif obj.type == 'ARMATURE':
-        for i, bone in enumerate(obj.data.bones):
-            state['input']['bones'].append(SimpleID(_get_bone_name(bone), bone))
-        if 'children' not in node:
-            node['children'] = []
-        offset = len(node['children'])
-        root_bones = [
-            Reference('objects', _get_bone_name(b), node['children'], i + offset)
-            for i, b in enumerate(obj.data.bones) if b.parent is None
-        ]
-        for bone in root_bones:
-            state['references'].append(bone)
-        node['children'].extend(root_bones)
+def flatten_hierarchy(state):
+    # Removes organizational empties that only add a transform to the hierarchy. Unanimated
+    # empties without extras are dropped when they have no exported children, or folded into
+    # their only child when that child is static (or the empty's transform is the identity).
+    # Empties targeted by constraints, such as a camera tracking an empty, are kept.
+    targets = {
+        constraint.target.name
+        for obj in state['input']['objects']
+        for constraint in obj.constraints
+        if getattr(constraint, 'target', None) is not None
+    }
 
-    return node
+    def get_depth(obj):
+        depth = 0
+        while obj.parent is not None:
+            depth += 1
+            obj = obj.parent
+        return depth
+
+    candidates = [
+        obj for obj in state['input']['objects']
+        if obj.type == 'EMPTY' and
+        obj.dupli_group is None and
+        obj.name not in targets and
+        not _is_animated(obj) and
+        not obj.constraints and
+        not getattr(obj, 'rigid_body', None) and
+        not _get_custom_properties(obj) and
+        not obj.game.properties
+    ]
 
+    # Children are visited before their parents so chains of empties collapse in one pass
+    flattened = state['flattened_nodes']
+    for obj in sorted(candidates, key=get_depth, reverse=True):
+        children = _get_node_children(state, obj)
+        if len(children) > 1:
+            continue
+        if children and _is_animated(children[0]) and not np.allclose(
+                np.array(obj.matrix_local, dtype=np.float64), np.identity(4)
+        ):
+            continue
+        flattened.add(obj.name)
 
-def export_joint(state, bone):
-    matrix = bone.matrix_local
-    if bone.parent:
-        matrix = bone.parent.matrix_local.inverted() * matrix
+    state['input']['objects'] = [
+        obj for obj in state['input']['objects'] if obj.name not in flattened
+    ]
+    if flattened:
+        print('Flattened {} empties out of the node hierarchy'.format(len(flattened)))
 
-    gltf_joint = {
-        'name': _get_bone_name(bone),
-    }
-    if state['version'] < Version('2.0'):
-        gltf_joint['jointName'] = Reference(
-            'objects',
-            _get_bone_name(bone),
-            gltf_joint,
-            'jointName'
-        )
-        state['references'].append(gltf_joint['jointName'])
-    if bone.children:
-        gltf_joint['children'] = [
-            Reference('objects', _get_bone_name(child), None, None) for child in bone.children
-        ]
-    for i, ref in enumerate(gltf_joint.get('children', [])):
-        ref.source = gltf_joint['children']
-        ref.prop = i
-        state['references'].append(ref)
 
-    gltf_joint['translation'], gltf_joint['rotation'], gltf_joint['scale'] = decompose(matrix)
+GPU_INSTANCING_MIN_INSTANCES = 2
+
+
+def _get_scene_names(obj):
+    return tuple(sorted(scene.name for scene in obj.users_scene))
+
+
+def _is_static_object(state, obj):
+    # Top level objects whose world transform and visibility can be baked at export time
+    return (
+        _get_node_parent(state, obj) is None and
+        not _is_animated(obj) and
+        not obj.constraints and
+        not getattr(obj, 'rigid_body', None) and
+        all(obj.is_visible(scene) for scene in obj.users_scene)
+    )
+
+
+def _is_static_mesh_object(state, obj):
+    # Only static, visible, top level meshes with nothing else attached can be instanced or
+    # merged
+    return (
+        obj.type == 'MESH' and
+        _is_static_object(state, obj) and
+        not _get_node_children(state, obj) and
+        obj.find_armature() is None and
+        not _get_custom_properties(obj) and
+        not obj.game.properties
+    )
+
+
+def build_gpu_instances(state):
+    # Collects world matrices of meshes that can be drawn with EXT_mesh_gpu_instancing, keyed
+    # by (mesh name, scene names). Objects that share a mesh are removed from the exported
+    # objects, and dupli-groups made only of meshes stop being expanded into nodes.
+    if state['version'] < Version('2.0'):
+        print('Warning: EXT_mesh_gpu_instancing requires glTF 2.0, no instances will be used')
+        return
+
+    mesh_names = {mesh.name for mesh in state['input']['meshes']}
+
+    def get_mesh_name(obj):
+        return state['mod_meshes'].get(obj.name, obj.data).name
+
+    candidates = collections.OrderedDict()
+    for obj in state['input']['objects']:
+        if _is_static_mesh_object(state, obj) and get_mesh_name(obj) in mesh_names:
+            key = (get_mesh_name(obj), _get_scene_names(obj))
+            candidates.setdefault(key, []).append(obj)
+
+    instances = collections.OrderedDict()
+    instanced = set()
+    for key, objects in candidates.items():
+        if len(objects) < GPU_INSTANCING_MIN_INSTANCES:
+            continue
+        instances.setdefault(key, []).append(
+            np.array([np.array(obj.matrix_world) for obj in objects], dtype=np.float64)
+        )
+        instanced.update(obj.name for obj in objects)
+    state['input']['objects'] = [
+        obj for obj in state['input']['objects'] if obj.name not in instanced
+    ]
+
+    # Every empty instancing a group places each member at
+    # empty.matrix_world * offset * member.matrix_world
+    dupli_empties = collections.OrderedDict()
+    for obj in state['input']['objects']:
+        group = obj.dupli_group if obj.type == 'EMPTY' else None
+        if group is None or not group.objects or not _is_static_object(state, obj):
+            continue
+        members = list(group.objects)
+        if all(
+                member.type == 'MESH' and member.find_armature() is None and
+                get_mesh_name(member) in mesh_names
+                for member in members
+        ):
+            dupli_empties.setdefault((group.name, _get_scene_names(obj)), []).append(obj)
+
+    for (group_name, scene_names), empties in dupli_empties.items():
+        group = empties[0].dupli_group
+        offset = np.identity(4)
+        offset[:3, 3] = -np.array(group.dupli_offset, dtype=np.float64)
+        empty_matrices = np.array([np.array(obj.matrix_world) for obj in empties])
+        for member in group.objects:
+            member_matrix = np.matmul(offset, np.array(member.matrix_world, dtype=np.float64))
+            key = (get_mesh_name(member), scene_names)
+            instances.setdefault(key, []).append(np.matmul(empty_matrices, member_matrix))
+        state['gpu_dupli_groups'].update(obj.name for obj in empties)
+
+    state['gpu_instances'] = collections.OrderedDict(
+        (key, np.concatenate(matrices)) for key, matrices in instances.items()
+    )
+    if instanced or dupli_empties:
+        print('Drawing {} objects and {} dupli-group instances with {} instanced meshes'.format(
+            len(instanced),
+            sum(len(empties) for empties in dupli_empties.values()),
+            len(state['gpu_instances'])
+        ))
+
+
+def export_gpu_instances(state):
+    # Adds one node per instanced mesh with per-instance TRS accessors to each of its scenes
+    for i, ((mesh_name, scene_names), matrices) in enumerate(state['gpu_instances'].items()):
+        name = 'instances_{}.{}'.format(mesh_name, i)
+        translation, rotation, scale = decompose_matrices(matrices)
+
+        buf = Buffer(name)
+        attributes = {}
+        channels = (
+            ('TRANSLATION', translation, Buffer.VEC3),
+            ('ROTATION', rotation, Buffer.VEC4),
+            ('SCALE', scale, Buffer.VEC3),
+        )
+        for path, values, data_type in channels:
+            accessor = _add_array_accessor(buf, values, Buffer.FLOAT, data_type)
+            attributes[path] = Reference('accessors', accessor.name, attributes, path)
+            state['references'].append(attributes[path])
+        state['buffers'].append(buf)
+        state['input']['buffers'].append(SimpleID(buf.name))
+
+        node = {
+            'name': name,
+            'extensions': {
+                'EXT_mesh_gpu_instancing': {
+                    'attributes': attributes,
+                },
+            },
+        }
+        node['mesh'] = Reference('meshes', mesh_name, node, 'mesh')
+        state['references'].append(node['mesh'])
+        _add_scene_node(state, node, scene_names)
+
+    # Instanced objects have no fallback nodes, so the extension is required
+    if state['gpu_instances']:
+        for extensions in (state['extensions_used'], state['extensions_required']):
+            if 'EXT_mesh_gpu_instancing' not in extensions:
+                extensions.append('EXT_mesh_gpu_instancing')
+
+
+COMPONENT_SIZES = {
+    Buffer.BYTE: 1,
+    Buffer.UNSIGNED_BYTE: 1,
+    Buffer.SHORT: 2,
+    Buffer.UNSIGNED_SHORT: 2,
+    Buffer.UNSIGNED_INT: 4,
+    Buffer.FLOAT: 4,
+}
+
+
+def _add_array_accessor(buf, values, component_type, data_type, target=None):
+    # Adds a tightly packed view and accessor to buf holding values
+    values = np.asarray(values)
+    count = len(values)
+    stride = COMPONENT_SIZES[component_type] * (values.size // count if count else 1)
+    view_stride = 0 if target == Buffer.ELEMENT_ARRAY_BUFFER else stride
+    view = buf.add_view(stride * count, view_stride, target)
+    accessor = buf.add_accessor(view, 0, stride, component_type, count, data_type)
+    accessor.set_array(values)
+    return accessor
+
+
+def _add_scene_node(state, node, scene_names):
+    # Nodes without a Blender object are added like dupli-group nodes
+    state['dupli_nodes'].append(node)
+    state['input']['dupli_ids'].append(SimpleID(node['name']))
+
+    for scene, gltf_scene in zip(state['input']['scenes'], state['output']['scenes']):
+        if scene.name in scene_names:
+            scene_nodes = gltf_scene['nodes']
+            scene_nodes.append(Reference('objects', node['name'], scene_nodes, len(scene_nodes)))
+            state['references'].append(scene_nodes[-1])
+
+
+def _morton_order(points):
+    # Returns indices that sort points along a Z-order curve, keeping neighbours together
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if not len(points):
+        return np.zeros(0, dtype=np.int64)
+    low = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - low, 1e-9)
+    cells = ((points - low) / extent * 1023).astype(np.int64)
+    codes = np.zeros(len(points), dtype=np.int64)
+    for bit in range(10):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return np.argsort(codes, kind='stable')
+
+
+def _get_used_mesh_names(state):
+    def get_mesh_name(obj):
+        return state['mod_meshes'].get(obj.name, obj.data).name
+
+    used = {key[0] for key in state['gpu_instances']}
+    for obj in state['input']['objects']:
+        if obj.type == 'MESH':
+            used.add(get_mesh_name(obj))
+        elif obj.type == 'EMPTY' and obj.dupli_group is not None:
+            used.update(
+                get_mesh_name(member) for member in obj.dupli_group.objects
+                if member.type == 'MESH'
+            )
+    return used
+
+
+def build_static_batches(state):
+    # Removes static, unmorphed mesh objects from the exported objects and groups them into
+    # batches of at most meshes_merge_max_vertices loops. Objects are ordered along a Z-order
+    # curve first so every batch stays spatially compact and can still be culled.
+    max_vertices = state['settings']['meshes_merge_max_vertices']
+
+    def get_mesh(obj):
+        return state['mod_meshes'].get(obj.name, obj.data)
+
+    groups = collections.OrderedDict()
+    for obj in state['input']['objects']:
+        if _is_static_mesh_object(state, obj) and get_mesh(obj).name not in state['shape_keys']:
+            mesh = get_mesh(obj)
+            key = (len(mesh.uv_layers), len(mesh.vertex_colors), _get_scene_names(obj))
+            groups.setdefault(key, []).append(obj)
+
+    merged = set()
+    for (_, _, scene_names), objects in groups.items():
+        if len(objects) < 2:
+            continue
+        locations = [np.array(obj.matrix_world, dtype=np.float64)[:3, 3] for obj in objects]
+        batch = []
+        batch_size = 0
+        for i in _morton_order(locations):
+            obj = objects[i]
+            size = len(get_mesh(obj).loops)
+            if batch and batch_size + size > max_vertices:
+                state['static_batches'].append((scene_names, batch))
+                batch = []
+                batch_size = 0
+            batch.append(obj)
+            batch_size += size
+        state['static_batches'].append((scene_names, batch))
+        merged.update(obj.name for obj in objects)
+
+    if not merged:
+        return
+
+    merged_meshes = {
+        get_mesh(obj).name for obj in state['input']['objects'] if obj.name in merged
+    }
+    state['input']['objects'] = [
+        obj for obj in state['input']['objects'] if obj.name not in merged
+    ]
+    used = _get_used_mesh_names(state)
+    state['input']['meshes'] = [
+        mesh for mesh in state['input']['meshes']
+        if mesh.name in used or mesh.name not in merged_meshes
+    ]
+    print('Merged {} static objects into {} meshes'.format(
+        len(merged), len(state['static_batches'])
+    ))
+
+
+def _transform_uvs(state, mesh_name, layer, uvs):
+    # Applies the same V flip and atlas remapping export_attributes does
+    uvs = np.array(uvs, dtype=np.float64)
+    if state['settings']['asset_profile'] == 'WEB':
+        uvs[:, 1] = 1.0 - uvs[:, 1]
+    uv_transform = state['atlas']['uv_transforms'].get((mesh_name, layer))
+    if uv_transform:
+        offset, scale = uv_transform
+        uvs = np.array(offset) + np.array(scale) * np.clip(uvs, 0.0, 1.0)
+    return uvs
+
+
+def export_static_batch(state, name, objects, geometry):
+    # Transforms the vertices of every object into world space and concatenates them, with
+    # one primitive per material. geometry caches get_mesh_geometry results by mesh name.
+    positions = []
+    normals = []
+    uvs = []
+    colors = []
+    prims = collections.OrderedDict()
+    offset = 0
+    for obj in objects:
+        mesh = state['mod_meshes'].get(obj.name, obj.data)
+        if mesh.name not in geometry:
+            geometry[mesh.name] = get_mesh_geometry(state, mesh)
+        vert_list, mesh_prims = geometry[mesh.name]
+
+        matrix = np.array(obj.matrix_world, dtype=np.float64)
+        rotation = matrix[:3, :3]
+        normal_matrix = invert_matrices(rotation[None])[0].T
+        co = np.array([vtx.co for vtx in vert_list], dtype=np.float64).reshape(-1, 3)
+        normal = np.array([vtx.normal for vtx in vert_list], dtype=np.float64).reshape(-1, 3)
+        normal = np.matmul(normal, normal_matrix.T)
+        normal /= np.maximum(np.linalg.norm(normal, axis=1, keepdims=True), 1e-12)
+        positions.append(np.matmul(co, rotation.T) + matrix[:3, 3])
+        normals.append(normal)
+        uvs.append([
+            _transform_uvs(state, mesh.name, i, [vtx.uvs[i] for vtx in vert_list])
+            for i in range(len(mesh.uv_layers))
+        ])
+        colors.append([
+            np.array([vtx.colors[i] for vtx in vert_list]).reshape(-1, 3)
+            for i in range(len(mesh.vertex_colors))
+        ])
+
+        # Mirrored objects need their winding flipped to keep facing the same way
+        flip = np.linalg.det(rotation) < 0.0
+        for material, prim in mesh_prims.items():
+            triangles = np.array(prim, dtype=np.int64).reshape(-1, 3) + offset
+            if flip:
+                triangles = triangles[:, ::-1]
+            prims.setdefault(material, []).append(triangles.ravel())
+        offset += len(vert_list)
+
+    buf = Buffer(name)
+    gltf_attrs = {}
+    attributes = [
+        ('POSITION', np.concatenate(positions), Buffer.VEC3),
+        ('NORMAL', np.concatenate(normals), Buffer.VEC3),
+    ]
+    attributes.extend(
+        ('TEXCOORD_{}'.format(i), np.concatenate([layers[i] for layers in uvs]), Buffer.VEC2)
+        for i in range(len(uvs[0]))
+    )
+    attributes.extend(
+        ('COLOR_{}'.format(i), np.concatenate([layers[i] for layers in colors]), Buffer.VEC3)
+        for i in range(len(colors[0]))
+    )
+    for attr_name, values, data_type in attributes:
+        accessor = _add_array_accessor(buf, values, Buffer.FLOAT, data_type, Buffer.ARRAY_BUFFER)
+        gltf_attrs[attr_name] = Reference('accessors', accessor.name, gltf_attrs, attr_name)
+        state['references'].append(gltf_attrs[attr_name])
+
+    itype = Buffer.UNSIGNED_SHORT
+    if offset > 65535:
+        itype = Buffer.UNSIGNED_INT
+        if state['version'] < Version('2.0'):
+            if OES_ELEMENT_INDEX_UINT not in state['gl_extensions_used']:
+                state['gl_extensions_used'].append(OES_ELEMENT_INDEX_UINT)
+
+    gltf_mesh = {
+        'name': name,
+        'primitives': [],
+    }
+    for material, indices in prims.items():
+        indices = np.concatenate(indices)
+        if not len(indices):
+            continue
+        idata = _add_array_accessor(
+            buf, indices, itype, Buffer.SCALAR, Buffer.ELEMENT_ARRAY_BUFFER
+        )
+        gltf_prim = {
+            'attributes': gltf_attrs,
+            'mode': 4,
+        }
+        gltf_prim['indices'] = Reference('accessors', idata.name, gltf_prim, 'indices')
+        state['references'].append(gltf_prim['indices'])
+        if material:
+            gltf_prim['material'] = Reference('materials', material, gltf_prim, 'material')
+            state['references'].append(gltf_prim['material'])
+        gltf_mesh['primitives'].append(gltf_prim)
+
+    state['buffers'].append(buf)
+    state['input']['buffers'].append(SimpleID(buf.name))
+    return gltf_mesh
+
+
+def export_static_batches(state):
+    geometry = {}
+    for i, (scene_names, objects) in enumerate(state['static_batches']):
+        name = 'static_batch.{}'.format(i)
+        state['output']['meshes'].append(export_static_batch(state, name, objects, geometry))
+        state['input']['meshes'].append(SimpleID(name))
+
+        node = {
+            'name': name,
+        }
+        if state['version'] < Version('2.0'):
+            node['meshes'] = []
+            node['meshes'].append(Reference('meshes', name, node['meshes'], 0))
+            state['references'].append(node['meshes'][0])
+        else:
+            node['mesh'] = Reference('meshes', name, node, 'mesh')
+            state['references'].append(node['mesh'])
+        _add_scene_node(state, node, scene_names)
+
+
+MESH_MATCH_TOLERANCE = 1e-5
+
+
+def _get_mesh_topology(mesh):
+    # Digest of everything but vertex positions that two meshes must share to use one mesh
+    digest = hashlib.sha1()
+    for collection, attr, dtype, width in (
+            (mesh.loops, 'vertex_index', np.int64, 1),
+            (mesh.polygons, 'loop_total', np.int64, 1),
+            (mesh.polygons, 'material_index', np.int64, 1),
+            (mesh.polygons, 'use_smooth', np.bool_, 1),
+    ):
+        digest.update(_get_array(collection, attr, dtype, width).tobytes())
+    for layer in mesh.uv_layers:
+        digest.update(_get_array(layer.data, 'uv', np.float32, 2).tobytes())
+    for layer in mesh.vertex_colors:
+        digest.update(_get_array(layer.data, 'color', np.float32, 3).tobytes())
+    digest.update(repr([material.name if material else None for material in mesh.materials])
+                  .encode())
+    return digest.hexdigest()
+
+
+def get_mesh_signature(positions, topology):
+    # Pose invariant key: vertex count, topology, the spread along the principal axes and the
+    # sorted distances of the vertices from the centroid, relative to the mesh radius
+    centered = positions - positions.mean(axis=0)
+    distances = np.linalg.norm(centered, axis=1)
+    radius = distances.max()
+    scale = radius if radius > 0.0 else 1.0
+    spread = np.linalg.eigvalsh(np.matmul(centered.T, centered) / len(positions)) / scale ** 2
+    distance_digest = hashlib.sha1(
+        (np.round(np.sort(distances) / scale, 4) + 0.0).tobytes()
+    ).hexdigest()
+    return (
+        len(positions),
+        topology,
+        float('{:.4g}'.format(radius)),
+        tuple((np.round(spread, 4) + 0.0).tolist()),
+        distance_digest,
+    )
+
+
+def solve_rigid_transform(source, target, tolerance=MESH_MATCH_TOLERANCE):
+    # Returns the 4x4 rotation and translation taking each source point onto the target point
+    # with the same index, or None if there is none within tolerance of the mesh radius
+    source_center = source.mean(axis=0)
+    target_center = target.mean(axis=0)
+    covariance = np.matmul((source - source_center).T, target - target_center)
+    u, _, vt = np.linalg.svd(covariance)
+    correction = np.identity(3)
+    correction[2, 2] = np.sign(np.linalg.det(np.matmul(vt.T, u.T))) or 1.0
+    rotation = np.matmul(vt.T, np.matmul(correction, u.T))
+
+    matrix = np.identity(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = target_center - np.matmul(rotation, source_center)
+
+    residual = np.abs(np.matmul(source, rotation.T) + matrix[:3, 3] - target).max()
+    radius = np.linalg.norm(source - source_center, axis=1).max()
+    if residual > tolerance * max(radius, 1.0):
+        return None
+    return matrix
+
+
+def _can_move_mesh_transform(state, obj):
+    # The node transform of these objects can take on a mesh transform without affecting
+    # animation, children, skinning or physics. Non-uniform scale followed by a rotation
+    # would add shear, which a node's TRS cannot hold. Any animation data can make an
+    # object eligible for baked animation, so only objects without it are moved.
+    basis = np.array(_get_node_matrix(state, obj), dtype=np.float64)[:3, :3]
+    scale = np.linalg.norm(basis, axis=0)
+    return (
+        np.allclose(scale, scale[0], rtol=1e-6) and
+        obj.animation_data is None and
+        not _get_node_children(state, obj) and
+        obj.find_armature() is None and
+        not obj.constraints and
+        not getattr(obj, 'rigid_body', None)
+    )
+
+
+def build_mesh_instances(state):
+    # Finds meshes that are the same geometry as an earlier mesh up to a rotation and
+    # translation, such as copies that had their transforms applied. Matches are replaced by
+    # the earlier mesh, and the transform between them is moved onto the nodes using them.
+    def get_mesh_name(obj):
+        return state['mod_meshes'].get(obj.name, obj.data).name
+
+    users = collections.OrderedDict()
+    excluded = {key[0] for key in state['gpu_instances']}
+    for obj in state['input']['objects']:
+        if obj.type == 'MESH':
+            users.setdefault(get_mesh_name(obj), []).append(obj)
+        elif obj.type == 'EMPTY' and obj.dupli_group is not None:
+            excluded.update(
+                get_mesh_name(member) for member in obj.dupli_group.objects
+                if member.type == 'MESH'
+            )
+
+    candidates = [
+        mesh for mesh in state['input']['meshes']
+        if mesh.name in users and
+        mesh.name not in excluded and
+        mesh.name not in state['shape_keys'] and
+        len(mesh.vertices) and
+        all(_can_move_mesh_transform(state, obj) for obj in users[mesh.name])
+    ]
+
+    groups = {}
+    matched = set()
+    for mesh in candidates:
+        positions = _get_array(mesh.vertices, 'co', np.float64, 3)
+        signature = get_mesh_signature(positions, _get_mesh_topology(mesh))
+        group = groups.setdefault(signature, [])
+        for canonical, canonical_positions in group:
+            matrix = solve_rigid_transform(canonical_positions, positions)
+            if matrix is not None:
+                break
+        else:
+            group.append((mesh, positions))
+            continue
+
+        state['aliases'][('meshes', mesh.name)] = ('meshes', canonical.name)
+        for obj in users[mesh.name]:
+            state['mesh_transforms'][obj.name] = mathutils.Matrix(matrix.tolist())
+        matched.add(mesh.name)
+
+    state['input']['meshes'] = [
+        mesh for mesh in state['input']['meshes'] if mesh.name not in matched
+    ]
+    if matched:
+        print('Replaced {} meshes with transformed copies of matching meshes'.format(
+            len(matched)
+        ))
+
+
+def export_node(state, obj):
+    node = {
+        'name': obj.name,
+    }
+
+    obj_children = _get_node_children(state, obj)
+    if obj_children:
+        node['children'] = []
+    for i, child in enumerate(obj_children):
+        node['children'].append(Reference('objects', child.name, node['children'], i))
+        state['references'].append(node['children'][-1])
+
+    matrix = _get_node_matrix(state, obj)
+    if obj.name in state['mesh_transforms']:
+        matrix = matrix * state['mesh_transforms'][obj.name]
+    node['translation'], node['rotation'], node['scale'] = decompose(matrix)
+
+    extras = _get_custom_properties(obj)
+    extras.update({
+        prop.name: prop.value for prop in obj.game.properties.values()
+    })
+    if extras:
+        node['extras'] = extras
+
+    if obj.type == 'MESH':
+        mesh = state['mod_meshes'].get(obj.name, obj.data)
+        if state['version'] < Version('2.0'):
+            node['meshes'] = []
+            node['meshes'].append(Reference('meshes', mesh.name, node['meshes'], 0))
+            state['references'].append(node['meshes'][0])
+        else:
+            node['mesh'] = Reference('meshes', mesh.name, node, 'mesh')
+            state['references'].append(node['mesh'])
+        armature = obj.find_armature()
+        if armature:
+            state['skinned_meshes'][mesh.name] = obj
+            node['skin'] = Reference('skins', obj.name, node, 'skin')
+            state['references'].append(node['skin'])
+            if state['version'] < Version('2.0'):
+                bone_names = [_get_bone_name(b) for b in armature.data.bones if b.parent is None]
+                node['skeletons'] = []
+                node['skeletons'].extend([
+                    Reference('objects', bone, node['skeletons'], i)
+                    for i, bone in enumerate(bone_names)
+                ])
+                for ref in node['skeletons']:
+                    state['references'].append(ref)
+    elif obj.type == 'CAMERA':
+        node['camera'] = Reference('cameras', obj.data.name, node, 'camera')
+        state['references'].append(node['camera'])
+    elif (obj.type == 'EMPTY' and obj.dupli_group is not None and
+          obj.name not in state['gpu_dupli_groups']):
+        node['children'] = node.get('children', [])
+        node['children'].append(export_dupli_group(state, obj.dupli_group))
+        node['children'][-1].source = node['children']
+        node['children'][-1].prop = len(node['children']) - 1
+    elif obj.type == 'ARMATURE':
+        for i, bone in enumerate(obj.data.bones):
+            state['input']['bones'].append(SimpleID(_get_bone_name(bone), bone))
+        if 'children' not in node:
+            node['children'] = []
+        offset = len(node['children'])
+        root_bones = [
+            Reference('objects', _get_bone_name(b), node['children'], i + offset)
+            for i, b in enumerate(obj.data.bones) if b.parent is None
+        ]
+        for bone in root_bones:
+            state['references'].append(bone)
+        node['children'].extend(root_bones)
+
+    return node
+
+
+def export_joint(state, bone):
+    matrix = bone.matrix_local
+    if bone.parent:
+        matrix = bone.parent.matrix_local.inverted() * matrix
+
+    gltf_joint = {
+        'name': _get_bone_name(bone),
+    }
+    if state['version'] < Version('2.0'):
+        gltf_joint['jointName'] = Reference(
+            'objects',
+            _get_bone_name(bone),
+            gltf_joint,
+            'jointName'
+        )
+        state['references'].append(gltf_joint['jointName'])
+    if bone.children:
+        gltf_joint['children'] = [
+            Reference('objects', _get_bone_name(child), None, None) for child in bone.children
+        ]
+    for i, ref in enumerate(gltf_joint.get('children', [])):
+        ref.source = gltf_joint['children']
+        ref.prop = i
+        state['references'].append(ref)
+
+    gltf_joint['translation'], gltf_joint['rotation'], gltf_joint['scale'] = decompose(matrix)
 
     return gltf_joint
 
@@ -1113,7 +2464,8 @@ def export_scene(state, scene):
     result['nodes'] = [
         Reference('objects', ob.name, None, None)
         for ob in scene.objects
-        if ob in state['input']['objects'] and ob.parent is None and ob.is_visible(scene)
+        if ob in state['input']['objects'] and _get_node_parent(state, ob) is None and
+        ob.is_visible(scene)
     ]
     for i, ref in enumerate(result['nodes']):
         ref.source = result['nodes']
@@ -1136,225 +2488,2095 @@ def export_scene(state, scene):
     return result
 
 
-def export_buffers(state):
-    if state['settings']['buffers_combine_data']:
-        buffers = [functools.reduce(
-            lambda x, y: x.combine(y, state),
-            state['buffers'],
-            Buffer('empty')
-        )]
-        state['buffers'] = buffers
-        state['input']['buffers'] = [SimpleID(buffers[0].name)]
-    else:
-        buffers = state['buffers']
+BVH_LEAF_SIZE = 4
+
+BVH_NODE_DTYPE = np.dtype([
+    ('min', '<f4', 3),
+    ('max', '<f4', 3),
+    ('offset', '<i4'),
+    ('count', '<i4'),
+])
+
+BOUNDS_DTYPE = np.dtype([
+    ('min', '<f4', 3),
+    ('max', '<f4', 3),
+    ('sphere', '<f4', 4),
+])
+
+PRIMITIVE_BOUNDS_DTYPE = np.dtype(BOUNDS_DTYPE.descr + [
+    ('node', '<i4'),
+    ('primitive', '<i4'),
+    ('instance', '<i4'),
+])
+
+
+def get_world_bounds(matrices, low, high):
+    # Transforms local boxes by matrices, returning world space boxes and bounding spheres
+    basis = matrices[..., :3, :3]
+    center = np.matmul(basis, ((low + high) / 2.0)[..., None])[..., 0] + matrices[..., :3, 3]
+    half = np.matmul(np.abs(basis), ((high - low) / 2.0)[..., None])[..., 0]
+    radius = (
+        np.linalg.norm((high - low) / 2.0, axis=-1) *
+        np.linalg.norm(basis, axis=-2).max(axis=-1)
+    )
+    return center - half, center + half, np.concatenate([center, radius[..., None]], axis=-1)
+
+
+def build_bvh(low, high, leaf_size=BVH_LEAF_SIZE):
+    # Builds a BVH over boxes by splitting at the median centroid along the widest axis.
+    # Nodes are stored depth first: an inner node is followed by its left child and stores
+    # the index of its right child as offset with a count of 0, and a leaf stores a range of
+    # the returned item order.
+    centers = (low + high) / 2.0
+    order = np.arange(len(low))
+    nodes = []
+
+    def build(start, end):
+        index = len(nodes)
+        items = order[start:end]
+        nodes.append((low[items].min(axis=0), high[items].max(axis=0), start, end - start))
+        if end - start <= leaf_size:
+            return index
+
+        axis = np.argmax(centers[items].max(axis=0) - centers[items].min(axis=0))
+        mid = (start + end) // 2
+        order[start:end] = items[np.argpartition(centers[items, axis], mid - start)]
+        build(start, mid)
+        right = build(mid, end)
+        nodes[index] = nodes[index][:2] + (right, 0)
+        return index
+
+    if len(low):
+        build(0, len(low))
+    return np.array(nodes, dtype=BVH_NODE_DTYPE), order
+
+
+def _get_local_matrix(node):
+    if 'matrix' in node:
+        return np.array(node['matrix'], dtype=np.float64).reshape(4, 4).T
+    return compose_matrices(
+        np.array(node.get('translation', (0.0, 0.0, 0.0)), dtype=np.float64),
+        np.array(node.get('rotation', (0.0, 0.0, 0.0, 1.0)), dtype=np.float64),
+        np.array(node.get('scale', (1.0, 1.0, 1.0)), dtype=np.float64),
+    )
+
+
+def _read_accessor(accessor):
+    values = np.frombuffer(accessor.to_bytes(), dtype=np.dtype(accessor._ctype))
+    return values.reshape(accessor.count, accessor.type_size).astype(np.float64)
+
+
+def _get_position_bounds(accessors, primitive):
+    # Local box of a primitive, grown by the extremes of its morph targets
+    accessor = accessors.get(primitive['attributes']['POSITION'].blender_name)
+    if accessor is None or not accessor.count:
+        return None
+    low = np.array(accessor.min[:3], dtype=np.float64)
+    high = np.array(accessor.max[:3], dtype=np.float64)
+    for target in primitive.get('targets', []):
+        delta = accessors.get(target['POSITION'].blender_name) if 'POSITION' in target else None
+        if delta is not None and delta.count:
+            low += np.minimum(delta.min[:3], 0.0)
+            high += np.maximum(delta.max[:3], 0.0)
+    return low, high
+
+
+def export_scene_bvh(state, scene_index):
+    # Stores world space bounds (after the global matrix) of every primitive under static
+    # nodes of a scene, their union per node and a BVH over the primitives in a buffer
+    # referenced from scene extras.
+    # Animated and skinned nodes, their descendants and joints are left out.
+    gltf_scene = state['output']['scenes'][scene_index]
+    nodes = {
+        entry.name: (entry, node)
+        for entry, node in zip(state['input']['objects'], state['output']['nodes'])
+    }
+    meshes = {
+        entry.name: mesh
+        for entry, mesh in zip(state['input']['meshes'], state['output']['meshes'])
+    }
+    accessors = {
+        name: accessor for buf in state['buffers'] for name, accessor in buf.accessors.items()
+    }
+
+    def is_dynamic(entry, node):
+        if isinstance(entry, SimpleID):
+            return entry.data is not None
+        return _is_animated(entry) or 'skin' in node
+
+    # Scene roots end up below a node holding the global matrix (the axis conversion)
+    global_matrix = np.array(state['settings']['nodes_global_matrix'], dtype=np.float64)
+    node_names = []
+    items = []
+    local_bounds = []
+    matrices = []
+    stack = [(ref.blender_name, global_matrix) for ref in reversed(gltf_scene['nodes'])]
+    while stack:
+        name, parent_matrix = stack.pop()
+        if name not in nodes:
+            continue
+        entry, node = nodes[name]
+        if is_dynamic(entry, node):
+            continue
+        matrix = np.matmul(parent_matrix, _get_local_matrix(node))
+        stack.extend(
+            (ref.blender_name, matrix) for ref in reversed(node.get('children', []))
+        )
+
+        mesh_refs = node.get('meshes', [node['mesh']] if 'mesh' in node else [])
+        instancing = node.get('extensions', {}).get('EXT_mesh_gpu_instancing')
+        if instancing:
+            attributes = instancing['attributes']
+            instances = np.matmul(matrix, compose_matrices(*[
+                _read_accessor(accessors[attributes[path].blender_name])
+                for path in ('TRANSLATION', 'ROTATION', 'SCALE')
+            ]))
+        else:
+            instances = matrix[None]
+
+        primitive_index = 0
+        for ref in mesh_refs:
+            key = state['aliases'].get(('meshes', ref.blender_name), ('meshes', ref.blender_name))
+            for primitive in meshes.get(key[1], {}).get('primitives', []):
+                bounds = _get_position_bounds(accessors, primitive)
+                if bounds is not None:
+                    for i, instance in enumerate(instances):
+                        items.append((
+                            len(node_names), primitive_index, i if instancing else -1
+                        ))
+                        local_bounds.append(bounds)
+                        matrices.append(instance)
+                primitive_index += 1
+        if items and items[-1][0] == len(node_names):
+            node_names.append(name)
+
+    if not items:
+        return
+
+    items = np.array(items, dtype=np.int64)
+    local_bounds = np.array(local_bounds, dtype=np.float64)
+    low, high, spheres = get_world_bounds(
+        np.array(matrices), local_bounds[:, 0], local_bounds[:, 1]
+    )
+    hierarchy, order = build_bvh(low, high)
+
+    primitive_bounds = np.zeros(len(order), dtype=PRIMITIVE_BOUNDS_DTYPE)
+    primitive_bounds['min'] = low[order]
+    primitive_bounds['max'] = high[order]
+    primitive_bounds['sphere'] = spheres[order]
+    primitive_bounds['node'] = items[order, 0]
+    primitive_bounds['primitive'] = items[order, 1]
+    primitive_bounds['instance'] = items[order, 2]
+
+    node_bounds = np.zeros(len(node_names), dtype=BOUNDS_DTYPE)
+    for i in range(len(node_names)):
+        mask = items[:, 0] == i
+        node_low = low[mask].min(axis=0)
+        node_high = high[mask].max(axis=0)
+        center = (node_low + node_high) / 2.0
+        radius = (
+            np.linalg.norm(spheres[mask, :3] - center, axis=1) + spheres[mask, 3]
+        ).max()
+        node_bounds[i] = (node_low, node_high, tuple(center) + (radius,))
+
+    buf = Buffer('bvh_{}'.format(gltf_scene['name']))
+    bvh = {
+        'nodes': [
+            Reference('objects', name, None, None) for name in node_names
+        ],
+    }
+    for i, ref in enumerate(bvh['nodes']):
+        ref.source = bvh['nodes']
+        ref.prop = i
+    state['references'].extend(bvh['nodes'])
+
+    for key, data in (
+            ('node_bounds', node_bounds),
+            ('primitive_bounds', primitive_bounds),
+            ('hierarchy', hierarchy),
+    ):
+        view_key = buf.add_view(data.nbytes, 0, None)
+        buf.buffer_views[view_key]['data'] = bytearray(data.tobytes())
+        bvh[key] = Reference('bufferViews', view_key, bvh, key)
+        state['references'].append(bvh[key])
+
+    state['buffers'].append(buf)
+    state['input']['buffers'].append(SimpleID(buf.name))
+    gltf_scene.setdefault('extras', {})['bvh'] = bvh
+
+
+def deduplicate_accessors(state):
+    # Redirect accessors with identical contents to the first one and drop unused views
+    referenced_views = {
+        ref.blender_name for ref in state['references'] if ref.blender_type == 'bufferViews'
+    }
+
+    canonical = {}
+    merged = 0
+    reclaimed = 0
+    for buf in state['buffers']:
+        accessor_views = {accessor.buffer_view for accessor in buf.accessors.values()}
+        for name, accessor in list(buf.accessors.items()):
+            if accessor.count == 0:
+                continue
+            key = (
+                buf.buffer_views[accessor.buffer_view]['target'],
+                accessor.component_type,
+                accessor.data_type,
+                accessor.normalized,
+                accessor.count,
+                hashlib.sha1(accessor.to_bytes()).digest(),
+            )
+            if key not in canonical:
+                canonical[key] = name
+                continue
+
+            state['aliases'][('accessors', name)] = ('accessors', canonical[key])
+            del buf.accessors[name]
+            merged += 1
+
+        # Only views emptied by merging are dropped, and only when that keeps the following
+        # views 4-byte aligned. Views without accessors, such as image padding, are kept.
+        used_views = {accessor.buffer_view for accessor in buf.accessors.values()}
+        offset = 0
+        for view_name, view in list(buf.buffer_views.items()):
+            if (view_name in accessor_views and view_name not in used_views and
+                    view_name not in referenced_views and view['bytelength'] % 4 == 0):
+                reclaimed += view['bytelength']
+                del buf.buffer_views[view_name]
+                continue
+            view['byteoffset'] = offset
+            offset += view['bytelength']
+        buf.bytelength = offset
+
+    empty_buffers = {buf.name for buf in state['buffers'] if not buf.buffer_views}
+    state['buffers'] = [buf for buf in state['buffers'] if buf.name not in empty_buffers]
+    state['input']['buffers'] = [
+        sid for sid in state['input']['buffers'] if sid.name not in empty_buffers
+    ]
+
+    if merged:
+        print('Merged {} duplicate accessors, reclaiming {} bytes'.format(merged, reclaimed))
+
+
+def export_buffers(state):
+    if state['settings']['buffers_deduplicate_accessors']:
+        deduplicate_accessors(state)
+
+    if state['settings']['buffers_combine_data']:
+        buffers = [functools.reduce(
+            lambda x, y: x.combine(y, state),
+            state['buffers'],
+            Buffer('empty')
+        )]
+        state['buffers'] = buffers
+        state['input']['buffers'] = [SimpleID(buffers[0].name)]
+    else:
+        buffers = state['buffers']
+
+    gltf = {}
+    gltf['buffers'] = [buf.export_buffer(state) for buf in buffers]
+    gltf['bufferViews'] = list(itertools.chain(*[buf.export_views(state) for buf in buffers]))
+    gltf['accessors'] = list(itertools.chain(*[buf.export_accessors(state) for buf in buffers]))
+
+    return gltf
+
+
+def _get_image_pixels(image):
+    # Returns RGBA bytes with the top row first
+    width, height = image.size[:]
+    channels = image.channels
+    pixels = np.empty(width * height * channels, dtype=np.float32)
+    if hasattr(image.pixels, 'foreach_get'):
+        image.pixels.foreach_get(pixels)
+    else:
+        # Older Blender versions can only copy pixels through a Python sequence
+        pixels[:] = image.pixels[:]
+    pixels = pixels.reshape(height, width, channels)
+    if channels == 3:
+        pixels = np.dstack((pixels, np.ones((height, width), dtype=np.float32)))
+
+    return (np.clip(pixels[::-1], 0.0, 1.0) * 255).astype(np.uint8)
+
+
+PNG_COMPRESSION_LEVEL = 9
+
+# Alpha values this close to 0 or 255 still count as binary coverage
+ALPHA_MASK_TOLERANCE = 8
+
+
+def classify_alpha(pixels):
+    alpha = pixels[..., 3]
+    if alpha.min() == 255:
+        return 'OPAQUE'
+
+    partial = (alpha > ALPHA_MASK_TOLERANCE) & (alpha < 255 - ALPHA_MASK_TOLERANCE)
+    if not partial.any():
+        return 'MASK'
+
+    return 'BLEND'
+
+
+def _get_image_alpha_mode(state, image, get_pixels, cache_key):
+    if image.channels < 4 or not getattr(image, 'use_alpha', True):
+        return 'OPAQUE'
+
+    alpha_key = cache_key and cache_key + ['ALPHA', ALPHA_MASK_TOLERANCE]
+    mode = _cached_encode(state, alpha_key, lambda: classify_alpha(get_pixels()).encode())
+    return mode.decode()
+
+
+def _encode_png(pixels):
+    height, width = pixels.shape[:2]
+
+    # Drop alpha that is fully opaque
+    color_type = 6
+    if classify_alpha(pixels) == 'OPAQUE':
+        pixels = pixels[..., :3]
+        color_type = 2
+    channels = pixels.shape[2]
+
+    # add a null filter byte at the start of each line
+    raw_data = np.insert(pixels.reshape(height, width * channels), 0, 0, axis=1).tobytes()
+
+    def png_pack(png_tag, data):
+        chunk_head = png_tag + data
+        return (struct.pack("!I", len(data)) +
+                chunk_head +
+                struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk_head)))
+
+    png_bytes = b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, color_type, 0, 0, 0)),
+        png_pack(b'IDAT', zlib.compress(raw_data, PNG_COMPRESSION_LEVEL)),
+        png_pack(b'IEND', b'')])
+
+    return png_bytes
+
+
+def _srgb_to_linear(values):
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+def _linear_to_srgb(values):
+    values = np.maximum(values, 0.0)
+    return np.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055)
+
+
+def _resample_taps(src_len, dst_len, mip_filter):
+    # Returns (dst_len, taps) arrays of source indices and weights, the nonzero band
+    # of the matrix mapping source texels to destination texels
+    ratio = src_len / dst_len
+    dst = np.arange(dst_len)
+
+    if mip_filter == 'KAISER':
+        # Kaiser windowed sinc with a radius of three destination texels
+        radius = 3.0 * ratio
+        beta = 4.0
+        reach = int(math.ceil(radius))
+        centers = ((dst + 0.5) * ratio - 0.5)[:, None]
+        src = np.floor(centers).astype(int) + np.arange(-reach, reach + 1)
+        dist = (src - centers) / radius
+        window = np.where(
+            np.abs(dist) < 1.0,
+            np.i0(beta * np.sqrt(np.maximum(1.0 - dist ** 2, 0.0))) / np.i0(beta),
+            0.0
+        )
+        weights = np.sinc((src - centers) / ratio) * window
+    else:
+        # Box filter, weighting each source texel by how much of it is covered
+        starts = (dst * ratio)[:, None]
+        src = np.floor(starts).astype(int) + np.arange(int(math.ceil(ratio)) + 1)
+        weights = np.clip(np.minimum(src + 1, starts + ratio) - np.maximum(src, starts), 0.0, None)
+
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.clip(src, 0, src_len - 1), weights.astype(np.float32)
+
+
+def _resample_axis(values, axis, dst_len, mip_filter):
+    # Apply the filter band one tap at a time so memory stays proportional to the output
+    indices, weights = _resample_taps(values.shape[axis], dst_len, mip_filter)
+    shape = [1] * values.ndim
+    shape[axis] = dst_len
+    result = np.zeros(values.shape[:axis] + (dst_len,) + values.shape[axis + 1:], np.float32)
+    for tap in range(weights.shape[1]):
+        result += np.take(values, indices[:, tap], axis=axis) * weights[:, tap].reshape(shape)
+    return result
+
+
+def generate_mipmaps(pixels, srgb, mip_filter='BOX'):
+    # Filter in linear space, alpha is never gamma encoded
+    values = pixels.astype(np.float32) / 255.0
+    if srgb:
+        values[..., :3] = _srgb_to_linear(values[..., :3])
+
+    levels = [pixels]
+    height, width = pixels.shape[:2]
+    while width > 1 or height > 1:
+        width = max(width // 2, 1)
+        height = max(height // 2, 1)
+        src = values
+        if mip_filter != 'KAISER' and src.shape[:2] == (height * 2, width * 2):
+            # Even sized box filtering is a plain average of each 2x2 block
+            src = src.reshape(height, 2, width, 2, src.shape[2]).mean(axis=(1, 3))
+        else:
+            if src.shape[0] != height:
+                src = _resample_axis(src, 0, height, mip_filter)
+            if src.shape[1] != width:
+                src = _resample_axis(src, 1, width, mip_filter)
+
+        level = np.clip(src, 0.0, 1.0)
+        if srgb:
+            level[..., :3] = _linear_to_srgb(level[..., :3])
+        levels.append(np.round(level * 255).astype(np.uint8))
+
+        # Keep filtering from full precision data to avoid compounding rounding
+        values = src
+
+    return levels
+
+
+VK_FORMAT_R8G8B8A8_UNORM = 37
+VK_FORMAT_R8G8B8A8_SRGB = 43
+
+KTX2_IDENTIFIER = b'\xabKTX 20\xbb\r\n\x1a\n'
+
+
+def encode_ktx2(levels, srgb):
+    height, width = levels[0].shape[:2]
+    vk_format = VK_FORMAT_R8G8B8A8_SRGB if srgb else VK_FORMAT_R8G8B8A8_UNORM
+
+    # Data format descriptor with a single RGBA8 basic block
+    transfer = 2 if srgb else 1
+    samples = b''.join(
+        struct.pack(
+            '<IIII',
+            (i * 8) | (7 << 16) | ((channel | (0x10 if channel == 15 and srgb else 0)) << 24),
+            0,
+            0,
+            255
+        )
+        for i, channel in enumerate((0, 1, 2, 15))
+    )
+    block_size = 24 + len(samples)
+    dfd = struct.pack(
+        '<IIIIIII',
+        4 + block_size,
+        0,
+        2 | (block_size << 16),
+        1 | (1 << 8) | (transfer << 16),
+        0,
+        4,
+        0
+    ) + samples
+
+    header_size = 80 + 24 * len(levels)
+    data_offset = header_size + len(dfd)
+
+    # Levels are stored smallest first, but indexed largest first
+    level_data = [level.tobytes() for level in levels]
+    offsets = {}
+    offset = data_offset
+    for i in reversed(range(len(levels))):
+        offsets[i] = offset
+        offset += len(level_data[i])
+
+    header = struct.pack(
+        '<12s9I',
+        KTX2_IDENTIFIER,
+        vk_format,
+        1,
+        width,
+        height,
+        0,
+        0,
+        1,
+        len(levels),
+        0
+    )
+    index = struct.pack('<IIIIQQ', header_size, len(dfd), 0, 0, 0, 0)
+    level_index = b''.join(
+        struct.pack('<QQQ', offsets[i], len(data), len(data))
+        for i, data in enumerate(level_data)
+    )
+
+    return b''.join([header, index, level_index, dfd] + level_data[::-1])
+
+
+def _image_cache_key(image):
+    # Images edited in Blender may not match their file, so never cache them
+    if image.is_dirty:
+        return None
+
+    if image.packed_file is not None:
+        return ['PACKED', hashlib.sha1(image.packed_file.data).hexdigest()]
+
+    path = bpy.path.abspath(image.filepath)
+    if image.source != 'FILE' or not os.path.isfile(path):
+        return None
+
+    stat = os.stat(path)
+    return ['FILE', os.path.normcase(os.path.abspath(path)), stat.st_mtime, stat.st_size]
+
+
+def _cached_encode(state, key, encode):
+    cache = state['image_cache']
+    if cache is None or key is None:
+        return encode()
+
+    data = cache.get(key)
+    if data is None:
+        data = encode()
+        cache.put(key, data)
+    return data
+
+
+def export_ktx2_image(state, name, get_pixels, srgb, cache_key):
+    mip_filter = state['settings']['images_ktx2_mip_filter']
+    if cache_key is not None:
+        cache_key = cache_key + ['KTX2', srgb, mip_filter]
+
+    gltf = {
+        'name': '{}_ktx2'.format(name),
+        'uri': '{}.ktx2'.format(name),
+        'mimeType': 'image/ktx2',
+    }
+    path = os.path.join(state['settings']['gltf_output_dir'], gltf['uri'])
+    state['files'][path] = _cached_encode(
+        state,
+        cache_key,
+        lambda: encode_ktx2(generate_mipmaps(get_pixels(), srgb, mip_filter), srgb)
+    )
+    state['ktx2_images'][name] = gltf
+
+
+def image_to_data_uri(image):
+    return _encode_png(_get_image_pixels(image))
+
+
+def check_image(image):
+    errors = []
+    if image.size[0] == 0:
+        errors.append('x dimension is 0')
+    if image.size[1] == 0:
+        errors.append('y dimension is 0')
+    if image.type != 'IMAGE':
+        errors.append('not an image')
+
+    if errors:
+        err_list = '\n\t'.join(errors)
+        print(
+            'Unable to export image {} due to the following errors:\n\t{}'
+            .format(image.name, err_list)
+        )
+        return False
+
+    return True
+
+
+EXT_MAP = {'BMP': 'bmp', 'JPEG': 'jpg', 'PNG': 'png', 'TARGA': 'tga'}
+
+
+def _embed_image(state, gltf, png_bytes):
+    gltf['mimeType'] = 'image/png'
+    if state['settings']['gltf_export_binary']:
+        buf = Buffer(gltf['name'])
+        view_key = buf.add_view(len(png_bytes), 0, None)
+        view = buf.buffer_views[view_key]
+        view['data'] = png_bytes
+
+        pad = 4 - len(png_bytes) % 4
+        if pad not in [0, 4]:
+            buf.add_view(pad, 0, None)
+
+        gltf['bufferView'] = Reference('bufferViews', view_key, gltf, 'bufferView')
+        state['references'].append(gltf['bufferView'])
+
+        state['buffers'].append(buf)
+        state['input']['buffers'].append(SimpleID(buf.name))
+    else:
+        gltf['uri'] = 'data:image/png;base64,' + base64.b64encode(png_bytes).decode()
+
+
+def export_atlas_page(state, page):
+    gltf = {'name': page.name}
+    cache_key = None
+    if state['image_cache'] is not None:
+        cache_key = ['ATLAS', hashlib.sha1(page.pixels.tobytes()).hexdigest(), page.pixels.shape]
+    png_bytes = _cached_encode(
+        state,
+        cache_key and cache_key + ['PNG', PNG_COMPRESSION_LEVEL],
+        lambda: _encode_png(page.pixels)
+    )
+
+    if state['settings']['images_data_storage'] == 'EMBED':
+        _embed_image(state, gltf, png_bytes)
+    else:
+        gltf['uri'] = '{}.png'.format(page.name)
+        path = os.path.join(state['settings']['gltf_output_dir'], gltf['uri'])
+        state['files'][path] = png_bytes
+
+    if state['settings']['images_data_storage'] == 'KTX2':
+        export_ktx2_image(state, page.name, lambda: page.pixels, page.srgb, cache_key)
+
+    return gltf
+
+
+def export_image(state, image):
+    if isinstance(image, AtlasPage):
+        return export_atlas_page(state, image)
+
+    path = ''
+    data = None
+
+    gltf = {'name': image.name}
+
+    storage_setting = state['settings']['images_data_storage']
+    image_packed = image.packed_file is not None
+
+    # Hashing packed data is only worth it when there is a cache to look up
+    cache_key = None
+    if state['image_cache'] is not None:
+        cache_key = _image_cache_key(image)
+
+    # Only read pixels once no matter how many encodings need them
+    pixels = []
+
+    def get_pixels():
+        if not pixels:
+            pixels.append(_get_image_pixels(image))
+        return pixels[0]
+
+    png_key = cache_key and cache_key + ['PNG', PNG_COMPRESSION_LEVEL]
+    if image_packed and storage_setting in ['COPY', 'REFERENCE', 'KTX2']:
+        if image.file_format in EXT_MAP:
+            # save the file to the output directory
+            gltf['uri'] = '.'.join([image.name, EXT_MAP[image.file_format]])
+
+            def save_image():
+                temp = image.filepath
+                image.filepath = os.path.join(state['settings']['gltf_output_dir'], gltf['uri'])
+                image.save()
+                with open(bpy.path.abspath(image.filepath), 'rb') as fin:
+                    saved_data = fin.read()
+                image.filepath = temp
+                return saved_data
+
+            save_key = cache_key and cache_key + ['SAVE', image.file_format]
+            data = _cached_encode(state, save_key, save_image)
+        else:
+            # convert to png and save
+            gltf['uri'] = '.'.join([image.name, 'png'])
+            data = _cached_encode(state, png_key, lambda: _encode_png(get_pixels()))
+        path = gltf['uri']
+
+    elif storage_setting in ['COPY', 'KTX2']:
+        # Copied when writing files so image data is never held in memory
+        gltf['uri'] = bpy.path.basename(image.filepath)
+        copy_path = os.path.join(state['settings']['gltf_output_dir'], gltf['uri'])
+        state['file_copies'][copy_path] = bpy.path.abspath(image.filepath)
+    elif storage_setting == 'REFERENCE':
+        gltf['uri'] = image.filepath.replace('//', '')
+    elif storage_setting == 'EMBED':
+        _embed_image(state, gltf, _cached_encode(state, png_key, lambda: _encode_png(get_pixels())))
+    else:
+        print(
+            'Encountered unknown option ({}) for images_data_storage setting'
+            .format(storage_setting)
+        )
+
+    if path:
+        state['files'][path] = data
+
+    # Write a KTX2 container with a full mip chain next to the regular copy
+    if storage_setting == 'KTX2':
+        srgb = image.colorspace_settings.name == 'sRGB'
+        export_ktx2_image(state, image.name, get_pixels, srgb, cache_key)
+
+    # Only images that decide a material's alpha mode are decoded to classify them
+    if image.name in state['alpha_images']:
+        state['image_alpha'][image.name] = _get_image_alpha_mode(
+            state, image, get_pixels, cache_key
+        )
+
+    return gltf
+
+
+# Linux ioctl to share extents between files on copy-on-write file systems
+FICLONE = 0x40049409
+
+
+def copy_file(source, path, link=False):
+    if os.path.exists(path):
+        if os.path.samefile(source, path) or filecmp.cmp(source, path, shallow=True):
+            return False
+        os.remove(path)
+
+    if link:
+        try:
+            os.link(source, path)
+            return True
+        except OSError:
+            pass
+
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as fin, open(path, 'wb') as fout:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            shutil.copystat(source, path)
+            return True
+        except OSError:
+            pass
+
+    # Uses sendfile or an equivalent where the platform supports it
+    shutil.copyfile(source, path)
+    shutil.copystat(source, path)
+    return True
+
+
+def check_texture(texture):
+    if not isinstance(texture, bpy.types.ImageTexture):
+        return False
+
+    errors = []
+    if texture.image is None:
+        errors.append('has no image reference')
+    elif texture.image.channels not in [3, 4]:
+        errors.append(
+            'points to {}-channel image (must be 3 or 4)'
+            .format(texture.image.channels)
+        )
+
+    if errors:
+        err_list = '\n\t'.join(errors)
+        print(
+            'Unable to export texture {} due to the following errors:\n\t{}'
+            .format(texture.name, err_list)
+        )
+        return False
+
+    return True
+
+
+def export_texture(state, texture):
+    # Generate sampler for this texture
+    gltf_sampler = {
+        'name': texture.name.replace('texture_', 'textures_'),
+    }
+
+    # Handle wrapS and wrapT
+    if texture.extension in ('REPEAT', 'CHECKER', 'EXTEND'):
+        if texture.use_mirror_x:
+            gltf_sampler['wrapS'] = GL_MIRRORED_REPEAT
+        else:
+            gltf_sampler['wrapS'] = GL_REPEAT
+
+        if texture.use_mirror_y:
+            gltf_sampler['wrapT'] = GL_MIRRORED_REPEAT
+        else:
+            gltf_sampler['wrapT'] = GL_REPEAT
+    elif texture.extension in ('CLIP', 'CLIP_CUBE'):
+        gltf_sampler['wrapS'] = GL_CLAMP_TO_EDGE
+        gltf_sampler['wrapT'] = GL_CLAMP_TO_EDGE
+    else:
+        print('Warning: Unknown texture extension option:', texture.extension)
+
+    # Handle minFilter and magFilter
+    if texture.use_mipmap:
+        gltf_sampler['minFilter'] = GL_LINEAR_MIPMAP_LINEAR
+        gltf_sampler['magFilter'] = GL_LINEAR
+    else:
+        gltf_sampler['minFilter'] = GL_NEAREST
+        gltf_sampler['magFilter'] = GL_NEAREST
+
+    gltf_texture = {
+        'name': texture.name,
+    }
+
+    state['input']['samplers'].append(SimpleID(texture.name))
+    state['samplers'].append(gltf_sampler)
+
+    gltf_texture['sampler'] = Reference('samplers', texture.name, gltf_texture, 'sampler')
+    state['references'].append(gltf_texture['sampler'])
+
+    source = state['atlas']['sources'].get(texture.name, texture.image.name)
+    gltf_texture['source'] = Reference('images', source, gltf_texture, 'source')
+    state['references'].append(gltf_texture['source'])
+
+    # Point clients that understand KTX2 at the precomputed mip chain
+    if source in state['ktx2_images']:
+        ktx2_name = state['ktx2_images'][source]['name']
+        gltf_texture['extras'] = {}
+        gltf_texture['extras']['ktx2_source'] = Reference(
+            'images',
+            ktx2_name,
+            gltf_texture['extras'],
+            'ktx2_source'
+        )
+        state['references'].append(gltf_texture['extras']['ktx2_source'])
+
+    tformat = None
+    channels = texture.image.channels
+    image_is_srgb = texture.image.colorspace_settings.name == 'sRGB'
+    use_srgb = state['settings']['images_allow_srgb'] and image_is_srgb
+
+    if state['version'] < Version('2.0'):
+        if channels == 3:
+            if use_srgb:
+                tformat = GL_SRGB
+            else:
+                tformat = GL_RGB
+        elif channels == 4:
+            if use_srgb:
+                tformat = GL_SRGB_ALPHA
+            else:
+                tformat = GL_RGBA
+
+        gltf_texture['format'] = gltf_texture['internalFormat'] = tformat
+
+    return gltf_texture
+
+
+_PBR_TEXTURE_SLOTS = (
+    ('base_color_texture', 'base_color_text_index'),
+    ('metal_roughness_texture', 'metal_rough_text_index'),
+    ('emissive_texture', 'emissive_text_index'),
+    ('normal_texture', 'normal_text_index'),
+    ('occlusion_texture', 'occlusion_text_index'),
+)
+
+
+def _pack_rects(sizes, page_size):
+    # Shelf packing, tallest rectangles first
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    placements = [None] * len(sizes)
+    pages = []
+
+    for i in order:
+        width, height = sizes[i]
+        if width > page_size or height > page_size:
+            raise ValueError('Rectangle {}x{} does not fit on a page'.format(width, height))
+
+        for page_idx, shelves in enumerate(pages):
+            shelf = next((
+                shelf for shelf in shelves
+                if height <= shelf[1] and shelf[2] + width <= page_size
+            ), None)
+            if shelf is None:
+                top = shelves[-1][0] + shelves[-1][1]
+                if top + height > page_size:
+                    continue
+                shelf = [top, height, 0]
+                shelves.append(shelf)
+            break
+        else:
+            shelf = [0, height, 0]
+            pages.append([shelf])
+            page_idx = len(pages) - 1
+
+        placements[i] = (page_idx, shelf[2], shelf[0])
+        shelf[2] += width
+
+    return placements, len(pages)
+
+
+def _atlas_uv_transform(rect, page_size, flip):
+    # Returns the offset and scale that map UVs onto rect, in the same
+    # orientation the exporter writes texture coordinates
+    pos_x, pos_y, width, height = rect
+    page_width, page_height = page_size
+    if not flip:
+        pos_y = page_height - pos_y - height
+
+    offset = (pos_x / page_width, pos_y / page_height)
+    scale = (width / page_width, height / page_height)
+    return offset, scale
+
+
+def build_texture_atlas(state):
+    settings = state['settings']
+    if state['version'] < Version('2.0'):
+        print('Warning: texture atlases require glTF 2.0, no atlas will be generated')
+        return
+
+    padding = settings['images_atlas_padding']
+    max_size = settings['images_atlas_max_image_size']
+    atlas = state['atlas']
+
+    def is_eligible(texture):
+        if not isinstance(texture, bpy.types.ImageTexture) or texture.image is None:
+            return False
+        image = texture.image
+        return (
+            texture.extension in ('CLIP', 'CLIP_CUBE')
+            and image.type == 'IMAGE'
+            and image.channels in (3, 4)
+            and 0 < image.size[0] <= max_size
+            and 0 < image.size[1] <= max_size
+        )
+
+    # Textures in a group can share a sampler and a color space
+    groups = collections.OrderedDict()
+    for texture in state['input']['textures']:
+        if is_eligible(texture):
+            key = (texture.image.colorspace_settings.name, texture.use_mipmap)
+            groups.setdefault(key, []).append(texture)
+
+    rects = {}
+    pages = []
+    packed_images = set()
+    for group_idx, ((colorspace, _), textures) in enumerate(groups.items()):
+        images = list(collections.OrderedDict(
+            (texture.image.name, texture.image) for texture in textures
+        ).values())
+        if len(images) < 2:
+            continue
+
+        sizes = [(image.size[0] + padding * 2, image.size[1] + padding * 2) for image in images]
+        placements, page_count = _pack_rects(sizes, settings['images_atlas_page_size'])
+
+        # Shrink pages to the smallest power of two that holds their contents
+        extents = [[1, 1] for _ in range(page_count)]
+        for (page_idx, pos_x, pos_y), (width, height) in zip(placements, sizes):
+            extents[page_idx][0] = max(extents[page_idx][0], pos_x + width)
+            extents[page_idx][1] = max(extents[page_idx][1], pos_y + height)
+        group_pages = [
+            AtlasPage(
+                'atlas_{}_{}'.format(group_idx, i),
+                1 << (width - 1).bit_length(),
+                1 << (height - 1).bit_length(),
+                colorspace == 'sRGB'
+            )
+            for i, (width, height) in enumerate(extents)
+        ]
+        pages.extend(group_pages)
+
+        image_rects = {}
+        for image, (page_idx, pos_x, pos_y), (width, height) in zip(images, placements, sizes):
+            page = group_pages[page_idx]
+            pixels = _get_image_pixels(image)
+            state['image_alpha'][image.name] = classify_alpha(pixels)
+            page.pixels[pos_y:pos_y + height, pos_x:pos_x + width] = np.pad(
+                pixels,
+                ((padding, padding), (padding, padding), (0, 0)),
+                mode='edge'
+            )
+            image_rects[image.name] = (
+                page,
+                (pos_x + padding, pos_y + padding, image.size[0], image.size[1])
+            )
+
+        # The first texture on each page stands in for every other texture on it
+        page_textures = {}
+        for texture in textures:
+            page, rect = image_rects[texture.image.name]
+            rects[texture.name] = (page.name, rect, page.size)
+            packed_images.add(texture.image.name)
+            if page.name not in page_textures:
+                page_textures[page.name] = texture.name
+                atlas['sources'][texture.name] = page.name
+            else:
+                canonical = page_textures[page.name]
+                state['aliases'][('textures', texture.name)] = ('textures', canonical)
+
+    if not pages:
+        return
+
+    # Drop merged textures and any images that are no longer referenced
+    packed_count = len(rects)
+    state['input']['textures'] = [
+        texture for texture in state['input']['textures']
+        if ('textures', texture.name) not in state['aliases']
+    ]
+    used_images = set(
+        texture.image.name for texture in state['input']['textures']
+        if getattr(texture, 'image', None) and texture.name not in rects
+    )
+    state['input']['images'] = [
+        image for image in state['input']['images']
+        if image.name not in packed_images or image.name in used_images
+    ]
+    state['input']['images'].extend(pages)
+
+    # Gather which texture coordinate layers sample atlased textures
+    flip = settings['asset_profile'] == 'WEB'
+    material_uses = {}
+    for material in state['input']['materials']:
+        pbr_settings = getattr(material, 'pbr_export_settings', None)
+        if pbr_settings is None:
+            continue
+        material_uses[material.name] = [
+            (getattr(pbr_settings, texture_prop), getattr(pbr_settings, index_prop))
+            for texture_prop, index_prop in _PBR_TEXTURE_SLOTS
+            if getattr(pbr_settings, texture_prop)
+        ]
+
+    material_meshes = {}
+    layer_rects = {}
+    for mesh in state['input']['meshes']:
+        for material in set(mat for mat in mesh.materials if mat):
+            material_meshes.setdefault(material.name, []).append(mesh.name)
+            for texture_name, layer in material_uses.get(material.name, []):
+                rect = rects.get(texture_name)
+                layer_rects.setdefault((mesh.name, layer), set()).add(rect and rect[1:])
+    remaps = {
+        key: next(iter(values)) for key, values in layer_rects.items()
+        if len(values) == 1 and None not in values
+    }
+
+    # A material can only rely on remapped coordinates if every mesh using it
+    # was remapped to the same rectangle, otherwise fall back to a transform
+    texture_transforms = {}
+    changed = True
+    while changed:
+        changed = False
+        for material_name, uses in material_uses.items():
+            meshes = material_meshes.get(material_name, [])
+            for texture_name, layer in uses:
+                if texture_name not in rects:
+                    continue
+                rect = rects[texture_name][1:]
+                if all(remaps.get((mesh, layer)) == rect for mesh in meshes):
+                    continue
+                texture_transforms[(material_name, texture_name)] = rect
+                for mesh in meshes:
+                    if remaps.pop((mesh, layer), None) is not None:
+                        changed = True
+
+    atlas['uv_transforms'] = {
+        key: _atlas_uv_transform(rect, page_size, flip)
+        for key, (rect, page_size) in remaps.items()
+    }
+    atlas['texture_transforms'] = {
+        key: _atlas_uv_transform(rect, page_size, flip)
+        for key, (rect, page_size) in texture_transforms.items()
+    }
+
+    atlas['report'] = {
+        'textures': packed_count,
+        'pages': len(pages),
+        'images_saved': len(packed_images - used_images) - len(pages),
+        'texture_binds_saved': packed_count - len(pages),
+        'transforms': len(texture_transforms),
+    }
+    print(
+        'Texture atlas: packed {textures} textures into {pages} pages, saving {images_saved} '
+        'images and {texture_binds_saved} texture binds ({transforms} texture transforms)'
+        .format(**atlas['report'])
+    )
+
+
+ANIMATION_INTERPOLATIONS = ('CONSTANT', 'LINEAR', 'BEZIER')
+BEZIER_SOLVER_ITERATIONS = 40
+
+_TRANSFORM_PROPS = (
+    'location',
+    'rotation_euler',
+    'rotation_quaternion',
+    'rotation_axis_angle',
+    'scale',
+)
+_OBJECT_DELTA_PROPS = (
+    'delta_location',
+    'delta_rotation_euler',
+    'delta_rotation_quaternion',
+    'delta_scale',
+)
+_POSE_BONE_PATH = re.compile(r'^pose\.bones\["(.+)"\]\.(\w+)$')
+
+
+def _split_data_path(path):
+    match = _POSE_BONE_PATH.match(path)
+    if match:
+        return match.group(1), match.group(2)
+    return None, path
+
+
+class FCurveKeys:
+    __slots__ = (
+        'co',
+        'handle_left',
+        'handle_right',
+        'interpolation',
+        'extrapolation',
+    )
+
+    def __init__(self, fcurve):
+        points = fcurve.keyframe_points
+        data = {}
+        for attr in ('co', 'handle_left', 'handle_right'):
+            values = np.zeros(len(points) * 2, dtype=np.float32)
+            points.foreach_get(attr, values)
+            data[attr] = values.reshape(-1, 2).astype(np.float64)
+
+        self.co = data['co']
+        self.handle_left = data['handle_left']
+        self.handle_right = data['handle_right']
+        self.interpolation = np.array([
+            ANIMATION_INTERPOLATIONS.index(point.interpolation) for point in points
+        ], dtype=np.int8)
+        self.extrapolation = fcurve.extrapolation
+
+    @staticmethod
+    def is_supported(fcurve):
+        return not fcurve.modifiers and all(
+            point.interpolation in ANIMATION_INTERPOLATIONS for point in fcurve.keyframe_points
+        )
+
+    def evaluate(self, frames):
+        frames = np.asarray(frames, dtype=np.float64)
+        co_x, co_y = self.co[:, 0], self.co[:, 1]
+        last = len(co_x) - 1
+
+        start = np.clip(np.searchsorted(co_x, frames, side='right') - 1, 0, last)
+        end = np.minimum(start + 1, last)
+        interpolation = self.interpolation[start]
+        inside = (frames > co_x[0]) & (frames < co_x[-1])
+
+        # Constant segments and frames that land on a key keep the key value
+        values = co_y[start].copy()
+
+        linear = inside & (interpolation == ANIMATION_INTERPOLATIONS.index('LINEAR'))
+        if linear.any():
+            x_0, x_1 = co_x[start[linear]], co_x[end[linear]]
+            y_0, y_1 = co_y[start[linear]], co_y[end[linear]]
+            width = np.where(x_1 == x_0, 1.0, x_1 - x_0)
+            values[linear] = y_0 + (y_1 - y_0) * (frames[linear] - x_0) / width
+
+        bezier = inside & (interpolation == ANIMATION_INTERPOLATIONS.index('BEZIER'))
+        if bezier.any():
+            values[bezier] = self._evaluate_bezier(frames[bezier], start[bezier])
+
+        if self.extrapolation == 'LINEAR':
+            before = frames < co_x[0]
+            values[before] = self._extrapolate(frames[before], 0, 1, self.handle_left[0])
+            after = frames > co_x[-1]
+            values[after] = self._extrapolate(
+                frames[after], last, last - 1, self.handle_right[last]
+            )
+
+        return values
+
+    def _evaluate_bezier(self, frames, start):
+        p_0 = self.co[start]
+        p_1 = self.handle_right[start]
+        p_2 = self.handle_left[start + 1]
+        p_3 = self.co[start + 1]
+
+        # Scale down handles that overlap in time, the same way Blender does
+        h_1 = p_0 - p_1
+        h_2 = p_3 - p_2
+        width = p_3[:, 0] - p_0[:, 0]
+        handle_width = np.abs(h_1[:, 0]) + np.abs(h_2[:, 0])
+        fac = np.where(
+            handle_width > width,
+            width / np.where(handle_width == 0.0, 1.0, handle_width),
+            1.0
+        )[:, None]
+        p_1 = p_0 - fac * h_1
+        p_2 = p_3 - fac * h_2
+
+        def bezier(param, axis):
+            inv = 1.0 - param
+            return (
+                inv * inv * inv * p_0[:, axis] +
+                3.0 * inv * inv * param * p_1[:, axis] +
+                3.0 * inv * param * param * p_2[:, axis] +
+                param * param * param * p_3[:, axis]
+            )
+
+        # The corrected curve is monotonic in time, so bisect for the parameter
+        low = np.zeros(len(frames))
+        high = np.ones(len(frames))
+        for _ in range(BEZIER_SOLVER_ITERATIONS):
+            param = (low + high) * 0.5
+            below = bezier(param, 0) < frames
+            low = np.where(below, param, low)
+            high = np.where(below, high, param)
+
+        return bezier((low + high) * 0.5, 1)
+
+    def _extrapolation_slope(self, key, neighbor, handle):
+        interpolation = ANIMATION_INTERPOLATIONS[self.interpolation[key]]
+        if interpolation == 'CONSTANT':
+            return 0.0
+
+        if interpolation == 'LINEAR':
+            if not 0 <= neighbor < len(self.co):
+                return 0.0
+            point = self.co[neighbor]
+        else:
+            point = handle
+
+        width = self.co[key, 0] - point[0]
+        if width == 0.0:
+            return 0.0
+        return (self.co[key, 1] - point[1]) / width
+
+    def _extrapolate(self, frames, key, neighbor, handle):
+        slope = self._extrapolation_slope(key, neighbor, handle)
+        return self.co[key, 1] + (frames - self.co[key, 0]) * slope
+
+
+def _rotation_to_quats(props, rotation_mode, prefix=''):
+    if rotation_mode == 'QUATERNION':
+        # Blender stores quaternions as (w, x, y, z)
+        return _normalize_quats(np.roll(props[prefix + 'rotation_quaternion'], -1, axis=-1))
+    if rotation_mode == 'AXIS_ANGLE':
+        if prefix:
+            # Delta axis angle rotations are not exposed to Python
+            quats = np.zeros(props['rotation_axis_angle'].shape)
+            quats[..., 3] = 1.0
+            return quats
+        return _axis_angle_to_quat(props['rotation_axis_angle'])
+    return _euler_to_quat(props[prefix + 'rotation_euler'], rotation_mode)
+
+
+def _compose_basis(props, rotation_mode):
+    loc = props['location']
+    rot = _rotation_to_quats(props, rotation_mode)
+    scale = props['scale']
+
+    if 'delta_location' in props:
+        loc = loc + props['delta_location']
+        rot = _quat_multiply(_rotation_to_quats(props, rotation_mode, 'delta_'), rot)
+        scale = scale * props['delta_scale']
+
+    return compose_matrices(loc, rot, scale)
+
+
+def _get_rest_matrix(obj, target):
+    if target is None:
+        if obj.parent:
+            return np.array(obj.matrix_parent_inverse, dtype=np.float64)
+        return np.identity(4)
+
+    bone = obj.data.bones[target]
+    rest = np.array(bone.matrix_local, dtype=np.float64)
+    if bone.parent:
+        rest = np.matmul(
+            np.linalg.inv(np.array(bone.parent.matrix_local, dtype=np.float64)),
+            rest
+        )
+    return rest
+
+
+def get_matrices(collection, attr):
+    # foreach_get hands matrices back column by column
+    matrices = np.zeros(len(collection) * 16, dtype=np.float32)
+    collection.foreach_get(attr, matrices)
+    return matrices.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
+
+
+def invert_matrices(matrices):
+    try:
+        return np.linalg.inv(matrices)
+    except np.linalg.LinAlgError:
+        # Zero scaled bones are singular, fall back to the pseudo-inverse like Blender does
+        return np.linalg.pinv(matrices)
+
+
+def _get_fallback_targets(obj, curves, keyed):
+    targets = [None]
+    if obj.type == 'ARMATURE':
+        targets.extend(pbone.name for pbone in obj.pose.bones)
+
+    # NLA strips are blended into the result of frame_set, so sample everything
+    anim_data = obj.animation_data
+    if anim_data and anim_data.use_nla and any(not t.mute for t in anim_data.nla_tracks):
+        return set(targets)
+
+    fallback = set()
+    transform_props = _TRANSFORM_PROPS + _OBJECT_DELTA_PROPS + ('rotation_mode',)
+    for (target, prop), fcurves in curves.items():
+        if target not in targets or prop not in transform_props:
+            continue
+        if prop == 'rotation_mode' or not all(FCurveKeys.is_supported(c) for c in fcurves):
+            fallback.add(target)
+
+    if anim_data:
+        for driver in anim_data.drivers:
+            target, prop = _split_data_path(driver.data_path)
+            if target in targets and prop in transform_props and not driver.mute:
+                fallback.add(target)
+
+    if obj.constraints or obj.parent_type != 'OBJECT' or obj.rigid_body is not None:
+        fallback.add(None)
+
+    if obj.type == 'ARMATURE':
+        for pbone in obj.pose.bones:
+            if pbone.bone.use_connect and (pbone.name, 'location') in curves:
+                fallback.add(pbone.name)
+
+            for constraint in pbone.constraints:
+                if constraint.mute:
+                    continue
+                fallback.add(pbone.name)
+
+                # IK moves every bone in its chain, not just the constrained one
+                if constraint.type in ('IK', 'SPLINE_IK'):
+                    parent = pbone.parent
+                    depth = 1
+                    chain_count = constraint.chain_count
+                    while parent and (chain_count == 0 or depth < chain_count):
+                        fallback.add(parent.name)
+                        parent = parent.parent
+                        depth += 1
+
+        # Bones that do not fully inherit their parent's pose move relative to it whenever
+        # anything above them moves, parents are handled first so this propagates down
+        moving = fallback | keyed
+        for pbone in sorted(obj.pose.bones, key=lambda pbone: len(pbone.parent_recursive)):
+            bone = pbone.bone
+            inherits_default = (
+                bone.use_inherit_rotation and
+                bone.use_inherit_scale and
+                bone.use_local_location
+            )
+            chain = [pbone] + list(pbone.parent_recursive)
+            if not inherits_default and any(i.name in moving for i in chain):
+                fallback.add(pbone.name)
+                moving.add(pbone.name)
+
+    return fallback
+
+
+def _sample_frame_set(jobs, frames, chunk_size, sinks):
+    # Every job in a sweep belongs to a different object, so all of their actions can be
+    # assigned at once and sampled with a single frame_set per frame
+    sce = bpy.context.scene
+    prev_frame = sce.frame_current
+
+    restore = []
+    for obj, action, _ in jobs:
+        created_anim_data = obj.animation_data is None
+        if created_anim_data:
+            obj.animation_data_create()
+        restore.append((obj, created_anim_data, obj.animation_data.action))
+        obj.animation_data.action = action
+
+    # Pose matrices are gathered for all bones at once and made parent relative in a batch
+    samplers = []
+    for obj, _, targets in jobs:
+        bone_indices = parent_indices = None
+        if obj.type == 'ARMATURE':
+            pose_bones = obj.pose.bones
+            indices = {pbone.name: i for i, pbone in enumerate(pose_bones)}
+            bone_indices = np.array([indices[target] for target in targets if target is not None])
+            parent_indices = np.array([
+                indices[pbone.parent.name] if pbone.parent else -1 for pbone in pose_bones
+            ])[bone_indices]
+        samplers.append((bone_indices, parent_indices))
+
+    # Samples are flushed to the sinks in chunks to bound memory use on long actions
+    chunk_size = min(chunk_size, len(frames))
+    samples = [np.zeros((chunk_size, len(targets), 4, 4)) for _, _, targets in jobs]
+
+    def flush(count):
+        for (_, _, targets), job_samples, job_sinks in zip(jobs, samples, sinks):
+            for i, target in enumerate(targets):
+                _write_matrices(job_sinks[target], job_samples[:count, i])
+
+    for i, frame in enumerate(frames):
+        sce.frame_set(int(frame))
+        row = i % chunk_size
+        for (obj, _, targets), job_samples, (bone_indices, parent_indices) in zip(
+                jobs, samples, samplers):
+            column = 0
+            if targets[0] is None:
+                job_samples[row, 0] = np.array(obj.matrix_local, dtype=np.float64)
+                column = 1
+            if bone_indices is not None and len(bone_indices):
+                pose = get_matrices(obj.pose.bones, 'matrix')
+                local = pose[bone_indices]
+                has_parent = parent_indices >= 0
+                local[has_parent] = np.matmul(
+                    invert_matrices(pose[parent_indices[has_parent]]),
+                    local[has_parent]
+                )
+                job_samples[row, column:] = local
+        if row == chunk_size - 1:
+            flush(chunk_size)
+    if len(frames) % chunk_size:
+        flush(len(frames) % chunk_size)
+
+    for obj, created_anim_data, prev_action in restore:
+        if created_anim_data:
+            obj.animation_data_clear()
+        else:
+            obj.animation_data.action = prev_action
+    sce.frame_set(prev_frame)
+
+
+class ActionEvaluator:
+    # Evaluates the local matrices of everything an action can move, a chunk of frames at a
+    # time. Targets are None for the object itself or a pose bone name. F-curves are evaluated
+    # directly, only targets driven by something besides the action need frame_set. Targets
+    # in skip (those exported from native keyframes) are left out.
+    def __init__(self, obj, action, skip=()):
+        curves = {}
+        for fcurve in action.fcurves:
+            curves.setdefault(_split_data_path(fcurve.data_path), []).append(fcurve)
+
+        owners = [(None, obj)]
+        if obj.type == 'ARMATURE':
+            owners.extend((pbone.name, pbone) for pbone in obj.pose.bones)
+
+        # Only keyed or externally driven targets can move, everything else keeps its pose
+        keyed = set()
+        transform_props = _TRANSFORM_PROPS + _OBJECT_DELTA_PROPS
+        for (target, prop), fcurves in curves.items():
+            if prop in transform_props and any(not c.mute and c.keyframe_points for c in fcurves):
+                keyed.add(target)
+
+        fallback = _get_fallback_targets(obj, curves, keyed) - set(skip)
+        animated = keyed | fallback
+
+        # The object itself (None) always comes first
+        self.fallback = sorted(fallback, key=lambda target: (target is not None, target or ''))
+        self.targets = []
+        self._direct = []
+        for target, owner in owners:
+            if target in skip:
+                continue
+            if target in fallback:
+                self.targets.append(target)
+                continue
+
+            # Objects are exported with their static pose, so unanimated objects need no channels
+            is_static = target not in animated
+            if is_static and target is None:
+                continue
+
+            prop_names = _TRANSFORM_PROPS
+            if target is None:
+                prop_names += _OBJECT_DELTA_PROPS
+            static = {
+                name: np.array(getattr(owner, name), dtype=np.float64)[None]
+                for name in prop_names
+            }
+            keys = [
+                (name, fcurve.array_index, FCurveKeys(fcurve))
+                for name in prop_names
+                for fcurve in curves.get((target, name), [])
+                if not fcurve.mute and fcurve.keyframe_points and
+                fcurve.array_index < static[name].shape[1]
+            ]
+            rest = _get_rest_matrix(obj, target)
+
+            # Joints are exported in their rest pose, so only posed static bones need channels
+            constant = None
+            if is_static:
+                basis = _compose_basis(static, owner.rotation_mode)[0]
+                if np.allclose(basis, np.identity(4), atol=1e-6):
+                    continue
+                constant = np.matmul(rest, basis)
+
+            self.targets.append(target)
+            self._direct.append((target, owner.rotation_mode, rest, static, keys, constant))
+
+    def evaluate(self, frames):
+        matrices = collections.OrderedDict()
+        for target, rotation_mode, rest, static, keys, constant in self._direct:
+            if constant is not None:
+                matrices[target] = np.broadcast_to(constant, (len(frames), 4, 4))
+                continue
+
+            props = {
+                name: np.repeat(values, len(frames), axis=0) for name, values in static.items()
+            }
+            for name, index, fcurve_keys in keys:
+                props[name][:, index] = fcurve_keys.evaluate(frames)
+            matrices[target] = np.matmul(rest, _compose_basis(props, rotation_mode))
+
+        return matrices
+
+
+def _get_dependencies(obj):
+    # Objects whose animation can change how obj evaluates: parents, constraint targets,
+    # modifier objects (armatures, hooks) and driver targets, followed transitively. Driver
+    # targets can be any ID, so missing attributes are skipped.
+    found = set()
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        related = [getattr(current, 'parent', None)]
+        related.extend(
+            getattr(constraint, 'target', None)
+            for constraint in getattr(current, 'constraints', ())
+        )
+        related.extend(
+            getattr(modifier, 'object', None) for modifier in getattr(current, 'modifiers', ())
+        )
+        animation_data = getattr(current, 'animation_data', None)
+        if animation_data is not None:
+            related.extend(
+                target.id
+                for fcurve in animation_data.drivers
+                for variable in fcurve.driver.variables
+                for target in variable.targets
+            )
+        for other in related:
+            if other is not None and other is not obj and other not in found:
+                found.add(other)
+                stack.append(other)
+    return found
+
+
+def _schedule_sweeps(jobs):
+    # Group jobs by frame range, then split each group into sweeps that touch every object
+    # at most once, since an object can only have one action assigned at a time. Objects
+    # that depend on each other are sampled in separate sweeps, so each is baked with the
+    # other in the same state as when it is baked alone.
+    ranges = collections.OrderedDict()
+    for job in jobs:
+        ranges.setdefault(job[1], []).append(job)
+
+    dependencies = {}
+
+    def get_dependencies(obj):
+        if obj not in dependencies:
+            dependencies[obj] = _get_dependencies(obj)
+        return dependencies[obj]
+
+    def conflicts(obj, other):
+        return obj is other or other in get_dependencies(obj) or obj in get_dependencies(other)
+
+    sweeps = []
+    for frame_range, range_jobs in ranges.items():
+        range_sweeps = []
+        for job in range_jobs:
+            for sweep in range_sweeps:
+                if not any(conflicts(job[2], other[2]) for other in sweep):
+                    sweep.append(job)
+                    break
+            else:
+                range_sweeps.append([job])
+        sweeps.extend((frame_range, sweep) for sweep in range_sweeps)
+
+    return sweeps
+
+
+# Rough peak memory used per target and frame while evaluating and decomposing a chunk
+BAKE_BYTES_PER_SAMPLE = 1024
+REDUCTION_MAX_SEGMENT = 4096
+
+
+class ChannelSink:
+    # Receives the baked samples of one channel in frame order. Without a tolerance every
+    # frame is stored in a preallocated float32 array, otherwise keys are reduced as samples
+    # arrive and only the kept keys plus the samples since the last key are held in memory.
+    def __init__(self, path, count, tolerance=None, breakpoints=()):
+        self.path = path
+        self.count = count
+        self.tolerance = tolerance
+        self.breakpoints = set(breakpoints)
+        self.previous = None
+        self.written = 0
+
+        width = 4 if path == 'rotation' else 3
+        self.values = None
+        if tolerance is None:
+            self.values = np.zeros((count, width), dtype=np.float32)
+
+        self.keys = [0]
+        self.key_values = []
+        self.constant = True
+        self.start = 0
+        self.end = 1
+        self.pending = np.zeros((0, width))
+
+    def write(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+
+        # Keep quaternions in the same hemisphere as the previous sample, across chunks too
+        if self.path == 'rotation':
+            if self.previous is not None:
+                values = align_quats(np.concatenate((self.previous[None], values)))[1:]
+            else:
+                values = align_quats(values)
+            self.previous = values[-1]
+
+        if self.tolerance is None:
+            self.values[self.written:self.written + len(values)] = values
+        else:
+            self._reduce(values)
+        self.written += len(values)
+
+    def _fits(self, end):
+        fac = np.arange(1, end) / float(end)
+        expected = _interpolate_channel(self.path, self.pending[0], self.pending[end], fac)
+        error = _channel_error(self.path, expected, self.pending[1:end])
+        return np.all(error <= self.tolerance)
+
+    def _reduce(self, values):
+        # Greedily extend each linear segment as long as the skipped samples stay within
+        # tolerance, segments always end at breakpoints so those keys are kept
+        if not self.key_values:
+            self.key_values.append(values[0])
+        first = self.key_values[0]
+        self.constant = self.constant and bool(
+            np.all(_channel_error(self.path, first, values) <= self.tolerance)
+        )
+
+        self.pending = np.concatenate((self.pending, values))
+        while True:
+            count = len(self.pending)
+            end = self.end
+            while (end + 1 < count and self.start + end not in self.breakpoints and
+                   end < REDUCTION_MAX_SEGMENT and self._fits(end + 1)):
+                end += 1
+            if end + 1 >= count:
+                self.end = end
+                return
+
+            self.keys.append(self.start + end)
+            self.key_values.append(self.pending[end])
+            self.pending = self.pending[end:].copy()
+            self.start += end
+            self.end = 1
+
+    def finish(self):
+        # Returns (key frames relative to the first sample, values)
+        if self.tolerance is None:
+            return np.arange(self.count, dtype=np.float64), self.values
+
+        if self.constant or self.written <= 1:
+            return np.zeros(1), np.array(self.key_values[:1])
+
+        last = len(self.pending) - 1
+        return (
+            np.array(self.keys + [self.start + last], dtype=np.float64),
+            np.array(self.key_values + [self.pending[last]])
+        )
+
+
+def _write_matrices(target_sinks, matrices):
+    loc, rot, scale = decompose_matrices(matrices)
+    for path, values in (('translation', loc), ('rotation', rot), ('scale', scale)):
+        if path in target_sinks:
+            target_sinks[path].write(values)
+
 
-    gltf = {}
-    gltf['buffers'] = [buf.export_buffer(state) for buf in buffers]
-    gltf['bufferViews'] = list(itertools.chain(*[buf.export_views(state) for buf in buffers]))
-    gltf['accessors'] = list(itertools.chain(*[buf.export_accessors(state) for buf in buffers]))
+def _get_chunk_size(memory_limit, num_targets):
+    return max(1, int(memory_limit // (max(1, num_targets) * BAKE_BYTES_PER_SAMPLE)))
 
-    return gltf
 
+def bake_actions(state, jobs, breakpoints=None, native=None):
+    # Bake (object, action) pairs into OrderedDicts mapping targets to OrderedDicts of
+    # path -> (key frames, values). Frames are streamed through ChannelSinks in chunks so
+    # intermediate sample memory stays under animations_bake_memory_limit. Paths with native
+    # channels are not baked, and neither are targets whose paths are all native.
+    settings = state['settings']
+    tolerances = None
+    if settings['animations_reduce_keyframes']:
+        tolerances = _get_animation_tolerances(settings)
+    memory_limit = settings['animations_bake_memory_limit'] * 1024 * 1024
+    if breakpoints is None:
+        breakpoints = [() for _ in jobs]
+    if native is None:
+        native = [{} for _ in jobs]
 
-def image_to_data_uri(image):
-    width = image.size[0]
-    height = image.size[1]
-    buf = bytearray([int(p * 255) for p in image.pixels])
+    sinks = []
+    pending = []
+    for i, (obj, action) in enumerate(jobs):
+        frame_start, frame_end = [int(x) for x in action.frame_range]
+        frames = np.arange(frame_start, frame_end + 1, dtype=np.float64)
+        paths = ('translation', 'rotation', 'scale')
+        skip = {
+            target for target, target_native in native[i].items()
+            if all(path in target_native for path in paths)
+        }
+        evaluator = ActionEvaluator(obj, action, skip)
+
+        job_sinks = collections.OrderedDict()
+        for target in evaluator.targets:
+            target_native = native[i].get(target, {})
+            job_sinks[target] = collections.OrderedDict(
+                (path, ChannelSink(
+                    path,
+                    len(frames),
+                    tolerances[path] if tolerances else None,
+                    breakpoints[i]
+                ))
+                for path in paths if path not in target_native
+            )
+        sinks.append(job_sinks)
+
+        num_direct = len(evaluator.targets) - len(evaluator.fallback)
+        if num_direct:
+            chunk_size = _get_chunk_size(memory_limit, num_direct)
+            for start in range(0, len(frames), chunk_size):
+                chunk = frames[start:start + chunk_size]
+                for target, matrices in evaluator.evaluate(chunk).items():
+                    _write_matrices(job_sinks[target], matrices)
+
+        if evaluator.fallback:
+            pending.append((i, (frame_start, frame_end), obj, action, evaluator.fallback))
+
+    sweeps = _schedule_sweeps(pending)
+    for (frame_start, frame_end), sweep in sweeps:
+        frames = np.arange(frame_start, frame_end + 1, dtype=np.float64)
+        chunk_size = _get_chunk_size(memory_limit, sum(len(job[4]) for job in sweep))
+        _sample_frame_set(
+            [job[2:] for job in sweep],
+            frames,
+            chunk_size,
+            [sinks[job[0]] for job in sweep]
+        )
 
-    # reverse the vertical line order and add null bytes at the start
-    width_byte_4 = width * 4
-    raw_data = b''.join(b'\x00' + buf[span:span + width_byte_4]
-                        for span in range((height - 1) * width_byte_4, -1, - width_byte_4))
+    if sweeps:
+        print('Sampled {} of {} actions in {} timeline sweeps'.format(
+            len(pending), len(jobs), len(sweeps)
+        ))
+
+    return [
+        collections.OrderedDict(
+            (target, collections.OrderedDict(
+                (path, sink.finish()) for path, sink in target_sinks.items()
+            ))
+            for target, target_sinks in job_sinks.items()
+        )
+        for job_sinks in sinks
+    ]
 
-    def png_pack(png_tag, data):
-        chunk_head = png_tag + data
-        return (struct.pack("!I", len(data)) +
-                chunk_head +
-                struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk_head)))
 
-    png_bytes = b''.join([
-        b'\x89PNG\r\n\x1a\n',
-        png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, 6, 0, 0, 0)),
-        png_pack(b'IDAT', zlib.compress(raw_data, 9)),
-        png_pack(b'IEND', b'')])
+def align_quats(quats):
+    # Flip signs so consecutive keys stay in the same hemisphere and interpolate the short way
+    dots = np.sum(quats[1:] * quats[:-1], axis=-1)
+    signs = np.cumprod(np.concatenate(([1.0], np.where(dots < 0.0, -1.0, 1.0))))
+    return quats * signs[:, None]
 
-    return png_bytes
 
+def _quat_slerp(quat_a, quat_b, fac):
+    dot = np.sum(quat_a * quat_b, axis=-1)
+    quat_b = np.where(dot[..., None] < 0.0, -quat_b, quat_b)
+    theta = np.arccos(np.clip(np.abs(dot), 0.0, 1.0))
+    sin_theta = np.sin(theta)
+    small = sin_theta < 1e-6
+    safe_sin = np.where(small, 1.0, sin_theta)
+    weight_a = np.where(small, 1.0 - fac, np.sin((1.0 - fac) * theta) / safe_sin)
+    weight_b = np.where(small, fac, np.sin(fac * theta) / safe_sin)
+    return weight_a[..., None] * quat_a + weight_b[..., None] * quat_b
 
-def check_image(image):
-    errors = []
-    if image.size[0] == 0:
-        errors.append('x dimension is 0')
-    if image.size[1] == 0:
-        errors.append('y dimension is 0')
-    if image.type != 'IMAGE':
-        errors.append('not an image')
 
-    if errors:
-        err_list = '\n\t'.join(errors)
-        print(
-            'Unable to export image {} due to the following errors:\n\t{}'
-            .format(image.name, err_list)
+def _channel_error(path, expected, actual):
+    if path == 'rotation':
+        dot = np.abs(np.sum(expected * actual, axis=-1)) / (
+            np.linalg.norm(expected, axis=-1) * np.linalg.norm(actual, axis=-1)
         )
-        return False
+        return 2.0 * np.arccos(np.clip(dot, 0.0, 1.0))
+    if path == 'translation':
+        return np.linalg.norm(expected - actual, axis=-1)
+    return np.max(np.abs(expected - actual), axis=-1)
 
-    return True
 
+def _interpolate_channel(path, start, end, fac):
+    if path == 'rotation':
+        return _quat_slerp(start, end, fac)
+    return start + (end - start) * fac[..., None]
 
-EXT_MAP = {'BMP': 'bmp', 'JPEG': 'jpg', 'PNG': 'png', 'TARGA': 'tga'}
 
+def reduce_keyframes(path, values, tolerance, breakpoints=()):
+    # Returns the indices of the keys kept when reducing a whole channel at once
+    sink = ChannelSink(path, len(values), tolerance, breakpoints)
+    sink.write(values)
+    return sink.finish()[0].astype(int)
 
-def export_image(state, image):
-    path = ''
-    data = None
 
-    gltf = {'name': image.name}
+QUANTIZED_COMPONENT_SIZES = {
+    Buffer.BYTE: 1,
+    Buffer.SHORT: 2,
+}
 
-    storage_setting = state['settings']['images_data_storage']
-    image_packed = image.packed_file is not None
-    if image_packed and storage_setting in ['COPY', 'REFERENCE']:
-        if image.file_format in EXT_MAP:
-            # save the file to the output directory
-            gltf['uri'] = '.'.join([image.name, EXT_MAP[image.file_format]])
-            temp = image.filepath
-            image.filepath = os.path.join(state['settings']['gltf_output_dir'], gltf['uri'])
-            image.save()
-            with open(bpy.path.abspath(image.filepath), 'rb') as fin:
-                data = fin.read()
-            image.filepath = temp
-        else:
-            # convert to png and save
-            gltf['uri'] = '.'.join([image.name, 'png'])
-            data = image_to_data_uri(image)
-        path = gltf['uri']
 
-    elif storage_setting == 'COPY':
-        with open(bpy.path.abspath(image.filepath), 'rb') as fin:
-            data = fin.read()
-        gltf['uri'] = bpy.path.basename(image.filepath)
-        path = os.path.join(state['settings']['gltf_output_dir'], gltf['uri'])
-    elif storage_setting == 'REFERENCE':
-        gltf['uri'] = image.filepath.replace('//', '')
-    elif storage_setting == 'EMBED':
-        png_bytes = image_to_data_uri(image)
-        gltf['mimeType'] = 'image/png'
-        if state['settings']['gltf_export_binary']:
-            buf = Buffer(image.name)
-            view_key = buf.add_view(len(png_bytes), 0, None)
-            view = buf.buffer_views[view_key]
-            view['data'] = png_bytes
-
-            pad = 4 - len(png_bytes) % 4
-            if pad not in [0, 4]:
-                buf.add_view(pad, 0, None)
-
-            gltf['bufferView'] = Reference('bufferViews', view_key, gltf, 'bufferView')
-            state['references'].append(gltf['bufferView'])
+def quantize_rotations(quats, max_error):
+    # Pick the smallest normalized integer type that keeps every rotation within max_error
+    # radians, returning None if even SHORT is not precise enough
+    quats = _normalize_quats(quats)
+    for component_type, scale in ((Buffer.BYTE, 127.0), (Buffer.SHORT, 32767.0)):
+        values = np.round(quats * scale)
+        decoded = np.maximum(values / scale, -1.0)
+        if np.all(_channel_error('rotation', quats, decoded) <= max_error):
+            return component_type, values
 
-            state['buffers'].append(buf)
-            state['input']['buffers'].append(SimpleID('buffer_' + image.name))
-        else:
-            gltf['uri'] = 'data:image/png;base64,' + base64.b64encode(png_bytes).decode()
-    else:
-        print(
-            'Encountered unknown option ({}) for images_data_storage setting'
-            .format(storage_setting)
-        )
+    return None
 
-    if path:
-        state['files'][path] = data
 
-    return gltf
+def _get_target_name(obj, target):
+    if target is None:
+        return obj.name
+    return _get_bone_name(bpy.data.armatures[obj.data.name].bones[target])
 
 
-def check_texture(texture):
-    if not isinstance(texture, bpy.types.ImageTexture):
-        return False
+def _get_animation_tolerances(settings):
+    return {
+        'translation': settings['animations_translation_tolerance'],
+        'rotation': settings['animations_rotation_tolerance'],
+        'scale': settings['animations_scale_tolerance'],
+    }
 
-    errors = []
-    if texture.image is None:
-        errors.append('has no image reference')
-    elif texture.image.channels not in [3, 4]:
-        errors.append(
-            'points to {}-channel image (must be 3 or 4)'
-            .format(texture.image.channels)
-        )
 
-    if errors:
-        err_list = '\n\t'.join(errors)
-        print(
-            'Unable to export texture {} due to the following errors:\n\t{}'
-            .format(texture.name, err_list)
+def _quat_left_matrix(quat):
+    # Matrix form of quat * q acting on (x, y, z, w) quaternions
+    return _quat_multiply(np.tile(quat, (4, 1)), np.identity(4)).T
+
+
+def _hermite(start, end, start_tangent, end_tangent, fac, width):
+    fac = fac[..., None]
+    fac2 = fac * fac
+    fac3 = fac2 * fac
+    return (
+        (2 * fac3 - 3 * fac2 + 1) * start +
+        (fac3 - 2 * fac2 + fac) * width[..., None] * start_tangent +
+        (-2 * fac3 + 3 * fac2) * end +
+        (fac3 - fac2) * width[..., None] * end_tangent
+    )
+
+
+def sample_gltf_channel(path, interpolation, times, values, in_tangents, out_tangents, sample):
+    # Evaluate a sampler the way a glTF 2.0 client would, for verifying exported channels
+    last = len(times) - 1
+    start = np.clip(np.searchsorted(times, sample, side='right') - 1, 0, last)
+    end = np.minimum(start + 1, last)
+    width = times[end] - times[start]
+    fac = np.clip((sample - times[start]) / np.where(width == 0.0, 1.0, width), 0.0, 1.0)
+
+    if interpolation == 'STEP':
+        return values[start]
+    if interpolation == 'CUBICSPLINE':
+        result = _hermite(
+            values[start], values[end], out_tangents[start], in_tangents[end], fac, width
         )
-        return False
+        if path == 'rotation':
+            result = _normalize_quats(result)
+        return result
+    return _interpolate_channel(path, values[start], values[end], fac)
 
-    return True
 
+def _handle_slopes(handles, points):
+    width = handles[:, 0] - points[:, 0]
+    slopes = (handles[:, 1] - points[:, 1]) / np.where(width == 0.0, 1.0, width)
+    return np.where(width == 0.0, 0.0, slopes)
 
-def export_texture(state, texture):
-    # Generate sampler for this texture
-    gltf_sampler = {
-        'name': texture.name.replace('texture_', 'textures_'),
-    }
 
-    # Handle wrapS and wrapT
-    if texture.extension in ('REPEAT', 'CHECKER', 'EXTEND'):
-        if texture.use_mirror_x:
-            gltf_sampler['wrapS'] = GL_MIRRORED_REPEAT
-        else:
-            gltf_sampler['wrapS'] = GL_REPEAT
+_NATIVE_PROPS = {
+    'translation': ('location', 'delta_location'),
+    'rotation': ('rotation_quaternion', 'delta_rotation_quaternion'),
+    'scale': ('scale', 'delta_scale'),
+}
 
-        if texture.use_mirror_y:
-            gltf_sampler['wrapT'] = GL_MIRRORED_REPEAT
-        else:
-            gltf_sampler['wrapT'] = GL_REPEAT
-    elif texture.extension in ('CLIP', 'CLIP_CUBE'):
-        gltf_sampler['wrapS'] = GL_CLAMP_TO_EDGE
-        gltf_sampler['wrapT'] = GL_CLAMP_TO_EDGE
+
+def _get_native_channel(obj, target, owner, curves, path, tolerance):
+    prop, delta_prop = _NATIVE_PROPS[path]
+    if path == 'rotation' and owner.rotation_mode != 'QUATERNION':
+        return None
+
+    def is_keyed(fcurve):
+        return not fcurve.mute and fcurve.keyframe_points
+
+    keyed = [fcurve for fcurve in curves.get((target, prop), []) if is_keyed(fcurve)]
+    if not keyed:
+        return None
+    if target is None and any(is_keyed(c) for c in curves.get((None, delta_prop), [])):
+        return None
+
+    # The rest transform has to be rigid for channels to map linearly onto the node
+    rest = _get_rest_matrix(obj, target)
+    rest_rotation = rest[:3, :3]
+    if not np.allclose(np.dot(rest_rotation.T, rest_rotation), np.identity(3), atol=1e-5):
+        return None
+    if np.linalg.det(rest_rotation) < 0.0:
+        return None
+
+    static = np.array(getattr(owner, prop), dtype=np.float64)
+    width = len(static)
+    keys = {}
+    for fcurve in keyed:
+        if fcurve.array_index < width:
+            keys[fcurve.array_index] = FCurveKeys(fcurve)
+
+    # All components need the same key times, and glTF samplers clamp instead of extrapolating
+    first = next(iter(keys.values()))
+    frames = first.co[:, 0]
+    for component in keys.values():
+        if component.extrapolation != 'CONSTANT' or not np.array_equal(component.co[:, 0], frames):
+            return None
+    if len(frames) > 1 and np.any(np.diff(frames) <= 0.0):
+        return None
+
+    segments = np.concatenate([component.interpolation[:-1] for component in keys.values()])
+    constant = segments == ANIMATION_INTERPOLATIONS.index('CONSTANT')
+    linear = segments == ANIMATION_INTERPOLATIONS.index('LINEAR')
+    if len(segments) == 0 or np.all(linear):
+        interpolation = 'LINEAR'
+    elif np.all(constant):
+        interpolation = 'STEP'
+    elif np.any(constant):
+        return None
     else:
-        print('Warning: Unknown texture extension option:', texture.extension)
+        interpolation = 'CUBICSPLINE'
+
+    values = np.tile(static, (len(frames), 1))
+    in_tangents = np.zeros(values.shape)
+    out_tangents = np.zeros(values.shape)
+    for index, component in keys.items():
+        co_x, co_y = component.co[:, 0], component.co[:, 1]
+        values[:, index] = co_y
+        if len(frames) < 2:
+            continue
 
-    # Handle minFilter and magFilter
-    if texture.use_mipmap:
-        gltf_sampler['minFilter'] = GL_LINEAR_MIPMAP_LINEAR
-        gltf_sampler['magFilter'] = GL_LINEAR
+        slope = np.diff(co_y) / np.diff(co_x)
+        bezier = component.interpolation[:-1] == ANIMATION_INTERPOLATIONS.index('BEZIER')
+        right = _handle_slopes(component.handle_right[:-1], component.co[:-1])
+        left = _handle_slopes(component.handle_left[1:], component.co[1:])
+        out_tangents[:-1, index] = np.where(bezier, right, slope)
+        in_tangents[1:, index] = np.where(bezier, left, slope)
+
+    # Map the Blender channel onto the glTF node through the rest and delta transforms
+    if path == 'translation':
+        offset = rest[:3, 3]
+        linear_map = rest_rotation
+        if target is None:
+            offset = offset + np.dot(rest_rotation, owner.delta_location)
+    elif path == 'rotation':
+        values, in_tangents, out_tangents = [
+            np.roll(i, -1, axis=-1) for i in (values, in_tangents, out_tangents)
+        ]
+        quat = _matrix_to_quat(rest_rotation)
+        if target is None:
+            delta = np.roll(np.array(owner.delta_rotation_quaternion, dtype=np.float64), -1)
+            quat = _quat_multiply(quat, _normalize_quats(delta))
+        offset = np.zeros(4)
+        linear_map = _quat_left_matrix(quat)
     else:
-        gltf_sampler['minFilter'] = GL_NEAREST
-        gltf_sampler['magFilter'] = GL_NEAREST
+        offset = np.zeros(3)
+        linear_map = np.identity(3)
+        if target is None:
+            linear_map = np.diag(owner.delta_scale)
+
+    values = np.dot(values, linear_map.T) + offset
+    in_tangents = np.dot(in_tangents, linear_map.T)
+    out_tangents = np.dot(out_tangents, linear_map.T)
+
+    # Compare against Blender's own evaluation, Bezier timing can differ from Hermite splines
+    sample = np.linspace(frames[0], frames[-1], max(2, int((frames[-1] - frames[0]) * 4) + 1))
+    expected = np.tile(static, (len(sample), 1))
+    for index, component in keys.items():
+        expected[:, index] = component.evaluate(sample)
+    if path == 'rotation':
+        expected = _normalize_quats(np.roll(expected, -1, axis=-1))
+    expected = np.dot(expected, linear_map.T) + offset
+    actual = sample_gltf_channel(
+        path, interpolation, frames, values, in_tangents, out_tangents, sample
+    )
+    if np.any(_channel_error(path, expected, actual) > tolerance):
+        return None
 
-    gltf_texture = {
-        'name': texture.name,
-    }
+    if path == 'rotation' and interpolation != 'CUBICSPLINE':
+        values = align_quats(_normalize_quats(values))
 
-    state['input']['samplers'].append(SimpleID(texture.name))
-    state['samplers'].append(gltf_sampler)
+    return frames, values, in_tangents, out_tangents, interpolation
 
-    gltf_texture['sampler'] = Reference('samplers', texture.name, gltf_texture, 'sampler')
-    state['references'].append(gltf_texture['sampler'])
 
-    gltf_texture['source'] = Reference('images', texture.image.name, gltf_texture, 'source')
-    state['references'].append(gltf_texture['source'])
+def native_animation_channels(state, obj, action):
+    # Returns an OrderedDict mapping targets to OrderedDicts of path -> (key frames relative
+    # to the action start, values, interpolation) for channels that do not need baking.
+    # CUBICSPLINE values hold (in tangent, value, out tangent) triplets per key.
+    frame_start = int(action.frame_range[0])
+    tolerances = _get_animation_tolerances(state['settings'])
 
-    tformat = None
-    channels = texture.image.channels
-    image_is_srgb = texture.image.colorspace_settings.name == 'sRGB'
-    use_srgb = state['settings']['images_allow_srgb'] and image_is_srgb
+    curves = {}
+    for fcurve in action.fcurves:
+        curves.setdefault(_split_data_path(fcurve.data_path), []).append(fcurve)
+    fallback = _get_fallback_targets(obj, curves, set(target for target, _ in curves))
 
-    if state['version'] < Version('2.0'):
-        if channels == 3:
-            if use_srgb:
-                tformat = GL_SRGB
-            else:
-                tformat = GL_RGB
-        elif channels == 4:
-            if use_srgb:
-                tformat = GL_SRGB_ALPHA
-            else:
-                tformat = GL_RGBA
+    owners = [(None, obj)]
+    if obj.type == 'ARMATURE':
+        owners.extend((pbone.name, pbone) for pbone in obj.pose.bones)
 
-        gltf_texture['format'] = gltf_texture['internalFormat'] = tformat
+    native = collections.OrderedDict()
+    for target, owner in owners:
+        if target in fallback:
+            continue
+        for path in ('translation', 'rotation', 'scale'):
+            channel = _get_native_channel(obj, target, owner, curves, path, tolerances[path])
+            if channel is None:
+                continue
 
-    return gltf_texture
+            frames, values, in_tangents, out_tangents, interpolation = channel
+            if frames[0] < frame_start:
+                continue
+            if interpolation == 'CUBICSPLINE':
+                # glTF tangents are per second rather than per frame
+                dt = state['animation_dt']
+                values = np.stack((in_tangents / dt, values, out_tangents / dt), axis=1)
+                values = values.reshape(-1, values.shape[-1])
+            native.setdefault(target, collections.OrderedDict())[path] = (
+                frames - frame_start, values, interpolation
+            )
+
+    return native
+
+
+def reduce_animation_channels(state, jobs, baked, native=None):
+    # Returns per job OrderedDicts mapping targets to OrderedDicts of path -> (key frames,
+    # values, interpolation), using native channels where available instead of baked ones.
+    # Channels that are constant in every action are moved to state['node_overrides']. Actions
+    # that leave a target out play it in its exported pose, so such channels are kept.
+    tolerances = _get_animation_tolerances(state['settings'])
+    reduce = state['settings']['animations_reduce_keyframes']
+    if native is None:
+        native = [{} for _ in jobs]
+
+    job_counts = collections.Counter(obj.name for obj, _ in jobs)
+    key_objects = {}
+    reduced = []
+    constants = collections.OrderedDict()
+    for (obj, _), channels, job_native in zip(jobs, baked, native):
+        job_channels = collections.OrderedDict()
+        targets = list(channels) + [target for target in job_native if target not in channels]
+        for target in targets:
+            target_channels = collections.OrderedDict()
+            target_native = job_native.get(target, {})
+            paths = channels.get(target, {})
+            for path in ('translation', 'rotation', 'scale'):
+                key = (_get_target_name(obj, target), path)
+                key_objects[key] = obj.name
+                if path in target_native:
+                    target_channels[path] = target_native[path]
+                    constants[key] = None
+                    continue
+                if path not in paths:
+                    continue
+                frames, values = paths[path]
+                if reduce and len(frames) == 1 and constants.get(key, True) is not None:
+                    constants.setdefault(key, []).append(values[0])
+                else:
+                    constants[key] = None
+                target_channels[path] = (frames, values, 'LINEAR')
+            job_channels[target] = target_channels
+        reduced.append(job_channels)
+
+    collapsed = set()
+    for (name, path), values in constants.items():
+        if values is None or len(values) < job_counts[key_objects[(name, path)]]:
+            continue
+        if np.all(_channel_error(path, values[0], np.array(values)) <= tolerances[path]):
+            overrides = state['node_overrides'].setdefault(name, {})
+            overrides[path] = [float(i) for i in values[0]]
+            collapsed.add((name, path))
+
+    for (obj, _), job_channels in zip(jobs, reduced):
+        for target, target_channels in job_channels.items():
+            name = _get_target_name(obj, target)
+            for path in list(target_channels):
+                if (name, path) in collapsed:
+                    del target_channels[path]
+
+    return reduced
 
 
 def _can_object_use_action(obj, action):
@@ -1372,183 +4594,241 @@ def _can_object_use_action(obj, action):
     return False
 
 
-def export_animations(state, actions):
-    def export_animation(obj, action):
-        if state['version'] < Version('2.0'):
-            target_key = 'id'
-        else:
-            target_key = 'node'
+def get_action_clips(state, action):
+    # Returns (name, first frame, last frame) per clip, relative to the start of the action.
+    # Each marker starts a clip that ends at the next marker or the end of the action.
+    frame_start = int(action.frame_range[0])
+    frame_end = int(action.frame_range[1])
+    whole_action = [(action.name, 0, action.frame_range[1] - frame_start)]
+
+    setting = state['settings']['animations_split_markers']
+    if setting == 'POSE':
+        markers = action.pose_markers
+    elif setting == 'TIMELINE':
+        markers = bpy.context.scene.timeline_markers
+    else:
+        return whole_action
 
-        channels = {}
+    markers = sorted(
+        (marker.frame, marker.name) for marker in markers
+        if frame_start <= marker.frame <= frame_end
+    )
+    clips = []
+    for i, (frame, name) in enumerate(markers):
+        end = markers[i + 1][0] if i + 1 < len(markers) else frame_end
+        if end > frame:
+            clips.append((name, frame - frame_start, end - frame_start))
 
-        sce = bpy.context.scene
-        prev_frame = sce.frame_current
-        prev_action = obj.animation_data.action
+    return clips or whole_action
 
-        frame_start, frame_end = [int(x) for x in action.frame_range]
-        num_frames = frame_end - frame_start + 1
-        obj.animation_data.action = action
 
-        channels[obj.name] = []
+def export_animations(state, actions):
+    if state['version'] < Version('2.0'):
+        target_key = 'id'
+    else:
+        target_key = 'node'
 
-        if obj.type == 'ARMATURE':
-            for pbone in obj.pose.bones:
-                channels[pbone.name] = []
+    quantize = (
+        state['settings']['animations_quantize_rotations'] and
+        state['version'] >= Version('2.0')
+    )
+    max_error = state['settings']['animations_quantization_error']
 
-        for frame in range(frame_start, frame_end + 1):
-            sce.frame_set(frame)
+    def write_tracks(obj, action, channels):
+        # Sample data is written once per action, clips reference ranges of it
+        tracks = []
+        for targetid, chan in channels.items():
+            is_bone = targetid is not None
+            if not chan:
+                continue
 
-            # Decompose here so we don't store a reference the matrix
-            channels[obj.name].append(decompose(obj.matrix_local))
+            buf = Buffer('{}_{}'.format(targetid if is_bone else obj.name, action.name))
+            state['buffers'].append(buf)
+            state['input']['buffers'].append(SimpleID(buf.name))
 
-            if obj.type == 'ARMATURE':
-                for pbone in obj.pose.bones:
-                    if pbone.parent:
-                        mat = pbone.parent.matrix.inverted() * pbone.matrix
-                    else:
-                        mat = pbone.matrix
-                    channels[pbone.name].append(decompose(mat))
+            targetid = _get_target_name(obj, targetid)
+
+            for path, (frames, values, interpolation) in chan.items():
+                count, width = values.shape
+                component_type = Buffer.FLOAT
+                if quantize and path == 'rotation' and interpolation != 'CUBICSPLINE':
+                    quantized = quantize_rotations(align_quats(values), max_error)
+                    if quantized is not None:
+                        component_type, values = quantized
+                stride = width * QUANTIZED_COMPONENT_SIZES.get(component_type, 4)
+                view = buf.add_view(count * stride, stride, None)
+                tracks.append({
+                    'target': targetid,
+                    'is_bone': is_bone,
+                    'path': path,
+                    'frames': frames,
+                    'values': values,
+                    'interpolation': interpolation,
+                    'buffer': buf,
+                    'view': view,
+                    'stride': stride,
+                    'component_type': component_type,
+                })
+
+        return tracks
+
+    def export_animation(obj, action, tracks, clip):
+        clip_name, clip_start, clip_end = clip
+        name = action.name if clip_name == action.name else '{}_{}'.format(action.name, clip_name)
+        num_frames = int(clip_end - clip_start) + 1
 
         gltf_channels = []
         gltf_parameters = {}
         gltf_samplers = []
+        shared_times = []
+
+        def add_times(buf, frames, parameter_name):
+            count = len(frames)
+            is_shared = count == num_frames and np.array_equal(frames, np.arange(num_frames))
+            if is_shared:
+                # Unreduced channels share a single time accessor per clip
+                if shared_times:
+                    return shared_times[0]
+                buf = Buffer('{}_time'.format(name))
+                state['buffers'].append(buf)
+                state['input']['buffers'].append(SimpleID(buf.name))
+                parameter_name = '{}_time_parameter'.format(name)
+
+            tbv = buf.add_view(count * 1 * 4, 1 * 4, None)
+            tdata = buf.add_accessor(tbv, 0, 1 * 4, Buffer.FLOAT, count, Buffer.SCALAR)
+            tdata.set_array(frames * state['animation_dt'])
+            ref = Reference('accessors', tdata.name, gltf_parameters, parameter_name)
+            gltf_parameters[parameter_name] = ref
+            state['references'].append(ref)
 
-        tbuf = Buffer('{}_time'.format(action.name))
-        tbv = tbuf.add_view(num_frames * 1 * 4, 1 * 4, None)
-        tdata = tbuf.add_accessor(tbv, 0, 1 * 4, Buffer.FLOAT, num_frames, Buffer.SCALAR)
-        time = 0
-        for i in range(num_frames):
-            tdata[i] = time
-            time += state['animation_dt']
-        state['buffers'].append(tbuf)
-        state['input']['buffers'].append(SimpleID(tbuf.name))
-        time_parameter_name = '{}_time_parameter'.format(action.name)
-        ref = Reference('accessors', tdata.name, gltf_parameters, time_parameter_name)
-        gltf_parameters[time_parameter_name] = ref
-        state['references'].append(ref)
+            if is_shared:
+                shared_times.append((tdata, parameter_name))
+            return tdata, parameter_name
 
-        input_list = '{}_{}_samplers'.format(action.name, obj.name)
+        input_list = '{}_{}_samplers'.format(name, obj.name)
         state['input'][input_list] = []
 
         sampler_keys = []
-        for targetid, chan in channels.items():
-            buf = Buffer('{}_{}'.format(targetid, action.name))
-            lbv = buf.add_view(num_frames * 3 * 4, 3 * 4, None)
-            ldata = buf.add_accessor(lbv, 0, 3 * 4, Buffer.FLOAT, num_frames, Buffer.VEC3)
-            rbv = buf.add_view(num_frames * 4 * 4, 4 * 4, None)
-            rdata = buf.add_accessor(rbv, 0, 4 * 4, Buffer.FLOAT, num_frames, Buffer.VEC4)
-            sbv = buf.add_view(num_frames * 3 * 4, 3 * 4, None)
-            sdata = buf.add_accessor(sbv, 0, 3 * 4, Buffer.FLOAT, num_frames, Buffer.VEC3)
-
-            for i in range(num_frames):
-                loc, rot, scale = chan[i]
-                for j in range(3):
-                    ldata[(i * 3) + j] = loc[j]
-                    sdata[(i * 3) + j] = scale[j]
-                for j in range(4):
-                    rdata[(i * 4) + j] = rot[j]
-
-            state['buffers'].append(buf)
-            state['input']['buffers'].append(SimpleID(buf.name))
+        for track in tracks:
+            targetid = track['target']
+            path = track['path']
+            frames = track['frames']
+            values = track['values']
+            interpolation = track['interpolation']
+
+            # Clip boundaries are always keyed, single keys hold for the whole clip
+            if len(frames) == 1:
+                first, last = 0, 1
+                clip_frames = np.zeros(1)
+            else:
+                first = np.searchsorted(frames, clip_start, side='left')
+                last = np.searchsorted(frames, clip_end, side='right')
+                clip_frames = frames[first:last] - clip_start
+            if last <= first:
+                continue
 
-            is_bone = False
-            if targetid != obj.name:
-                is_bone = True
-                targetid = _get_bone_name(bpy.data.armatures[obj.data.name].bones[targetid])
+            sampler_name = '{}_{}_{}_sampler'.format(name, targetid, path)
+            sampler_keys.append(sampler_name)
+            parameter_name = '{}_{}_{}_parameter'.format(name, targetid, path)
+
+            elements = 3 if interpolation == 'CUBICSPLINE' else 1
+            buf = track['buffer']
+            data = buf.add_accessor(
+                track['view'],
+                int(first) * elements * track['stride'],
+                track['stride'],
+                track['component_type'],
+                int(last - first) * elements,
+                Buffer.VEC4 if values.shape[1] == 4 else Buffer.VEC3,
+                normalized=track['component_type'] != Buffer.FLOAT
+            )
+            data.set_array(values[first * elements:last * elements])
+            tdata, time_parameter_name = add_times(
+                buf,
+                clip_frames,
+                '{}_{}_{}_time_parameter'.format(name, targetid, path)
+            )
 
-            for path in ('translation', 'rotation', 'scale'):
-                sampler_name = '{}_{}_{}_sampler'.format(action.name, targetid, path)
-                sampler_keys.append(sampler_name)
-                parameter_name = '{}_{}_{}_parameter'.format(action.name, targetid, path)
-
-                gltf_channel = {
-                    'sampler': sampler_name,
-                    'target': {
-                        target_key: targetid,
-                        'path': path,
-                    }
+            gltf_channel = {
+                'sampler': sampler_name,
+                'target': {
+                    target_key: targetid,
+                    'path': path,
                 }
-                gltf_channels.append(gltf_channel)
-                id_ref = Reference(
-                    'objects' if is_bone else 'objects',
-                    targetid,
-                    gltf_channel['target'],
-                    target_key
+            }
+            gltf_channels.append(gltf_channel)
+            id_ref = Reference(
+                'objects',
+                targetid,
+                gltf_channel['target'],
+                target_key
+            )
+            state['references'].append(id_ref)
+            state['input'][input_list].append(SimpleID(sampler_name))
+            sampler_ref = Reference(input_list, sampler_name, gltf_channel, 'sampler')
+            state['references'].append(sampler_ref)
+
+            gltf_sampler = {
+                'input': None,
+                'interpolation': interpolation,
+                'output': None,
+            }
+            gltf_samplers.append(gltf_sampler)
+
+            if state['version'] < Version('2.0'):
+                gltf_sampler['input'] = time_parameter_name
+                gltf_sampler['output'] = parameter_name
+                accessor_ref = Reference(
+                    'accessors',
+                    data.name,
+                    gltf_parameters,
+                    parameter_name
                 )
-                state['references'].append(id_ref)
-                state['input'][input_list].append(SimpleID(sampler_name))
-                sampler_ref = Reference(input_list, sampler_name, gltf_channel, 'sampler')
-                state['references'].append(sampler_ref)
-
-                gltf_sampler = {
-                    'input': None,
-                    'interpolation': 'LINEAR',
-                    'output': None,
-                }
-                gltf_samplers.append(gltf_sampler)
-
-                accessor_name = {
-                    'translation': ldata.name,
-                    'rotation': rdata.name,
-                    'scale': sdata.name,
-                }[path]
-
-                if state['version'] < Version('2.0'):
-                    gltf_sampler['input'] = time_parameter_name
-                    gltf_sampler['output'] = parameter_name
-                    accessor_ref = Reference(
-                        'accessors',
-                        accessor_name,
-                        gltf_parameters,
-                        parameter_name
-                    )
-                    gltf_parameters[parameter_name] = accessor_ref
-                else:
-                    time_ref = Reference(
-                        'accessors',
-                        tdata.name,
-                        gltf_sampler,
-                        'input'
-                    )
-                    gltf_sampler['input'] = time_ref
-                    state['references'].append(time_ref)
-                    accessor_ref = Reference(
-                        'accessors',
-                        accessor_name,
-                        gltf_sampler,
-                        'output'
-                    )
-                    gltf_sampler['output'] = accessor_ref
-
-                state['references'].append(accessor_ref)
+                gltf_parameters[parameter_name] = accessor_ref
+            else:
+                time_ref = Reference(
+                    'accessors',
+                    tdata.name,
+                    gltf_sampler,
+                    'input'
+                )
+                gltf_sampler['input'] = time_ref
+                state['references'].append(time_ref)
+                accessor_ref = Reference(
+                    'accessors',
+                    data.name,
+                    gltf_sampler,
+                    'output'
+                )
+                gltf_sampler['output'] = accessor_ref
+
+            state['references'].append(accessor_ref)
 
         gltf_action = {
-            'name': action.name,
+            'name': clip_name,
             'channels': gltf_channels,
             'samplers': gltf_samplers,
         }
 
         if state['version'] < Version('2.0'):
+            gltf_action['name'] = name
             gltf_action['samplers'] = {
                 '{}_{}'.format(input_list, i[0]): i[1]
                 for i in zip(sampler_keys, gltf_action['samplers'])
             }
             gltf_action['parameters'] = gltf_parameters
 
-        sce.frame_set(prev_frame)
-        obj.animation_data.action = prev_action
-
         return gltf_action
 
     armature_objects = [obj for obj in state['input']['objects'] if obj.type == 'ARMATURE']
     regular_objects = [obj for obj in state['input']['objects'] if obj.type != 'ARMATURE']
 
-    gltf_actions = []
+    jobs = []
 
     def export_eligible(objects):
         for obj in objects:
-            gltf_actions.extend([
-                export_animation(obj, action)
+            jobs.extend([
+                (obj, action)
                 for action in actions
                 if _can_object_use_action(obj, action)
             ])
@@ -1556,7 +4836,7 @@ def export_animations(state, actions):
     def export_active(objects):
         for obj in objects:
             if obj.animation_data and obj.animation_data.action:
-                gltf_actions.append(export_animation(obj, obj.animation_data.action))
+                jobs.append((obj, obj.animation_data.action))
 
     armature_setting = state['settings']['animations_armature_export']
     object_setting = state['settings']['animations_object_export']
@@ -1581,6 +4861,29 @@ def export_animations(state, actions):
             '{}'.format(object_setting)
         )
 
+    clips = [get_action_clips(state, action) for _, action in jobs]
+
+    # Native keyframes rarely land on clip boundaries, so split actions are always baked
+    native = None
+    if state['settings']['animations_native_keyframes'] and state['version'] >= Version('2.0'):
+        native = [
+            native_animation_channels(state, obj, action) if len(job_clips) == 1 else {}
+            for (obj, action), job_clips in zip(jobs, clips)
+        ]
+    breakpoints = [
+        [int(frame) for clip in job_clips for frame in clip[1:]] if len(job_clips) > 1 else []
+        for job_clips in clips
+    ]
+    baked = bake_actions(state, jobs, breakpoints, native)
+    channels = reduce_animation_channels(state, jobs, baked, native)
+
+    gltf_actions = []
+    for (obj, action), job_channels, job_clips in zip(jobs, channels, clips):
+        tracks = write_tracks(obj, action, job_channels)
+        if not tracks:
+            continue
+        gltf_actions.extend(export_animation(obj, action, tracks, clip) for clip in job_clips)
+
     return gltf_actions
 
 
@@ -1602,6 +4905,45 @@ def insert_root_nodes(state, root_matrix):
         state['references'].append(scene['nodes'][0])
 
 
+def _get_rna_signature(data):
+    # Returns a hashable snapshot of the RNA properties of a struct, with pointers by name
+    values = []
+    for prop in data.bl_rna.properties:
+        if prop.identifier in ('rna_type', 'name') or prop.type == 'COLLECTION':
+            continue
+        value = getattr(data, prop.identifier, None)
+        if prop.type == 'POINTER':
+            value = getattr(value, 'name', None)
+        elif getattr(prop, 'is_enum_flag', False):
+            value = tuple(sorted(value))
+        elif getattr(prop, 'is_array', False):
+            value = tuple(np.array(value).ravel().tolist())
+        values.append((prop.identifier, value))
+    return tuple(values)
+
+
+def _get_modifier_signature(obj):
+    # Objects with the same mesh and signature evaluate to the same mesh. Vertex groups and
+    # material slots are matched by position, and modifiers that use other objects depend
+    # on where the object is relative to them.
+    modifiers = tuple(_get_rna_signature(modifier) for modifier in obj.modifiers)
+    signature = (
+        obj.data.name,
+        modifiers,
+        tuple(group.name for group in obj.vertex_groups),
+        tuple(slot.material.name if slot.material else None for slot in obj.material_slots),
+    )
+    uses_objects = any(
+        prop.type == 'POINTER' and prop.fixed_type.identifier == 'Object' and
+        getattr(modifier, prop.identifier, None) is not None
+        for modifier in obj.modifiers
+        for prop in modifier.bl_rna.properties
+    )
+    if uses_objects:
+        signature += (tuple(np.round(np.array(obj.matrix_world), 6).ravel().tolist()),)
+    return signature
+
+
 def build_string_refmap(input_data):
     in_out_map = {
         'objects': 'nodes',
@@ -1639,8 +4981,17 @@ def export_gltf(scene_delta, settings=None):
         'mod_meshes': {},
         'shape_keys': {},
         'skinned_meshes': {},
+        'skin_palettes': {},
+        'skin_partitions': {},
+        'partition_meshes': collections.OrderedDict(),
+        'gpu_instances': collections.OrderedDict(),
+        'gpu_dupli_groups': set(),
+        'static_batches': [],
+        'flattened_nodes': set(),
+        'mesh_transforms': {},
         'dupli_nodes': [],
         'extensions_used': [],
+        'extensions_required': [],
         'gl_extensions_used': [],
         'buffers': [],
         'samplers': [],
@@ -1661,97 +5012,132 @@ def export_gltf(scene_delta, settings=None):
             'extensions': [],
         },
         'references': [],
+        'aliases': {},
+        'node_overrides': {},
+        'ktx2_images': collections.OrderedDict(),
+        'image_cache': None,
+        'file_copies': collections.OrderedDict(),
+        'image_alpha': {},
+        'alpha_images': set(),
+        'atlas': {
+            'sources': {},
+            'uv_transforms': {},
+            'texture_transforms': {},
+        },
         'files': {},
     }
     state['input'].update({key: list(value) for key, value in scene_delta.items()})
 
-    # Make sure any temporary meshes do not have animation data baked in
-    default_scene = bpy.context.scene
-    saved_pose_positions = [armature.pose_position for armature in bpy.data.armatures]
-    for armature in bpy.data.armatures:
-        armature.pose_position = 'REST'
-    if saved_pose_positions:
-        for obj in bpy.data.objects:
-            if obj.type == 'ARMATURE':
-                obj.update_tag()
-    default_scene.frame_set(default_scene.frame_current)
+    if settings['images_cache_dir']:
+        state['image_cache'] = ImageCache(
+            bpy.path.abspath(settings['images_cache_dir']),
+            settings['images_cache_max_size'] * 1024 * 1024
+        )
 
+    default_scene = bpy.context.scene
+    meshes = scene_delta.get('meshes', [])
     mesh_list = []
     mod_obs = [
         ob for ob in state['input']['objects']
         if [mod for mod in ob.modifiers if mod.type != 'ARMATURE']
     ]
-    for mesh in scene_delta.get('meshes', []):
-
-        # Mute shape keys
-        if mesh.shape_keys and mesh.shape_keys.use_relative:
+    evaluated_meshes = collections.OrderedDict()
+    reused_meshes = 0
+    with SceneOverrides(default_scene) as overrides:
+        # Make sure any temporary meshes do not have animation data baked in
+        for armature in bpy.data.armatures:
+            overrides.set(armature, 'pose_position', 'REST')
+
+        # Mute shape keys, and modifiers of their users if modifiers are not applied
+        shape_keys = {}
+        for mesh in meshes:
+            if not mesh.shape_keys or not mesh.shape_keys.use_relative:
+                continue
             keys = [key for key in mesh.shape_keys.key_blocks if key != key.relative_key]
-
-            # Gather weight values
-            weights = [key.value for key in keys]
-
-            # Clear weight values
+            shape_keys[mesh.name] = keys
             for key in keys:
-                key.value = 0.0
-
-        # Handle base mesh
-        if settings['meshes_apply_modifiers']:
-            mod_users = [ob for ob in mod_obs if ob.data == mesh]
-
-            # Only convert meshes with modifiers, otherwise each non-modifier
-            # user ends up with a copy of the mesh and we lose instancing
-            state['mod_meshes'].update(
-                {ob.name: ob.to_mesh(default_scene, True, 'PREVIEW') for ob in mod_users}
-            )
+                overrides.set(key, 'value', 0.0)
+            if not settings['meshes_apply_modifiers']:
+                for obj in state['input']['objects']:
+                    if obj.data == mesh:
+                        for modifier in obj.modifiers:
+                            overrides.set(modifier, 'show_viewport', False)
+
+        # Evaluate all overrides at once before capturing any mesh variants
+        overrides.evaluate()
+
+        for mesh in meshes:
+            # Handle base mesh
+            if settings['meshes_apply_modifiers']:
+                mod_users = [ob for ob in mod_obs if ob.data == mesh]
+
+                # Only convert meshes with modifiers, otherwise each non-modifier
+                # user ends up with a copy of the mesh and we lose instancing. Users with
+                # identical modifier stacks share one evaluated mesh for the same reason.
+                for ob in mod_users:
+                    signature = _get_modifier_signature(ob)
+                    if signature not in evaluated_meshes:
+                        evaluated_meshes[signature] = ob.to_mesh(default_scene, True, 'PREVIEW')
+                    else:
+                        reused_meshes += 1
+                    state['mod_meshes'][ob.name] = evaluated_meshes[signature]
 
-            # Add unmodified meshes directly to the mesh list
-            if len(mod_users) < mesh.users:
+                # Add unmodified meshes directly to the mesh list
+                if len(mod_users) < mesh.users:
+                    mesh_list.append(mesh)
+            else:
                 mesh_list.append(mesh)
-        else:
-            mesh_list.append(mesh)
 
-        # Handle shape keys
-        if mesh.shape_keys and mesh.shape_keys.use_relative:
-            mesh_users = [obj for obj in state['input']['objects'] if obj.data == mesh]
-
-            # Mute modifiers if necessary
-            muted_modifiers = []
-            original_modifier_states = []
-            if not settings['meshes_apply_modifiers']:
-                muted_modifiers = itertools.chain.from_iterable(
-                    [obj.modifiers for obj in mesh_users]
-                )
-                original_modifier_states = [mod.show_viewport for mod in muted_modifiers]
-                for modifier in muted_modifiers:
-                    modifier.show_viewport = False
+            # Handle shape keys
+            keys = shape_keys.get(mesh.name)
+            if keys:
+                mesh_users = [obj for obj in state['input']['objects'] if obj.data == mesh]
+                for user in mesh_users:
+                    mesh_name = state['mod_meshes'].get(user.name, mesh).name
+                    if mesh_name in state['shape_keys']:
+                        continue
+
+                    # Users without modifiers share deltas read straight from the key blocks
+                    if mesh_name == mesh.name and not any(key.vertex_group for key in keys):
+                        state['shape_keys'][mesh_name] = [
+                            (overrides.original(key, 'value'), deltas)
+                            for key, deltas in zip(keys, get_shape_key_deltas(mesh, keys))
+                        ]
+                        continue
 
-            for user in mesh_users:
-                mesh_name = state['mod_meshes'].get(user.name, mesh).name
-                if mesh_name not in state['shape_keys']:
                     key_meshes = []
-                    for key, weight in zip(keys, weights):
+                    for key in keys:
                         key.value = key.slider_max
                         key_meshes.append((
-                            weight,
+                            overrides.original(key, 'value'),
                             user.to_mesh(default_scene, True, 'PREVIEW')
                         ))
                         key.value = 0.0
                     state['shape_keys'][mesh_name] = key_meshes
 
-            # Reset weight values
-            for key, weight in zip(keys, weights):
-                key.value = weight
+    if reused_meshes:
+        print('Reused evaluated meshes for {} objects with matching modifiers'.format(
+            reused_meshes
+        ))
+    mesh_list.extend(evaluated_meshes.values())
+    state['input']['meshes'] = mesh_list
+
+    state['alpha_images'] = get_alpha_images(state)
 
-            # Unmute modifiers
-            for modifier, state in zip(muted_modifiers, original_modifier_states):
-                modifier.show_viewport = state
+    if settings['images_atlas_textures']:
+        build_texture_atlas(state)
 
-    mesh_list.extend(state['mod_meshes'].values())
-    state['input']['meshes'] = mesh_list
+    if settings['nodes_flatten_hierarchy']:
+        flatten_hierarchy(state)
 
-    # Restore armature pose positions
-    for i, armature in enumerate(bpy.data.armatures):
-        armature.pose_position = saved_pose_positions[i]
+    if settings['nodes_gpu_instancing']:
+        build_gpu_instances(state)
+
+    if settings['meshes_merge_static']:
+        build_static_batches(state)
+
+    if settings['meshes_match_transformed']:
+        build_mesh_instances(state)
 
     exporter = collections.namedtuple('exporter', [
         'gltf_key',
@@ -1791,6 +5177,19 @@ def export_gltf(scene_delta, settings=None):
         ] for exporter in exporters
     }
 
+    # Skin partitions go after all other meshes so mesh indices stay aligned
+    state['output']['meshes'].extend(state['partition_meshes'].values())
+    state['input']['meshes'].extend(SimpleID(name) for name in state['partition_meshes'])
+
+    # KTX2 variants go after all other images so image indices stay aligned
+    state['output']['images'].extend(state['ktx2_images'].values())
+    state['input']['images'].extend(
+        SimpleID(gltf['name']) for gltf in state['ktx2_images'].values()
+    )
+
+    export_gpu_instances(state)
+    export_static_batches(state)
+
     # Export top level data
     gltf = {
         'asset': {
@@ -1806,6 +5205,7 @@ def export_gltf(scene_delta, settings=None):
     # Export animations
     state['output']['animations'] = export_animations(state, scene_delta.get('actions', []))
     state['output']['skins'] = export_skins(state)
+    export_skin_partition_nodes(state)
     state['output']['nodes'].extend([
         export_joint(state, sid.data) for sid in state['input']['bones']
     ])
@@ -1814,11 +5214,19 @@ def export_gltf(scene_delta, settings=None):
     state['input']['objects'].extend(state['input']['bones'])
     state['input']['bones'] = []
 
+    # Constant animation channels are stored on the nodes themselves
+    for obj, node in zip(state['input']['objects'], state['output']['nodes']):
+        node.update(state['node_overrides'].get(obj.name, {}))
+
     # Export dupli-groups
     state['output']['nodes'].extend(state['dupli_nodes'])
     state['input']['objects'].extend(state['input']['dupli_ids'])
     state['input']['dupli_ids'] = []
 
+    if settings['nodes_bounding_volumes']:
+        for i in range(len(state['output']['scenes'])):
+            export_scene_bvh(state, i)
+
     # Export extensions
     state['refmap'] = build_int_refmap(state['input'])
     for ext_exporter in settings['extension_exporters']:
@@ -1828,6 +5236,8 @@ def export_gltf(scene_delta, settings=None):
     state['output'] = {key: value for key, value in state['output'].items() if value != []}
     if state['extensions_used']:
         gltf.update({'extensionsUsed': state['extensions_used']})
+    if state['extensions_required']:
+        gltf.update({'extensionsRequired': state['extensions_required']})
     if state['version'] < Version('2.0'):
         gltf.update({'glExtensionsUsed': state['gl_extensions_used']})
 
@@ -1852,7 +5262,9 @@ def export_gltf(scene_delta, settings=None):
         refmap = build_int_refmap(state['input'])
         ref_default = -1
     for ref in state['references']:
-        ref.source[ref.prop] = refmap.get((ref.blender_type, ref.blender_name), ref_default)
+        key = (ref.blender_type, ref.blender_name)
+        key = state['aliases'].get(key, key)
+        ref.source[ref.prop] = refmap.get(key, ref_default)
         if ref.source[ref.prop] == ref_default:
             print(
                 'Warning: {} contains an invalid reference to {}'
@@ -1863,8 +5275,10 @@ def export_gltf(scene_delta, settings=None):
     shape_key_meshes = [
         shape_key_pair[1] for shape_key_pair
         in itertools.chain.from_iterable(state['shape_keys'].values())
+        if not isinstance(shape_key_pair[1], ShapeKeyDeltas)
     ]
-    for mesh in itertools.chain(state['mod_meshes'].values(), shape_key_meshes):
+    evaluated_meshes = {mesh.name: mesh for mesh in state['mod_meshes'].values()}
+    for mesh in itertools.chain(evaluated_meshes.values(), shape_key_meshes):
         bpy.data.meshes.remove(mesh)
 
     # Transform gltf data to binary
@@ -1909,5 +5323,14 @@ def export_gltf(scene_delta, settings=None):
     for path, data in state['files'].items():
         with open(path, 'wb') as fout:
             fout.write(data)
+    for path, source in state['file_copies'].items():
+        copy_file(source, path, settings['images_link_copies'])
+
+    if state['image_cache'] is not None:
+        state['image_cache'].evict()
+        print('Image cache: {} hits, {} misses'.format(
+            state['image_cache'].hits,
+            state['image_cache'].misses
+        ))
 
     return gltf
@@ -31,8 +31,17 @@ def state():
         'mod_meshes': {},
         'shape_keys': {},
         'skinned_meshes': {},
+        'skin_palettes': {},
+        'skin_partitions': {},
+        'partition_meshes': {},
+        'gpu_instances': {},
+        'gpu_dupli_groups': set(),
+        'static_batches': [],
+        'flattened_nodes': set(),
+        'mesh_transforms': {},
         'dupli_nodes': [],
         'extensions_used': [],
+        'extensions_required': [],
         'gl_extensions_used': [],
         'buffers': [],
         'samplers': [],
@@ -60,6 +69,18 @@ def state():
             'extensions': [],
         },
         'references': [],
+        'aliases': {},
+        'node_overrides': {},
+        'ktx2_images': {},
+        'image_cache': None,
+        'file_copies': {},
+        'image_alpha': {},
+        'alpha_images': set(),
+        'atlas': {
+            'sources': {},
+            'uv_transforms': {},
+            'texture_transforms': {},
+        },
         'files': {},
     }
 
@@ -0,0 +1,460 @@
+import collections
+import math
+
+import numpy as np
+
+
+class FakeKeyframePoints(list):
+    def foreach_get(self, attr, values):
+        values[:] = [i for point in self for i in getattr(point, attr)]
+
+
+class FakeKeyframe:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, co, handle_left=None, handle_right=None, interpolation='BEZIER'):
+        self.co = co
+        self.handle_left = handle_left or co
+        self.handle_right = handle_right or co
+        self.interpolation = interpolation
+
+
+def make_fcurve(mocker, points, extrapolation='CONSTANT'):
+    fcurve = mocker.MagicMock()
+    fcurve.keyframe_points = FakeKeyframePoints(points)
+    fcurve.extrapolation = extrapolation
+    fcurve.modifiers = []
+    return fcurve
+
+
+def test_euler_to_quat(blendergltf):
+    # pylint: disable=protected-access
+    angles = np.array([[math.pi / 2, 0.0, 0.0], [0.0, 0.0, math.pi]])
+    quats = blendergltf._euler_to_quat(angles, 'XYZ')
+
+    half = math.sqrt(0.5)
+    assert np.allclose(quats[0], (half, 0.0, 0.0, half))
+    assert np.allclose(quats[1], (0.0, 0.0, 1.0, 0.0))
+
+    # XYZ applies X first, so Z is applied last in world space
+    angles = np.array([[math.pi / 2, 0.0, math.pi / 2]])
+    rotation = blendergltf._quat_to_matrix(blendergltf._euler_to_quat(angles, 'XYZ'))[0]
+    assert np.allclose(rotation.dot((0.0, 1.0, 0.0)), (0.0, 0.0, 1.0))
+
+
+def test_axis_angle_to_quat(blendergltf):
+    # pylint: disable=protected-access
+    values = np.array([[math.pi, 0.0, 0.0, 2.0], [1.0, 0.0, 0.0, 0.0]])
+    quats = blendergltf._axis_angle_to_quat(values)
+
+    assert np.allclose(quats[0], (0.0, 0.0, 1.0, 0.0))
+    assert np.allclose(quats[1], (0.0, 0.0, 0.0, 1.0))
+
+
+def test_compose_decompose_matrices(blendergltf):
+    loc = np.array([[1.0, 2.0, 3.0], [0.0, 0.0, 0.0]])
+    rot = np.array([[0.0, 0.0, math.sqrt(0.5), math.sqrt(0.5)], [1.0, 0.0, 0.0, 0.0]])
+    scale = np.array([[1.0, 2.0, 3.0], [-1.0, 1.0, 1.0]])
+
+    matrices = blendergltf.compose_matrices(loc, rot, scale)
+    assert np.allclose(matrices[0].dot((1.0, 0.0, 0.0, 1.0)), (1.0, 3.0, 3.0, 1.0))
+
+    out_loc, out_rot, out_scale = blendergltf.decompose_matrices(matrices)
+    assert np.allclose(out_loc, loc)
+    assert np.allclose(out_rot[0], rot[0])
+    assert np.allclose(out_scale[0], scale[0])
+
+    # Mirrored matrices flip every axis, like Matrix.decompose()
+    assert np.allclose(out_scale[1], (-1.0, -1.0, -1.0))
+    assert np.allclose(blendergltf.compose_matrices(out_loc, out_rot, out_scale), matrices)
+
+
+def test_fcurve_keys_linear_constant(blendergltf, mocker):
+    fcurve = make_fcurve(mocker, [
+        FakeKeyframe((1.0, 0.0), interpolation='LINEAR'),
+        FakeKeyframe((5.0, 4.0), interpolation='CONSTANT'),
+        FakeKeyframe((9.0, -1.0), interpolation='LINEAR'),
+    ])
+    keys = blendergltf.FCurveKeys(fcurve)
+
+    values = keys.evaluate([0.0, 1.0, 2.0, 5.0, 8.0, 9.0, 10.0])
+    assert np.allclose(values, [0.0, 0.0, 1.0, 4.0, 4.0, -1.0, -1.0])
+
+    keys.extrapolation = 'LINEAR'
+    values = keys.evaluate([0.0, 10.0])
+    assert np.allclose(values, [-1.0, -2.25])
+
+
+def test_fcurve_keys_bezier(blendergltf, mocker):
+    # Handles a third of the way along a straight line make the curve linear
+    fcurve = make_fcurve(mocker, [
+        FakeKeyframe((0.0, 0.0), (-1.0, -2.0), (1.0, 2.0)),
+        FakeKeyframe((3.0, 6.0), (2.0, 4.0), (4.0, 8.0)),
+    ], 'LINEAR')
+    keys = blendergltf.FCurveKeys(fcurve)
+
+    frames = np.linspace(-1.0, 4.0, 11)
+    assert np.allclose(keys.evaluate(frames), frames * 2.0)
+
+    # Flat handles ease in and out symmetrically, and overlong handles are clamped
+    fcurve = make_fcurve(mocker, [
+        FakeKeyframe((0.0, 0.0), (-1.0, 0.0), (10.0, 0.0)),
+        FakeKeyframe((2.0, 1.0), (-8.0, 1.0), (3.0, 1.0)),
+    ])
+    keys = blendergltf.FCurveKeys(fcurve)
+
+    values = keys.evaluate([0.5, 1.0, 1.5])
+    assert np.isclose(values[1], 0.5)
+    assert np.isclose(values[0] + values[2], 1.0)
+    assert 0.0 < values[0] < 0.25
+
+
+def test_accessor_set_array(blendergltf):
+    buf = blendergltf.Buffer('test')
+    view = buf.add_view(4 * 3 * 4, 3 * 4, None)
+    accessor = buf.add_accessor(
+        view, 0, 3 * 4, blendergltf.Buffer.FLOAT, 4, blendergltf.Buffer.VEC3
+    )
+
+    values = np.arange(12, dtype=np.float64).reshape(4, 3) - 2.0
+    accessor.set_array(values)
+
+    assert [accessor[i] for i in range(12)] == list(values.flatten())
+    assert accessor.min[:3] == [-2.0, -1.0, 0.0]
+    assert accessor.max[:3] == [7.0, 8.0, 9.0]
+
+
+def test_schedule_sweeps(blendergltf):
+    # pylint: disable=protected-access
+    obj_a, obj_b = object(), object()
+    jobs = [
+        (0, (1, 10), obj_a, 'walk', [None]),
+        (1, (1, 10), obj_a, 'run', [None]),
+        (2, (1, 10), obj_b, 'walk', [None]),
+        (3, (1, 20), obj_b, 'idle', [None]),
+    ]
+    sweeps = blendergltf._schedule_sweeps(jobs)
+
+    assert [(frame_range, [job[0] for job in sweep]) for frame_range, sweep in sweeps] == [
+        ((1, 10), [0, 2]),
+        ((1, 10), [1]),
+        ((1, 20), [3]),
+    ]
+
+
+class FakeDependent:
+    def __init__(self, parent=None, constraint_target=None):
+        self.parent = parent
+        self.constraints = [FakeConstraint(constraint_target)] if constraint_target else []
+        self.modifiers = []
+        self.animation_data = None
+
+
+class FakeConstraint:
+    def __init__(self, target):
+        self.target = target
+
+
+def test_schedule_sweeps_dependencies(blendergltf):
+    # pylint: disable=protected-access
+    parent = FakeDependent()
+    child = FakeDependent(parent=parent)
+    grandchild = FakeDependent(parent=child)
+    tracker = FakeDependent(constraint_target=grandchild)
+    unrelated = FakeDependent()
+    jobs = [
+        (0, (1, 10), parent, 'walk', [None]),
+        (1, (1, 10), tracker, 'walk', [None]),
+        (2, (1, 10), child, 'walk', [None]),
+        (3, (1, 10), unrelated, 'walk', [None]),
+    ]
+    sweeps = blendergltf._schedule_sweeps(jobs)
+
+    assert [[job[0] for job in sweep] for _, sweep in sweeps] == [[0, 3], [1], [2]]
+
+
+def test_reduce_keyframes(blendergltf):
+    values = np.zeros((9, 3))
+    values[:5, 0] = np.arange(5)
+    values[5:, 0] = 4.0 - np.arange(1, 5) * 0.5
+
+    indices = blendergltf.reduce_keyframes('translation', values, 0.0001)
+    assert list(indices) == [0, 4, 8]
+
+    values[2, 1] = 0.001
+    indices = blendergltf.reduce_keyframes('translation', values, 0.0001)
+    assert list(indices) == [0, 1, 2, 3, 4, 8]
+
+    assert list(blendergltf.reduce_keyframes('scale', np.ones((5, 3)), 0.0001)) == [0]
+
+
+def test_reduce_keyframes_rotation(blendergltf):
+    # A constant speed spin about Z is reproduced by slerp, even across hemispheres
+    angles = np.linspace(0.0, 0.9 * math.pi, 7)
+    quats = np.zeros((7, 4))
+    quats[:, 2] = np.sin(angles / 2.0)
+    quats[:, 3] = np.cos(angles / 2.0)
+    quats[4:] *= -1.0
+
+    aligned = blendergltf.align_quats(quats)
+    assert np.all(np.sum(aligned[1:] * aligned[:-1], axis=-1) > 0.0)
+    assert list(blendergltf.reduce_keyframes('rotation', aligned, 0.001)) == [0, 6]
+
+
+def test_reduce_animation_channels(blendergltf, state, mocker):
+    state['settings'] = dict(state['settings'], animations_reduce_keyframes=True)
+    obj = mocker.MagicMock()
+    obj.name = 'Cube'
+
+    def trs(loc_x, scale):
+        loc = np.zeros((3, 3))
+        loc[:, 0] = loc_x
+        rot = np.tile((0.0, 0.0, 0.0, 1.0), (3, 1))
+        paths = collections.OrderedDict()
+        for path, values in zip(('translation', 'rotation', 'scale'), (loc, rot, scale)):
+            sink = blendergltf.ChannelSink(path, 3, 0.001)
+            sink.write(values if path != 'scale' else np.full((3, 3), values))
+            paths[path] = sink.finish()
+        return collections.OrderedDict([(None, paths)])
+
+    jobs = [(obj, 'a'), (obj, 'b')]
+    reduced = blendergltf.reduce_animation_channels(
+        state, jobs, [trs([0.0, 1.0, 2.0], 1.0), trs(0.0, 2.0)]
+    )
+
+    # Rotation is identical everywhere so it is only stored on the node
+    assert state['node_overrides'] == {'Cube': {'rotation': [0.0, 0.0, 0.0, 1.0]}}
+    assert list(reduced[0][None]) == ['translation', 'scale']
+    assert list(reduced[0][None]['translation'][0]) == [0, 2]
+    assert list(reduced[1][None]['translation'][0]) == [0]
+    assert np.allclose(reduced[1][None]['scale'][1], [[2.0, 2.0, 2.0]])
+
+
+def test_reduce_animation_channels_partial_targets(blendergltf, state, mocker):
+    # A bone held still in one action but not keyed in another keeps its channel, so the
+    # other action still plays it in the rest pose
+    state['settings'] = dict(state['settings'], animations_reduce_keyframes=True)
+    mocker.patch.object(blendergltf, '_get_target_name', lambda obj, target: target)
+    obj = mocker.MagicMock()
+    obj.name = 'Armature'
+
+    rotation = (np.zeros(1), np.array([[0.0, 0.0, 0.7071, 0.7071]]))
+    held = collections.OrderedDict([('hand', collections.OrderedDict([('rotation', rotation)]))])
+    reduced = blendergltf.reduce_animation_channels(
+        state, [(obj, 'a'), (obj, 'b')], [held, collections.OrderedDict()]
+    )
+
+    assert not state['node_overrides']
+    assert list(reduced[0]['hand']) == ['rotation']
+    assert not reduced[1]
+
+
+def test_channel_sink_streaming(blendergltf):
+    angles = np.linspace(0.0, 3.0, 50)
+    quats = np.zeros((50, 4))
+    quats[:, 2] = np.sin(angles * angles / 2.0)
+    quats[:, 3] = np.cos(angles * angles / 2.0)
+    quats[25:] *= -1.0
+
+    sink = blendergltf.ChannelSink('rotation', 50, 0.001, breakpoints=[20])
+    for start in range(0, 50, 7):
+        sink.write(quats[start:start + 7])
+    frames, values = sink.finish()
+
+    expected = blendergltf.reduce_keyframes(
+        'rotation', blendergltf.align_quats(quats), 0.001, breakpoints=[20]
+    )
+    assert list(frames) == list(expected)
+    assert 20 in expected and expected[-1] == 49
+    assert np.all(np.sum(values[1:] * values[:-1], axis=-1) > 0.0)
+
+    # Without a tolerance every sample is kept in a preallocated array
+    sink = blendergltf.ChannelSink('rotation', 50)
+    for start in range(0, 50, 7):
+        sink.write(quats[start:start + 7])
+    frames, values = sink.finish()
+    assert len(frames) == 50 and values.dtype == np.float32
+    assert np.allclose(values, blendergltf.align_quats(quats))
+
+
+def test_evaluate_action_prunes_static_targets(blendergltf, mocker):
+    # pylint: disable=protected-access
+    obj = mocker.MagicMock()
+    obj.type = 'MESH'
+    obj.animation_data = None
+    obj.constraints = []
+    obj.parent_type = 'OBJECT'
+    obj.rigid_body = None
+    obj.parent = None
+    obj.rotation_mode = 'XYZ'
+    obj.location = obj.delta_location = obj.rotation_euler = obj.delta_rotation_euler = (0, 0, 0)
+    obj.rotation_quaternion = obj.delta_rotation_quaternion = (1, 0, 0, 0)
+    obj.rotation_axis_angle = (0, 0, 1, 0)
+    obj.scale = obj.delta_scale = (1, 1, 1)
+
+    fcurve = make_fcurve(mocker, [
+        FakeKeyframe((1.0, 0.0), interpolation='LINEAR'),
+        FakeKeyframe((3.0, 4.0), interpolation='LINEAR'),
+    ])
+    fcurve.mute = False
+    fcurve.array_index = 2
+    action = mocker.MagicMock()
+    frames = np.arange(1.0, 4.0)
+
+    fcurve.data_path = 'color'
+    action.fcurves = [fcurve]
+    evaluator = blendergltf.ActionEvaluator(obj, action)
+    assert not evaluator.targets and not evaluator.fallback
+    assert not evaluator.evaluate(frames)
+
+    fcurve.data_path = 'location'
+    evaluator = blendergltf.ActionEvaluator(obj, action)
+    assert evaluator.targets == [None] and not evaluator.fallback
+    matrices = evaluator.evaluate(frames)
+    assert np.allclose(matrices[None][:, 2, 3], [0.0, 2.0, 4.0])
+    assert np.allclose(evaluator.evaluate(frames[2:])[None][:, 2, 3], [4.0])
+
+    # Targets exported from native keyframes are not evaluated at all
+    assert not blendergltf.ActionEvaluator(obj, action, skip={None}).targets
+
+
+def test_bake_actions_skips_native_paths(blendergltf, state, mocker):
+    obj = mocker.MagicMock()
+    action = mocker.MagicMock()
+    action.frame_range = (1.0, 3.0)
+    evaluator = mocker.MagicMock(targets=[None, 'Bone'], fallback=[])
+    evaluator.evaluate.side_effect = lambda frames: collections.OrderedDict(
+        (target, np.broadcast_to(np.identity(4), (len(frames), 4, 4)))
+        for target in evaluator.targets
+    )
+    evaluator_class = mocker.patch.object(blendergltf, 'ActionEvaluator', return_value=evaluator)
+
+    native = [{
+        None: {'translation': None},
+        'Hand': {path: None for path in ('translation', 'rotation', 'scale')},
+    }]
+    baked = blendergltf.bake_actions(state, [(obj, action)], native=native)
+
+    assert evaluator_class.call_args[0][2] == {'Hand'}
+    assert list(baked[0][None]) == ['rotation', 'scale']
+    assert list(baked[0]['Bone']) == ['translation', 'rotation', 'scale']
+
+
+def test_native_channel(blendergltf, mocker):
+    # pylint: disable=protected-access
+    owner = mocker.MagicMock()
+    owner.location = (0.0, 0.0, 0.0)
+    obj = mocker.MagicMock()
+    obj.parent = None
+
+    # Evenly spaced handles map exactly onto Hermite tangents
+    x_curve = make_fcurve(mocker, [
+        FakeKeyframe((1.0, 0.0), (0.0, 0.0), (2.0, 0.0)),
+        FakeKeyframe((4.0, 3.0), (3.0, 3.0), (5.0, 3.0)),
+    ])
+    y_curve = make_fcurve(mocker, [
+        FakeKeyframe((1.0, 0.0), interpolation='LINEAR'),
+        FakeKeyframe((4.0, 6.0), interpolation='LINEAR'),
+    ])
+    curves = {(None, 'location'): [x_curve, y_curve]}
+    for i, fcurve in enumerate((x_curve, y_curve)):
+        fcurve.mute = False
+        fcurve.array_index = i
+
+    owner.delta_location = (0.0, 0.0, 1.0)
+    channel = blendergltf._get_native_channel(obj, None, owner, curves, 'translation', 0.0001)
+    frames, values, in_tangents, out_tangents, interpolation = channel
+
+    assert interpolation == 'CUBICSPLINE'
+    assert list(frames) == [1.0, 4.0]
+    assert np.allclose(values, [[0.0, 0.0, 1.0], [3.0, 6.0, 1.0]])
+    assert np.allclose(out_tangents[0], (0.0, 2.0, 0.0))
+    assert np.allclose(in_tangents[1], (0.0, 2.0, 0.0))
+
+    # Keys at different times on each axis cannot share a sampler
+    y_curve.keyframe_points[1].co = (5.0, 6.0)
+    assert blendergltf._get_native_channel(
+        obj, None, owner, curves, 'translation', 0.0001
+    ) is None
+
+
+def test_sample_gltf_channel(blendergltf):
+    times = np.array([0.0, 2.0])
+    values = np.array([[0.0], [1.0]])
+    tangents = np.zeros((2, 1))
+
+    sample = np.array([0.0, 1.0, 2.0, 3.0])
+    step = blendergltf.sample_gltf_channel('scale', 'STEP', times, values, None, None, sample)
+    assert list(step[:, 0]) == [0.0, 0.0, 1.0, 1.0]
+
+    cubic = blendergltf.sample_gltf_channel(
+        'scale', 'CUBICSPLINE', times, values, tangents, tangents, sample
+    )
+    assert np.allclose(cubic[:, 0], [0.0, 0.5, 1.0, 1.0])
+
+
+def test_quantize_rotations(blendergltf):
+    angles = np.linspace(0.0, math.pi, 5)
+    quats = np.zeros((5, 4))
+    quats[:, 0] = np.sin(angles / 2.0)
+    quats[:, 3] = np.cos(angles / 2.0)
+
+    component_type, values = blendergltf.quantize_rotations(quats, 0.02)
+    assert component_type == blendergltf.Buffer.BYTE
+    assert np.array_equal(values[0], (0, 0, 0, 127))
+
+    component_type, values = blendergltf.quantize_rotations(quats, 0.0005)
+    assert component_type == blendergltf.Buffer.SHORT
+    assert np.array_equal(values[-1], (32767, 0, 0, 0))
+
+    # Not even SHORT can hit an arbitrary rotation exactly
+    assert blendergltf.quantize_rotations(quats, 1e-9) is None
+
+
+def test_get_matrices(blendergltf):
+    class FakeCollection(list):
+        def foreach_get(self, attr, values):
+            # Blender stores matrices column major
+            values[:] = [i for item in self for i in np.array(item[attr]).T.flatten()]
+
+    matrix = np.arange(16, dtype=np.float64).reshape(4, 4)
+    matrices = blendergltf.get_matrices(FakeCollection([{'matrix': matrix}] * 2), 'matrix')
+
+    assert matrices.shape == (2, 4, 4)
+    assert np.array_equal(matrices[1], matrix)
+
+
+def test_invert_matrices(blendergltf):
+    matrices = np.tile(np.diag((2.0, 4.0, 1.0, 1.0)), (2, 1, 1))
+    assert np.allclose(blendergltf.invert_matrices(matrices)[0], np.diag((0.5, 0.25, 1.0, 1.0)))
+
+    # Zero scaled bones do not stop the whole batch from inverting
+    matrices[1, 0, 0] = 0.0
+    inverted = blendergltf.invert_matrices(matrices)
+    assert np.allclose(inverted[0], np.diag((0.5, 0.25, 1.0, 1.0)))
+    assert np.allclose(inverted[1], np.diag((0.0, 0.25, 1.0, 1.0)))
+
+
+def test_get_action_clips(blendergltf, state, mocker):
+    def marker(frame, name):
+        result = mocker.MagicMock(frame=frame)
+        result.name = name
+        return result
+
+    action = mocker.MagicMock()
+    action.name = 'Character'
+    action.frame_range = (1.0, 60.0)
+    action.pose_markers = [marker(40, 'run'), marker(10, 'walk'), marker(60, 'end')]
+
+    assert blendergltf.get_action_clips(state, action) == [('Character', 0, 59.0)]
+
+    state['settings'] = dict(state['settings'], animations_split_markers='POSE')
+    assert blendergltf.get_action_clips(state, action) == [('walk', 9, 39), ('run', 39, 59)]
+
+
+def test_reduce_keyframes_breakpoints(blendergltf):
+    values = np.zeros((9, 3))
+    values[:, 0] = np.arange(9)
+
+    assert list(blendergltf.reduce_keyframes('translation', values, 0.0001)) == [0, 8]
+    indices = blendergltf.reduce_keyframes('translation', values, 0.0001, [3, 6])
+    assert list(indices) == [0, 3, 6, 8]
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def add_accessor(blendergltf, state, name, values):
+    buf = blendergltf.Buffer(name)
+    view = buf.add_view(len(values) * 4, 4, None)
+    accessor = buf.add_accessor(
+        view, 0, 4, blendergltf.Buffer.FLOAT, len(values), blendergltf.Buffer.SCALAR
+    )
+    accessor.set_array(np.array(values))
+    state['buffers'].append(buf)
+    state['input']['buffers'].append(blendergltf.SimpleID(buf.name))
+    return buf, accessor
+
+
+def test_deduplicate_accessors(blendergltf, state):
+    buf_a, time_a = add_accessor(blendergltf, state, 'walk_time', [0.0, 1.0, 2.0])
+    _, time_b = add_accessor(blendergltf, state, 'run_time', [0.0, 1.0, 2.0])
+    _, other = add_accessor(blendergltf, state, 'idle_time', [0.0, 1.0])
+
+    # A second accessor in the first buffer that matches nothing keeps its view
+    view = buf_a.add_view(8, 4, None)
+    extra = buf_a.add_accessor(view, 0, 4, blendergltf.Buffer.FLOAT, 2, blendergltf.Buffer.SCALAR)
+    extra.set_array(np.array([5.0, 6.0]))
+
+    blendergltf.deduplicate_accessors(state)
+
+    assert state['aliases'] == {('accessors', time_b.name): ('accessors', time_a.name)}
+    assert [buf.name for buf in state['buffers']] == ['buffer_walk_time', 'buffer_idle_time']
+    assert [sid.name for sid in state['input']['buffers']] == [
+        'buffer_walk_time', 'buffer_idle_time'
+    ]
+    assert other.name in state['buffers'][1].accessors
+    assert buf_a.bytelength == 20
+    assert list(view['byteoffset'] for view in buf_a.buffer_views.values()) == [0, 12]
+
+
+def test_deduplicate_accessors_keeps_alignment(blendergltf, state):
+    buf, _ = add_accessor(blendergltf, state, 'vertices', [1.0, 2.0, 3.0])
+    image_view = buf.add_view(1, 0, None)
+    padding_view = buf.add_view(3, 0, None)
+    state['references'].append(blendergltf.Reference('bufferViews', image_view, None, None))
+
+    # Identical bytes in an index view are not merged with the vertex data
+    index_view = buf.add_view(12, 4, blendergltf.Buffer.ELEMENT_ARRAY_BUFFER)
+    indices = buf.add_accessor(
+        index_view, 0, 4, blendergltf.Buffer.FLOAT, 3, blendergltf.Buffer.SCALAR
+    )
+    indices.set_array(np.array([1.0, 2.0, 3.0]))
+
+    blendergltf.deduplicate_accessors(state)
+
+    assert not state['aliases']
+    assert padding_view in buf.buffer_views
+    assert buf.bytelength == 28
+    assert buf.buffer_views[index_view]['byteoffset'] == 16
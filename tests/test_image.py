@@ -0,0 +1,201 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+
+def test_pack_rects_single_page(blendergltf):
+    # pylint: disable=protected-access
+    sizes = [(32, 32), (64, 16), (16, 64), (32, 32)]
+    placements, page_count = blendergltf._pack_rects(sizes, 128)
+
+    assert page_count == 1
+    boxes = [
+        (x, y, x + w, y + h)
+        for (_, x, y), (w, h) in zip(placements, sizes)
+    ]
+    for i, box in enumerate(boxes):
+        assert box[2] <= 128 and box[3] <= 128
+        for other in boxes[i + 1:]:
+            overlap = (
+                box[0] < other[2] and other[0] < box[2]
+                and box[1] < other[3] and other[1] < box[3]
+            )
+            assert not overlap
+
+
+def test_pack_rects_multiple_pages(blendergltf):
+    # pylint: disable=protected-access
+    placements, page_count = blendergltf._pack_rects([(64, 64)] * 5, 128)
+
+    assert page_count == 2
+    assert sorted(page for page, _, _ in placements) == [0, 0, 0, 0, 1]
+
+
+def test_atlas_uv_transform(blendergltf):
+    # pylint: disable=protected-access
+    rect = (16, 32, 64, 32)
+    offset, scale = blendergltf._atlas_uv_transform(rect, (256, 128), True)
+    assert offset == (0.0625, 0.25)
+    assert scale == (0.25, 0.25)
+
+    offset, scale = blendergltf._atlas_uv_transform(rect, (256, 128), False)
+    assert offset == (0.0625, 0.5)
+
+
+def test_encode_png(blendergltf):
+    # pylint: disable=protected-access
+    pixels = np.arange(2 * 3 * 4, dtype=np.uint8).reshape(2, 3, 4)
+    png_bytes = blendergltf._encode_png(pixels)
+
+    assert png_bytes[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack('!2I', png_bytes[16:24])
+    assert (width, height) == (3, 2)
+
+    idat_length = struct.unpack('!I', png_bytes[33:37])[0]
+    raw_data = zlib.decompress(png_bytes[41:41 + idat_length])
+    assert raw_data == b'\x00' + pixels[0].tobytes() + b'\x00' + pixels[1].tobytes()
+
+
+def test_generate_mipmaps_gamma_correct(blendergltf):
+    pixels = np.zeros((4, 6, 4), dtype=np.uint8)
+    pixels[:, ::2] = 255
+
+    levels = blendergltf.generate_mipmaps(pixels, srgb=True)
+    assert [level.shape[:2] for level in levels] == [(4, 6), (2, 3), (1, 1)]
+
+    # Half black, half white averages to 50% linear light, not 50% sRGB
+    assert (levels[1][..., :3] == 188).all()
+    assert (levels[1][..., 3] == 128).all()
+
+    levels = blendergltf.generate_mipmaps(pixels, srgb=False, mip_filter='KAISER')
+    assert [level.shape[:2] for level in levels] == [(4, 6), (2, 3), (1, 1)]
+
+
+def test_encode_ktx2(blendergltf):
+    pixels = np.full((4, 2, 4), 255, dtype=np.uint8)
+    levels = blendergltf.generate_mipmaps(pixels, srgb=False)
+    data = blendergltf.encode_ktx2(levels, srgb=False)
+
+    assert data[:12] == blendergltf.KTX2_IDENTIFIER
+    header = struct.unpack('<9I', data[12:48])
+    assert header[0] == blendergltf.VK_FORMAT_R8G8B8A8_UNORM
+    assert header[2:4] == (2, 4)
+    assert header[7] == len(levels) == 3
+
+    for i, level in enumerate(levels):
+        offset, length, _ = struct.unpack_from('<QQQ', data, 80 + 24 * i)
+        assert offset % 4 == 0
+        assert data[offset:offset + length] == level.tobytes()
+
+
+def test_image_cache(blendergltf, tmpdir):
+    cache = blendergltf.ImageCache(str(tmpdir), 10)
+
+    assert cache.get(['FILE', 'a.png', 1.0, 4]) is None
+    cache.put(['FILE', 'a.png', 1.0, 4], b'1234')
+    assert cache.get(['FILE', 'a.png', 1.0, 4]) == b'1234'
+    assert cache.get(['FILE', 'a.png', 2.0, 4]) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_image_cache_evicts_least_recently_used(blendergltf, tmpdir):
+    # pylint: disable=protected-access
+    cache = blendergltf.ImageCache(str(tmpdir), 10)
+    for i, key in enumerate(('a', 'b', 'c')):
+        cache.put([key], b'12345')
+        os.utime(cache._path([key]), (i, i))
+
+    cache.get(['a'])
+    cache.evict()
+
+    assert cache.get(['a']) == b'12345'
+    assert cache.get(['b']) is None
+    assert cache.get(['c']) == b'12345'
+
+
+def test_copy_file(blendergltf, tmpdir):
+    source = tmpdir.join('source.png')
+    source.write_binary(b'image data')
+    path = tmpdir.join('output.png')
+
+    assert blendergltf.copy_file(str(source), str(path))
+    assert path.read_binary() == b'image data'
+
+    # Identical files are left alone
+    assert not blendergltf.copy_file(str(source), str(path))
+    assert not blendergltf.copy_file(str(source), str(source))
+
+    source.write_binary(b'new image data')
+    assert blendergltf.copy_file(str(source), str(path))
+    assert path.read_binary() == b'new image data'
+
+
+def test_copy_file_link(blendergltf, tmpdir):
+    source = tmpdir.join('source.png')
+    source.write_binary(b'image data')
+    path = tmpdir.join('output.png')
+
+    assert blendergltf.copy_file(str(source), str(path), link=True)
+    assert os.path.samefile(str(source), str(path))
+
+
+def test_classify_alpha(blendergltf):
+    pixels = np.full((4, 4, 4), 255, dtype=np.uint8)
+    assert blendergltf.classify_alpha(pixels) == 'OPAQUE'
+
+    pixels[:2, :, 3] = 0
+    pixels[3, 3, 3] = 250
+    assert blendergltf.classify_alpha(pixels) == 'MASK'
+
+    pixels[3, 3, 3] = 128
+    assert blendergltf.classify_alpha(pixels) == 'BLEND'
+
+
+def test_encode_png_strips_opaque_alpha(blendergltf):
+    # pylint: disable=protected-access
+    pixels = np.full((2, 3, 4), 255, dtype=np.uint8)
+    pixels[..., 0] = 7
+    png_bytes = blendergltf._encode_png(pixels)
+
+    assert png_bytes[25] == 2
+    idat_length = struct.unpack('!I', png_bytes[33:37])[0]
+    raw_data = zlib.decompress(png_bytes[41:41 + idat_length])
+    assert raw_data == (b'\x00' + b'\x07\xff\xff' * 3) * 2
+
+
+def test_get_image_pixels(blendergltf, mocker):
+    # pylint: disable=protected-access
+    class FakePixels:
+        def __init__(self, values):
+            self.values = values
+
+        def foreach_get(self, out):
+            out[:] = self.values
+
+    image = mocker.MagicMock()
+    image.size = (2, 1)
+    image.channels = 3
+    image.pixels = FakePixels([0.0, 0.5, 1.0, 1.0, 1.0, 1.0])
+
+    pixels = blendergltf._get_image_pixels(image)
+    assert pixels.tolist() == [[[0, 127, 255, 255], [255, 255, 255, 255]]]
+
+
+def test_image_cache_version(blendergltf, tmpdir, mocker):
+    cache = blendergltf.ImageCache(str(tmpdir), 10)
+    cache.put(['FILE', 'a.png'], b'1234')
+
+    mocker.patch.object(blendergltf, 'IMAGE_CACHE_VERSION', blendergltf.IMAGE_CACHE_VERSION + 1)
+    assert cache.get(['FILE', 'a.png']) is None
+
+
+def test_export_image_skips_cache_key(blendergltf, state, mocker):
+    mocker.patch.object(blendergltf, '_image_cache_key')
+    mocker.patch.dict(state['settings'], {'images_data_storage': 'REFERENCE'})
+    image = mocker.MagicMock(packed_file=None, filepath='//a.png')
+    image.name = 'a'
+
+    assert blendergltf.export_image(state, image)['uri'] == 'a.png'
+    assert not blendergltf._image_cache_key.called
@@ -67,3 +67,64 @@ def test_material_textured(mocker, blendergltf, state, bpy_material_default, glt
         ref.source[ref.prop] = ref.blender_name
 
     assert output == gltf_material_default
+
+
+def test_material_alpha_mode(mocker, blendergltf, state, bpy_material_default):
+    pbr = bpy_material_default.pbr_export_settings
+    pbr.base_color_texture = 'base_color'
+    pbr.base_color_text_index = 0
+    pbr.metal_roughness_texture = ''
+    pbr.emissive_texture = ''
+    pbr.normal_texture = ''
+    pbr.occlusion_texture = ''
+
+    texture = mocker.MagicMock()
+    texture.name = 'base_color'
+    texture.image.name = 'base_color_image'
+    state['input']['textures'] = [texture]
+    blendergltf.bpy.data.textures.get.return_value = texture
+
+    state['image_alpha']['base_color_image'] = 'MASK'
+    output = blendergltf.export_material(state, bpy_material_default)
+    assert output['alphaMode'] == 'MASK'
+    assert output['alphaCutoff'] == 0.5
+
+    state['image_alpha']['base_color_image'] = 'OPAQUE'
+    output = blendergltf.export_material(state, bpy_material_default)
+    assert 'alphaMode' not in output
+
+    pbr.base_color_factor = [1.0, 1.0, 1.0, 0.5]
+    output = blendergltf.export_material(state, bpy_material_default)
+    assert output['alphaMode'] == 'BLEND'
+    assert 'alphaCutoff' not in output
+
+
+def test_get_alpha_images(mocker, blendergltf, state):
+    def make_material(alpha, image_name):
+        material = mocker.MagicMock()
+        material.pbr_export_settings.base_color_factor = [1.0, 1.0, 1.0, alpha]
+        material.pbr_export_settings.base_color_texture = image_name
+        return material
+
+    def get_texture(name):
+        texture = mocker.MagicMock()
+        texture.image.name = name
+        return texture
+
+    blendergltf.bpy.data.textures.get.side_effect = get_texture
+    state['input']['materials'] = [make_material(1.0, 'leaves'), make_material(0.5, 'glass')]
+    assert blendergltf.get_alpha_images(state) == {'leaves'}
+    blendergltf.bpy.data.textures.get.side_effect = None
+
+
+def test_atlas_transform_required(mocker, blendergltf, state):
+    # pylint: disable=protected-access
+    material = mocker.MagicMock()
+    material.name = 'leaves'
+    state['atlas']['texture_transforms'][('leaves', 'bark')] = ((0.5, 0.0), (0.5, 0.5))
+    texture_info = {}
+    blendergltf._apply_atlas_transform(state, material, 'bark', texture_info)
+
+    assert texture_info['extensions']['KHR_texture_transform']['offset'] == [0.5, 0.0]
+    assert state['extensions_used'] == ['KHR_texture_transform']
+    assert state['extensions_required'] == ['KHR_texture_transform']
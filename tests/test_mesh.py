@@ -0,0 +1,341 @@
+import numpy as np
+import pytest
+
+
+class FakeVertex:
+    def __init__(self, groups):
+        groups = sorted(groups, key=lambda group: group[1], reverse=True)
+        self.joint_indexes = [group for group, _ in groups]
+        self.weights = [weight for _, weight in groups]
+
+
+def test_compact_skin_influences(blendergltf):
+    # Vertex group 3 is not a bone, bones 0 and 1 are never referenced
+    group_joints = {0: 7, 1: 2, 2: 5, 4: 9, 5: 6}
+    vert_list = [
+        FakeVertex([(0, 0.5), (1, 0.5), (3, 1.0)]),
+        FakeVertex([(2, 0.25), (0, 0.25), (1, 0.25), (4, 0.2), (5, 0.05)]),
+        FakeVertex([(5, 1.0), (2, 0.0001)]),
+        FakeVertex([]),
+    ]
+
+    palette, joints, weights = blendergltf.compact_skin_influences(vert_list, group_joints, 0.01)
+
+    assert list(palette) == [2, 5, 6, 7, 9]
+    assert np.allclose(weights.sum(axis=1), [1.0, 1.0, 1.0, 0.0])
+    assert list(palette[joints[0, :2]]) == [7, 2]
+    assert list(palette[joints[1]]) == [5, 7, 2, 9]
+    assert np.allclose(weights[1], [0.25 / 0.95] * 3 + [0.2 / 0.95])
+    assert list(palette[joints[2, :1]]) == [6] and weights[2, 1] == 0.0
+    assert np.all(joints[3] == 0)
+
+
+def test_quantize_weights(blendergltf):
+    weights = np.array([
+        [1.0 / 3.0, 1.0 / 3.0, 1.0 / 3.0, 0.0],
+        [0.45, 0.45, 0.1, 0.0],
+        [0.0, 0.0, 0.0, 0.0],
+    ])
+
+    # Rounding error goes to the strongest influence
+    quantized = blendergltf.quantize_weights(weights, blendergltf.Buffer.UNSIGNED_BYTE)
+    assert list(quantized.sum(axis=1)) == [255, 255, 0]
+    assert list(quantized[1]) == [114, 115, 26, 0]
+
+    quantized = blendergltf.quantize_weights(weights, blendergltf.Buffer.UNSIGNED_SHORT)
+    assert list(quantized.sum(axis=1)) == [65535, 65535, 0]
+
+
+def test_partition_triangles(blendergltf):
+    # A strip of quads where each quad uses its own pair of joints
+    joints = np.zeros((12, 4), dtype=np.int64)
+    weights = np.zeros((12, 4))
+    joints[:, 0] = np.arange(12) // 2
+    weights[:, 0] = 1.0
+    triangles = np.array([
+        [i, i + 1, i + 2] for i in range(0, 10, 2)
+    ] + [
+        [i + 1, i + 3, i + 2] for i in range(0, 10, 2)
+    ])
+
+    partitions = blendergltf.partition_triangles(triangles, joints, weights, 3)
+
+    assert len(partitions) > 1
+    assert sorted(i for _, indices in partitions for i in indices) == list(range(10))
+    for part_joints, indices in partitions:
+        assert len(part_joints) <= 3
+        used = set(joints[triangles[indices], 0].ravel().tolist())
+        assert used <= set(part_joints)
+
+    # A triangle that alone exceeds the limit cannot be placed anywhere
+    with pytest.raises(ValueError):
+        blendergltf.partition_triangles(triangles, joints, weights, 1)
+
+
+def test_partition_skinned_mesh(blendergltf):
+    joints = np.array([[0, 1, 0, 0], [1, 0, 0, 0], [2, 0, 0, 0], [3, 0, 0, 0]])
+    weights = np.array([[0.5, 0.5, 0, 0], [1.0, 0, 0, 0], [1.0, 0, 0, 0], [1.0, 0, 0, 0]])
+    prims = {'a': [0, 1, 2], 'b': [1, 3, 2]}
+    joint_names = ['j0', 'j1', 'j2', 'j3']
+
+    parts = blendergltf.partition_skinned_mesh(
+        'Body', prims, joint_names, joints, weights, 3
+    )
+
+    assert [part[0] for part in parts] == ['Body', 'Body_part1']
+    _, vertex_indices, part_prims, (part_joints, part_weights), names = parts[1]
+    assert vertex_indices == [1, 2, 3]
+    assert dict(part_prims) == {'a': [], 'b': [0, 2, 1]}
+    assert names == ['j1', 'j2', 'j3']
+    assert list(part_joints[:, 0]) == [0, 1, 2]
+    assert np.allclose(part_weights, weights[1:])
+
+
+def test_compute_loop_normals(blendergltf):
+    # Two quads folded 45 degrees along their shared edge (1, 2)
+    positions = np.array([
+        [0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [0.0, 1.0, 0.0],
+        [2.0, 0.0, 1.0], [2.0, 1.0, 1.0],
+    ])
+    loop_vertices = np.array([0, 1, 2, 3, 1, 4, 5, 2])
+    loop_start = np.array([0, 4])
+    loop_total = np.array([4, 4])
+
+    flat = blendergltf.compute_loop_normals(
+        positions, loop_vertices, loop_start, loop_total, np.array([False, False])
+    )
+    assert np.allclose(flat[:4], [0.0, 0.0, 1.0])
+    assert np.allclose(flat[4:], [-np.sqrt(0.5), 0.0, np.sqrt(0.5)])
+
+    smooth = blendergltf.compute_loop_normals(
+        positions, loop_vertices, loop_start, loop_total, np.array([True, True])
+    )
+    shared = smooth[loop_vertices == 1]
+    assert np.allclose(shared[0], shared[1])
+    assert np.allclose(shared[0], [-np.sin(np.pi / 8), 0.0, np.cos(np.pi / 8)])
+    assert np.allclose(smooth[0], [0.0, 0.0, 1.0])
+
+
+class FakeCollection(list):
+    def __init__(self, attr, values):
+        super().__init__(values)
+        self.attr = attr
+
+    def foreach_get(self, attr, out):
+        assert attr == self.attr
+        out[:] = np.array(self, dtype=out.dtype).ravel()
+
+
+def test_get_shape_key_deltas(blendergltf, mocker):
+    mesh = mocker.MagicMock()
+    mesh.name = 'Plane'
+    mesh.loops = FakeCollection('vertex_index', [0, 1, 2, 0, 2, 3])
+    mesh.polygons = mocker.MagicMock()
+    mesh.polygons.__len__.return_value = 2
+    attrs = {'loop_start': [0, 3], 'loop_total': [3, 3], 'use_smooth': [False, False]}
+    mesh.polygons.foreach_get.side_effect = lambda attr, out: out.__setitem__(
+        slice(None), attrs[attr]
+    )
+
+    square = [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [0.0, 1.0, 0.0]]
+    basis = mocker.MagicMock()
+    basis.name = 'Basis'
+    basis.data = FakeCollection('co', square)
+    raised = mocker.MagicMock()
+    raised.name = 'Raise'
+    raised.data = FakeCollection('co', [co[:2] + [1.0] for co in square])
+    raised.relative_key = basis
+    raised.slider_max = 2.0
+    mesh.shape_keys.reference_key = basis
+
+    deltas, = blendergltf.get_shape_key_deltas(mesh, [raised])
+
+    assert deltas.name == 'Plane_Raise'
+    assert np.allclose(deltas.positions, [0.0, 0.0, 2.0])
+    assert deltas.positions.shape == (6, 3)
+    assert np.allclose(deltas.normals, 0.0)
+
+
+class FakeNamed:
+    def __init__(self, name):
+        self.name = name
+        self.identifier = name
+
+
+class FakeProperty:
+    def __init__(self, identifier, prop_type, is_array=False, fixed_type=None,
+                 is_enum_flag=False):
+        self.identifier = identifier
+        self.type = prop_type
+        self.is_array = is_array
+        self.is_enum_flag = is_enum_flag
+        self.fixed_type = FakeNamed(fixed_type)
+
+
+class FakeModifier:
+    def __init__(self, **values):
+        self.__dict__.update(values)
+        self.bl_rna = FakeNamed('Modifier')
+        self.bl_rna.properties = [
+            FakeProperty('rna_type', 'POINTER', fixed_type='Struct'),
+            FakeProperty('name', 'STRING'),
+            FakeProperty('levels', 'INT'),
+            FakeProperty('offset', 'FLOAT', is_array=True),
+            FakeProperty('offset_object', 'POINTER', fixed_type='Object'),
+        ]
+
+
+def test_modifier_signature(blendergltf, mocker):
+    # pylint: disable=protected-access
+    def make_object(name, levels, offset_object=None, matrix=np.identity(4)):
+        obj = mocker.MagicMock()
+        obj.data = FakeNamed('Rock')
+        obj.modifiers = [FakeModifier(
+            name=name, levels=levels, offset=(1.0, 0.0, 0.0), offset_object=offset_object
+        )]
+        obj.vertex_groups = [FakeNamed('Top')]
+        obj.material_slots = []
+        obj.matrix_world = matrix
+        return obj
+
+    signature = blendergltf._get_modifier_signature(make_object('Subsurf', 2))
+    assert signature == blendergltf._get_modifier_signature(make_object('Renamed', 2))
+    assert signature != blendergltf._get_modifier_signature(make_object('Subsurf', 3))
+
+    # Modifiers using other objects also depend on where the object is
+    target = FakeNamed('Empty')
+    moved = np.identity(4)
+    moved[0, 3] = 1.0
+    assert (
+        blendergltf._get_modifier_signature(make_object('Array', 2, target)) !=
+        blendergltf._get_modifier_signature(make_object('Array', 2, target, moved))
+    )
+
+
+class FakeMeshVertex:
+    def __init__(self, co, normal):
+        self.co = co
+        self.normal = normal
+        self.uvs = ((co[0], co[1]),)
+        self.colors = ()
+
+
+def test_export_static_batch(blendergltf, state, mocker):
+    state['settings'] = dict(state['settings'], asset_profile='DESKTOP')
+    mesh = mocker.MagicMock()
+    mesh.name = 'Tile'
+    mesh.uv_layers = [None]
+    mesh.vertex_colors = []
+    vert_list = [
+        FakeMeshVertex((0.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+        FakeMeshVertex((1.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+        FakeMeshVertex((0.0, 1.0, 0.0), (0.0, 0.0, 1.0)),
+    ]
+    geometry = {'Tile': (vert_list, {'Stone': [0, 1, 2], '': []})}
+
+    moved = mocker.MagicMock()
+    moved.name = 'Moved'
+    moved.data = mesh
+    moved.matrix_world = np.identity(4)
+    moved.matrix_world[:3, 3] = (5.0, 0.0, 0.0)
+    mirrored = mocker.MagicMock()
+    mirrored.name = 'Mirrored'
+    mirrored.data = mesh
+    mirrored.matrix_world = np.diag([-2.0, 1.0, 1.0, 1.0])
+
+    gltf_mesh = blendergltf.export_static_batch(state, 'batch', [moved, mirrored], geometry)
+
+    assert len(gltf_mesh['primitives']) == 1
+    prim = gltf_mesh['primitives'][0]
+    assert prim['material'].blender_name == 'Stone'
+    accessors = state['buffers'][0].accessors
+    indices = accessors[prim['indices'].blender_name]
+    assert [indices[i] for i in range(6)] == [0, 1, 2, 5, 4, 3]
+    positions = accessors[prim['attributes']['POSITION'].blender_name]
+    assert positions.min[:3] == [-2.0, 0.0, 0.0] and positions.max[:3] == [6.0, 1.0, 0.0]
+    assert [positions[i] for i in range(12, 15)] == [-2.0, 0.0, 0.0]
+    assert sorted(prim['attributes']) == ['NORMAL', 'POSITION', 'TEXCOORD_0']
+
+
+def test_morton_order(blendergltf):
+    # pylint: disable=protected-access
+    points = [(10, 10, 0), (0, 0, 0), (10, 9, 0), (1, 0, 0)]
+    order = list(blendergltf._morton_order(points))
+    assert sorted(order) == [0, 1, 2, 3]
+    assert abs(order.index(0) - order.index(2)) == 1
+    assert abs(order.index(1) - order.index(3)) == 1
+
+
+def test_solve_rigid_transform(blendergltf):
+    source = np.array([[0, 0, 0], [1, 0, 0], [0, 2, 0], [0, 0, 3], [1, 1, 1]], dtype=np.float64)
+    angle = 0.7
+    rotation = np.array([
+        [np.cos(angle), -np.sin(angle), 0],
+        [np.sin(angle), np.cos(angle), 0],
+        [0, 0, 1],
+    ])
+    target = np.matmul(source, rotation.T) + (5, -2, 1)
+
+    matrix = blendergltf.solve_rigid_transform(source, target)
+    assert np.allclose(matrix[:3, :3], rotation)
+    assert np.allclose(matrix[:3, 3], (5, -2, 1))
+
+    topology = 'abc'
+    assert (
+        blendergltf.get_mesh_signature(source, topology) ==
+        blendergltf.get_mesh_signature(target, topology)
+    )
+
+    # Mirrored and deformed copies are not matched
+    assert blendergltf.solve_rigid_transform(source, source * (-1, 1, 1)) is None
+    assert blendergltf.solve_rigid_transform(source, source * (1, 1, 2)) is None
+
+
+def test_solve_rigid_transform_planar(blendergltf):
+    source = np.array([[0, 0, 0], [2, 0, 0], [2, 1, 0], [0, 1, 0]], dtype=np.float64)
+    target = source[:, (1, 0, 2)] * (-1, 1, 1)
+    matrix = blendergltf.solve_rigid_transform(source, target)
+    assert np.allclose(np.matmul(source, matrix[:3, :3].T) + matrix[:3, 3], target)
+    assert np.isclose(np.linalg.det(matrix[:3, :3]), 1.0)
+
+
+def test_modifier_signature_enum_flags(blendergltf, mocker):
+    # pylint: disable=protected-access
+    def make_object(data_types):
+        modifier = FakeModifier(name='DataTransfer', data_types_verts=data_types)
+        modifier.bl_rna.properties.append(
+            FakeProperty('data_types_verts', 'ENUM', is_enum_flag=True)
+        )
+        obj = mocker.MagicMock()
+        obj.data = FakeNamed('Rock')
+        obj.modifiers = [modifier]
+        obj.vertex_groups = []
+        obj.material_slots = []
+        return obj
+
+    signature = blendergltf._get_modifier_signature(
+        make_object({'VGROUP_WEIGHTS', 'BEVEL_WEIGHT_VERT'})
+    )
+    assert hash(signature)
+    assert signature == blendergltf._get_modifier_signature(
+        make_object({'BEVEL_WEIGHT_VERT', 'VGROUP_WEIGHTS'})
+    )
+    assert signature != blendergltf._get_modifier_signature(make_object({'VGROUP_WEIGHTS'}))
+
+
+def test_can_move_mesh_transform(blendergltf, state, mocker):
+    # pylint: disable=protected-access
+    obj = mocker.MagicMock(animation_data=None, children=[], constraints=[], rigid_body=None)
+    obj.parent = None
+    obj.find_armature.return_value = None
+    obj.matrix_local = np.diag((2.0, 2.0, 2.0, 1.0))
+    assert blendergltf._can_move_mesh_transform(state, obj)
+
+    obj.matrix_local = np.diag((1.0, 2.0, 1.0, 1.0))
+    assert not blendergltf._can_move_mesh_transform(state, obj)
+
+    # Animation data without an action or NLA tracks can still be baked
+    obj.matrix_local = np.diag((2.0, 2.0, 2.0, 1.0))
+    obj.animation_data = mocker.MagicMock(action=None)
+    obj.animation_data.nla_tracks = []
+    assert not blendergltf._can_move_mesh_transform(state, obj)
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def test_scene_default(blendergltf, state, bpy_scene_default, gltf_scene_default):
     state['input']['cameras'].append(bpy_scene_default.camera.name)
     output = blendergltf.export_scene(state, bpy_scene_default)
@@ -15,3 +18,270 @@ def test_scene_custom_props(blendergltf, state, bpy_scene_default):
     blendergltf._get_custom_properties.return_value = {'foo': 'bar'}
     output = blendergltf.export_scene(state, bpy_scene_default)
     assert ('foo', 'bar') in output['extras'].items()
+
+
+def test_scene_overrides_restore_once(blendergltf, mocker):
+    scene = mocker.MagicMock()
+    scene.frame_current = 7
+    key = mocker.MagicMock()
+    key.as_pointer.return_value = 1
+    key.value = 0.25
+    armature = mocker.MagicMock()
+    armature.as_pointer.return_value = 2
+    armature.pose_position = 'POSE'
+
+    try:
+        with blendergltf.SceneOverrides(scene) as overrides:
+            overrides.set(armature, 'pose_position', 'REST')
+            overrides.set(key, 'value', 0.0)
+            overrides.set(key, 'value', 1.0)
+            overrides.evaluate()
+            assert overrides.original(key, 'value') == 0.25
+            assert (key.value, armature.pose_position) == (1.0, 'REST')
+            raise RuntimeError('export failed')
+    except RuntimeError:
+        pass
+
+    assert (key.value, armature.pose_position) == (0.25, 'POSE')
+    assert scene.frame_set.call_args_list == [mocker.call(7), mocker.call(7)]
+
+
+def test_gpu_instances(blendergltf, state, mocker):
+    # pylint: disable=protected-access
+    mocker.patch.object(
+        blendergltf, '_is_static_mesh_object', lambda state, obj: obj.type == 'MESH'
+    )
+    scene = mocker.MagicMock()
+    scene.name = 'Scene'
+
+    mesh = mocker.MagicMock()
+    mesh.name = 'Rock'
+    state['input']['meshes'] = [mesh]
+    state['input']['scenes'] = [scene]
+
+    def make_object(name, obj_type, location):
+        obj = mocker.MagicMock()
+        obj.name = name
+        obj.type = obj_type
+        obj.data = mesh if obj_type == 'MESH' else None
+        obj.users_scene = [scene]
+        obj.find_armature.return_value = None
+        obj.matrix_world = np.identity(4)
+        obj.matrix_world[:3, 3] = location
+        return obj
+
+    rocks = [make_object('Rock.{}'.format(i), 'MESH', (i, 0, 0)) for i in range(3)]
+    empty = make_object('Pile', 'EMPTY', (0, 5, 0))
+    empty.parent = None
+    empty.animation_data = None
+    empty.constraints = []
+    empty.rigid_body = None
+    empty.dupli_group.objects = [rocks[0]]
+    empty.dupli_group.dupli_offset = (1, 0, 0)
+    state['input']['objects'] = rocks + [empty]
+
+    blendergltf.build_gpu_instances(state)
+
+    assert state['input']['objects'] == [empty]
+    assert state['gpu_dupli_groups'] == {'Pile'}
+    matrices = state['gpu_instances'][('Rock', ('Scene',))]
+    assert np.allclose(matrices[:, :3, 3], [[0, 0, 0], [1, 0, 0], [2, 0, 0], [-1, 5, 0]])
+
+    state['output']['scenes'] = [{'nodes': []}]
+    blendergltf.export_gpu_instances(state)
+
+    node = state['dupli_nodes'][0]
+    attributes = node['extensions']['EXT_mesh_gpu_instancing']['attributes']
+    assert sorted(attributes) == ['ROTATION', 'SCALE', 'TRANSLATION']
+    assert node['mesh'].blender_name == 'Rock'
+    assert state['output']['scenes'][0]['nodes'][0].blender_name == node['name']
+    assert state['extensions_used'] == ['EXT_mesh_gpu_instancing']
+    assert state['extensions_required'] == ['EXT_mesh_gpu_instancing']
+    translation = state['buffers'][0].accessors[attributes['TRANSLATION'].blender_name]
+    assert translation.count == 4
+
+
+class _Matrix(np.ndarray):
+    def __mul__(self, other):
+        return np.matmul(self, other).view(_Matrix)
+
+
+def test_flatten_hierarchy(blendergltf, state, mocker):
+    # pylint: disable=protected-access
+    def make_object(name, obj_type, parent=None, location=(0, 0, 0)):
+        obj = mocker.MagicMock()
+        obj.name = name
+        obj.type = obj_type
+        obj.parent = parent
+        obj.children = []
+        obj.animation_data = None
+        obj.constraints = []
+        obj.dupli_group = None
+        obj.rigid_body = None
+        obj.game.properties = []
+        obj.matrix_local = np.identity(4).view(_Matrix)
+        obj.matrix_local[:3, 3] = location
+        if parent is not None:
+            parent.children.append(obj)
+        return obj
+
+    root = make_object('Root', 'EMPTY')
+    group = make_object('Group', 'EMPTY', root, (0, 0, 2))
+    mesh = make_object('Mesh', 'MESH', group, (1, 0, 0))
+    make_object('Leaf', 'EMPTY', root)
+    target = make_object('Target', 'EMPTY', root)
+    camera = make_object('Camera', 'CAMERA', root)
+    camera.constraints = [mocker.MagicMock(target=target)]
+    state['input']['objects'] = [root] + root.children + [mesh]
+
+    blendergltf.flatten_hierarchy(state)
+
+    assert state['flattened_nodes'] == {'Group', 'Leaf'}
+    assert [obj.name for obj in state['input']['objects']] == ['Root', 'Target', 'Camera', 'Mesh']
+    assert blendergltf._get_node_children(state, root) == [mesh, target, camera]
+    assert blendergltf._get_node_parent(state, mesh) is root
+    assert np.allclose(blendergltf._get_node_matrix(state, mesh)[:3, 3], (1, 0, 2))
+
+
+def test_flatten_hierarchy_keeps_animated_child(blendergltf, state, mocker):
+    # Mock() reserves the parent keyword, so hierarchy attributes are set afterwards
+    parent = mocker.MagicMock(type='EMPTY', animation_data=None, constraints=[],
+                              dupli_group=None, rigid_body=None)
+    parent.name = 'Offset'
+    parent.parent = None
+    parent.game.properties = []
+    parent.matrix_local = np.diag((2.0, 2.0, 2.0, 1.0))
+    child = mocker.MagicMock(children=[], constraints=[])
+    child.parent = parent
+    parent.children = [child]
+    state['input']['objects'] = [parent, child]
+
+    blendergltf.flatten_hierarchy(state)
+    assert not state['flattened_nodes']
+
+    parent.matrix_local = np.identity(4)
+    blendergltf.flatten_hierarchy(state)
+    assert state['flattened_nodes'] == {'Offset'}
+
+
+def test_build_bvh(blendergltf):
+    low = np.array([[x, 0, 0] for x in range(10)], dtype=np.float64)
+    high = low + 0.5
+    hierarchy, order = blendergltf.build_bvh(low, high, leaf_size=2)
+
+    assert sorted(order) == list(range(10))
+    assert np.allclose(hierarchy[0]['min'], (0, 0, 0))
+    assert np.allclose(hierarchy[0]['max'], (9.5, 0.5, 0.5))
+
+    def visit(index):
+        node = hierarchy[index]
+        if node['count']:
+            items = order[node['offset']:node['offset'] + node['count']]
+            assert (low[items] >= node['min']).all() and (high[items] <= node['max']).all()
+            return list(items)
+        return visit(index + 1) + visit(node['offset'])
+    assert sorted(visit(0)) == list(range(10))
+
+
+def test_get_world_bounds(blendergltf):
+    matrix = np.identity(4)
+    matrix[:3, :3] = [[0, -2, 0], [2, 0, 0], [0, 0, 2]]
+    matrix[:3, 3] = (1, 0, 0)
+    low, high, sphere = blendergltf.get_world_bounds(
+        matrix[None], np.array([[0, 0, 0]]), np.array([[1, 2, 0]])
+    )
+    assert np.allclose(low, [[-3, 0, 0]])
+    assert np.allclose(high, [[1, 2, 0]])
+    assert np.allclose(sphere, [[-1, 1, 0, np.sqrt(5)]])
+
+
+def test_export_scene_bvh(blendergltf, state, mocker):
+    buf = blendergltf.Buffer('mesh')
+    # pylint: disable=protected-access
+    positions = blendergltf._add_array_accessor(
+        buf, np.array([[-1, -1, -1], [1, 1, 1]], dtype=np.float32),
+        blendergltf.Buffer.FLOAT, blendergltf.Buffer.VEC3
+    )
+    state['buffers'].append(buf)
+
+    def ref(blender_type, name):
+        return blendergltf.Reference(blender_type, name, None, None)
+
+    primitive = {'attributes': {'POSITION': ref('accessors', positions.name)}}
+    mesh = {'name': 'Box', 'primitives': [primitive]}
+    parent = {'name': 'Parent', 'translation': (10, 0, 3), 'children': [ref('objects', 'Box')]}
+    box = {'name': 'Box', 'mesh': ref('meshes', 'Box')}
+    animated = {'name': 'Animated', 'mesh': ref('meshes', 'Box')}
+    objects = []
+    for name, animation_data in (('Parent', None), ('Box', None), ('Animated', mocker.MagicMock())):
+        obj = mocker.MagicMock(animation_data=animation_data)
+        obj.name = name
+        objects.append(obj)
+
+    state['input']['objects'] = objects
+    state['input']['meshes'] = [blendergltf.SimpleID('Box')]
+    state['output'] = {
+        'nodes': [parent, box, animated],
+        'meshes': [mesh],
+        'scenes': [{
+            'name': 'Scene',
+            'nodes': [ref('objects', 'Parent'), ref('objects', 'Animated')],
+            'extras': {},
+        }],
+    }
+
+    # Z up to Y up
+    global_matrix = np.array([[1, 0, 0, 0], [0, 0, 1, 0], [0, -1, 0, 0], [0, 0, 0, 1]])
+    state['settings'] = dict(state['settings'], nodes_global_matrix=global_matrix)
+    blendergltf.export_scene_bvh(state, 0)
+
+    bvh = state['output']['scenes'][0]['extras']['bvh']
+    assert [node.blender_name for node in bvh['nodes']] == ['Box']
+    bvh_buf = state['buffers'][-1]
+    primitives = np.frombuffer(
+        bytes(bvh_buf.buffer_views[bvh['primitive_bounds'].blender_name]['data']),
+        dtype=blendergltf.PRIMITIVE_BOUNDS_DTYPE
+    )
+    assert len(primitives) == 1
+    assert np.allclose(primitives[0]['min'], (9, 2, -1))
+    assert np.allclose(primitives[0]['max'], (11, 4, 1))
+    assert (primitives[0]['node'], primitives[0]['primitive'], primitives[0]['instance']) == (
+        0, 0, -1
+    )
+
+
+def test_gpu_instances_skip_dynamic_empties(blendergltf, state, mocker):
+    scene = mocker.MagicMock()
+    scene.name = 'Scene'
+    mesh = mocker.MagicMock()
+    mesh.name = 'Rock'
+    state['input']['meshes'] = [mesh]
+
+    rock = mocker.MagicMock(type='MESH', data=mesh)
+    rock.find_armature.return_value = None
+    rock.matrix_world = np.identity(4)
+
+    def make_empty(name, animated=False, visible=True):
+        empty = mocker.MagicMock(type='EMPTY', constraints=[], rigid_body=None, children=[])
+        empty.name = name
+        empty.parent = None
+        empty.users_scene = [scene]
+        empty.animation_data = mocker.MagicMock() if animated else None
+        empty.is_visible.return_value = visible
+        empty.matrix_world = np.identity(4)
+        empty.dupli_group.objects = [rock]
+        empty.dupli_group.dupli_offset = (0, 0, 0)
+        return empty
+
+    empties = [
+        make_empty('Static'),
+        make_empty('Static.001'),
+        make_empty('Animated', animated=True),
+        make_empty('Hidden', visible=False),
+    ]
+    state['input']['objects'] = list(empties)
+
+    blendergltf.build_gpu_instances(state)
+
+    assert state['gpu_dupli_groups'] == {'Static', 'Static.001'}
+    assert len(state['gpu_instances'][('Rock', ('Scene',))]) == 2